@@ -1,4 +1,5 @@
 
+import asyncio
 import os
 from dotenv import load_dotenv
 
@@ -15,35 +16,52 @@ else:
     print("[ERROR] DATABASE_URL is not set!")
 
 from typing import List, Optional
-from datetime import datetime, timedelta
-from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Depends, Request
+from datetime import datetime
+from fastapi import FastAPI, Form, UploadFile, File, HTTPException, Depends, Response, BackgroundTasks
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from prisma import Prisma
-from passlib.context import CryptContext
-from jose import jwt, JWTError
+from database import db
+from auth import create_access_token, get_current_user, get_current_user_id, token_cache
+from passwords import password_hasher, PasswordHasherBusy
+from singleflight import SingleFlight
+from geo import haversine_meters, METERS_PER_MILE
+from spatial_index import spatial_indexes, SPATIAL_INDEX_ENABLED, NEAREST_MAX_RADIUS_METERS
+from routing import join_costs, join_costs_many, plan_pickups
+from group_index import open_group_index
+from commute import query_commute_matches, index_commute_matches
+from match_refresher import match_refresher, MATCH_REFRESH_ENABLED, MATCH_RADIUS_METERS, MATCH_STORE_SIZE
+from pagination import (
+    InvalidCursor, decode_cursor, page_size, paginate, seek_page,
+    SEARCH_PAGE_SIZE, NEARBY_PAGE_SIZE
+)
 from storage import storage_service
-from geocoding import geocode_address
+from images import image_processor, store_variants, MAX_IMAGE_UPLOAD_BYTES
+from prisma import Json
+from prisma.errors import UniqueViolationError
+import geocoding
+from geocoding import geocoder
+from geocode_worker import enqueue_geocode_jobs, geocode_worker, geocoding_status, GEOCODE_WORKER_ENABLED
+from geocode_cache import geocode_cache
+from gazetteer import gazetteer
 
 BASE_DIR = os.path.dirname(__file__)
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# Authentication configuration
-JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
-JWT_ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60
+from content_store import UploadsStaticFiles
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+app = FastAPI()
 
-from fastapi.staticfiles import StaticFiles
+# Identical concurrent searches (e.g. colleagues at one office) share one query
+search_flight = SingleFlight("search")
 
-app = FastAPI()
-db = Prisma()
+# /groups/open re-ranks this many groups along the route corridor by real detour
+OPEN_GROUP_CANDIDATES = int(os.getenv("OPEN_GROUP_CANDIDATES", "50"))
+# Groups returned by the city/office fallback of /groups/open
+OPEN_GROUP_FALLBACK_RESULTS = int(os.getenv("OPEN_GROUP_FALLBACK_RESULTS", "20"))
 
 # Serve uploaded profile images
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", UploadsStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # Adjust this origin to your React dev server
 app.add_middleware(
@@ -59,63 +77,84 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # /search returns a bare list, so its next-page cursor travels in a header
+    expose_headers=["X-Next-Cursor"],
 )
 
 
 @app.on_event("startup")
 async def startup():
     await db.connect()
+    password_hasher.start()
+    image_processor.start()
+    await geocoder.start()
+    if GEOCODE_WORKER_ENABLED:
+        geocode_worker.start()
+    if SPATIAL_INDEX_ENABLED:
+        spatial_indexes.start()
+    if MATCH_REFRESH_ENABLED:
+        match_refresher.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await geocode_worker.stop()
+    await spatial_indexes.stop()
+    await match_refresher.stop()
     await db.disconnect()
-
-
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    """Create a JWT access token"""
-    to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.utcnow() + expires_delta
-    else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
-    return encoded_jwt
+    password_hasher.shutdown()
+    image_processor.shutdown()
+    await geocoder.close()
 
 
 @app.get("/")
 async def root():
     return {"ok": True}
 
-def decode_token(token: str):
+
+async def _match_queue_stats() -> dict:
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Invalid or expired token")
+        return await match_refresher.queue_stats()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+async def _release_profile_images(profile_path: Optional[str], profile_variants: Optional[dict]):
+    """Drop a stored profile image and its variants once no user refers to them"""
+    for path in filter(None, [profile_path, *(profile_variants or {}).values()]):
+        try:
+            await storage_service.delete_file(path)
+        except Exception as e:
+            print(f"[WARNING] Could not release {path}: {e}")
+
+
+@app.get("/metrics")
+async def metrics():
+    """Runtime counters for the in-process caches and worker pools"""
+    return {
+        "authTokenCache": token_cache.stats(),
+        "passwordHasher": password_hasher.stats(),
+        "geocodeCache": geocode_cache.stats(),
+        "geocoder": geocoder.stats(),
+        "geocoderRateLimit": geocoding.rate_limiter.stats(),
+        "singleFlight": {
+            "geocode": geocoding.geocode_flight.stats(),
+            "search": search_flight.stats()
+        },
+        "gazetteer": gazetteer.stats(),
+        "geocodeWorker": geocode_worker.stats(),
+        "spatialIndex": spatial_indexes.stats(),
+        "openGroupIndex": open_group_index.stats(),
+        "userMatches": {**match_refresher.stats(), **await _match_queue_stats()},
+        # The content store counts its files in SQLite; keep that off the event loop
+        "storage": await asyncio.to_thread(storage_service.stats),
+        "imageProcessor": image_processor.stats()
+    }
+
 
 @app.get("/me")
-async def get_me(request: Request):
+async def get_me(user = Depends(get_current_user)):
     """Return current user info based on Authorization: Bearer <token> header"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    user = await db.user.find_unique(
-        where={"id": user_id},
-        include={
-            "companyAddress": True,
-            "homeAddress": True
-        }
-    )
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     user_data = {
         "id": user.id,
         "firstName": user.firstName,
@@ -125,7 +164,8 @@ async def get_me(request: Request):
         "role": user.role,
         "willingToTake": user.willingToTake,
         "hasDriversLicense": user.hasDriversLicense,
-        "profilePath": user.profilePath,
+        "profilePath": storage_service.get_file_url(user.profilePath),
+        "profileVariants": storage_service.get_variant_urls(user.profileVariants),
         "companyAddress": None,
         "homeAddress": None
     }
@@ -148,6 +188,17 @@ async def get_me(request: Request):
     return user_data
 
 
+@app.get("/me/geocoding-status")
+async def get_geocoding_status(user_id: int = Depends(get_current_user_id)):
+    """
+    Report whether the user's addresses have been geocoded yet.
+    
+    Spatial search (/search/nearby, PostGIS matching) only works once
+    "spatialSearchReady" is true.
+    """
+    return await geocoding_status(user_id)
+
+
 @app.post("/signup")
 async def signup(
     firstName: str = Form(...),
@@ -175,52 +226,58 @@ async def signup(
     if len(password) < 8:
         raise HTTPException(status_code=400, detail="Password must be at least 8 characters long")
 
+    # Check for existing user with same email and return 409 Conflict
+    # (before any slow work like hashing or uploads)
+    existing = await db.user.find_first(where={"email": email})
+    if existing:
+        raise HTTPException(status_code=409, detail="Account already exists")
+
     # Save profile file if present
     profile_path = None
+    profile_variants = None
     if profile:
+        # Bounded read: never holds more than MAX_IMAGE_UPLOAD_BYTES + 1 in memory
+        data = await profile.read(MAX_IMAGE_UPLOAD_BYTES + 1)
+        if len(data) > MAX_IMAGE_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Profile image must be at most {MAX_IMAGE_UPLOAD_BYTES // (1024 * 1024)} MB"
+            )
+        await profile.seek(0)
         filename = f"{int(__import__('time').time())}_{profile.filename}"
-        content = await profile.read()
-        profile_path = await storage_service.save_file(content, filename)
+        profile_path = await storage_service.save_upload(profile, filename)
+        # Resized, EXIF-stripped WebP avatars for list views
+        profile_variants = await store_variants(data, filename)
 
     # Build nested create dicts only if values provided
-    # Geocode addresses for spatial search (runs in background, non-blocking on failure)
+    # Coordinates start out NULL; a background job geocodes them (see geocode_worker.py)
     company_data = None
     if officeName or companyStreet or companyCity or companyZip:
-        company_coords = await geocode_address(
-            street=companyStreet,
-            city=companyCity,
-            zipcode=companyZip
-        )
         company_data = {
             "create": {
                 "officeName": officeName,
                 "street": companyStreet,
                 "city": companyCity,
                 "zipcode": companyZip,
-                "latitude": company_coords[0] if company_coords else None,
-                "longitude": company_coords[1] if company_coords else None,
             }
         }
 
     home_data = None
     if homeStreet or homeCity or homeZip:
-        home_coords = await geocode_address(
-            street=homeStreet,
-            city=homeCity,
-            zipcode=homeZip
-        )
         home_data = {
             "create": {
                 "street": homeStreet,
                 "city": homeCity,
                 "zipcode": homeZip,
-                "latitude": home_coords[0] if home_coords else None,
-                "longitude": home_coords[1] if home_coords else None,
             }
         }
 
-    # Hash the password
-    hashed_password = pwd_context.hash(password)
+    # Hash the password (runs in the worker pool, off the event loop)
+    try:
+        hashed_password = await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        await _release_profile_images(profile_path, profile_variants)
+        raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
 
     user_payload = {
         "firstName": firstName,
@@ -234,29 +291,38 @@ async def signup(
         "hasDriversLicense": hasDriversLicense,
     }
 
+    if profile_variants:
+        user_payload["profileVariants"] = Json(profile_variants)
     if company_data:
         user_payload["companyAddress"] = company_data
     if home_data:
         user_payload["homeAddress"] = home_data
 
-    # Check for existing user with same email and return 409 Conflict
-    existing = await db.user.find_first(where={"email": email})
-    if existing:
-        raise HTTPException(status_code=409, detail="Account already exists")
-
     try:
-        user = await db.user.create(user_payload)
+        user = await db.user.create(
+            user_payload,
+            include={"companyAddress": True, "homeAddress": True}
+        )
+    except UniqueViolationError:
+        # Another signup with the same email won the race
+        await _release_profile_images(profile_path, profile_variants)
+        raise HTTPException(status_code=409, detail="Account already exists")
     except Exception as e:
+        await _release_profile_images(profile_path, profile_variants)
         # Return a clear JSON error (will still include CORS headers from middleware)
         raise HTTPException(status_code=500, detail=str(e))
 
+    # Queue geocoding of the addresses; spatial search starts working once it finishes
+    queued = await enqueue_geocode_jobs(user)
+
     # Create JWT token
     access_token = create_access_token(data={"sub": user.email, "user_id": user.id})
 
     return {
         "id": user.id,
         "access_token": access_token,
-        "token_type": "bearer"
+        "token_type": "bearer",
+        "geocodingStatus": "pending" if queued else "none"
     }
 
 @app.post("/login")
@@ -272,10 +338,21 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     if not user.passwordHash:
         raise HTTPException(status_code=401, detail="Password not set for this account")
     
-    # Verify password
-    if not pwd_context.verify(form_data.password, user.passwordHash):
+    # Verify password (runs in the worker pool, off the event loop)
+    try:
+        valid, new_hash = await password_hasher.verify_and_update(form_data.password, user.passwordHash)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server is busy, please try again shortly")
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
+    # Opportunistically upgrade hashes made with outdated settings
+    if new_hash:
+        try:
+            await db.user.update(where={"id": user.id}, data={"passwordHash": new_hash})
+        except Exception as e:
+            print(f"[WARNING] Failed to store rehashed password for user {user.id}: {e}")
+    
     # Create JWT token
     access_token = create_access_token(data={"sub": user.email, "user_id": user.id})
     
@@ -286,98 +363,340 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     }
 
 
+# Match-score query behind /search when no spatial search applies.
+# Weights: same office 2000, home city 1000, home zipcode 500, home street 300,
+# work street 150, work city 50. The lower(...) comparisons are served by the
+# functional indexes from the add_address_lower_indexes migration.
+#   $1 current user id, $2 office name, $3 work street, $4 work city,
+#   $5 home city, $6 home zipcode, $7 home street,
+#   $8 whether same office scores, $9 whether same work street scores,
+#   $10/$11 score and id of the previous page's last row (NULL for page one),
+#   $12 rows to fetch
+_SEARCH_MATCH_SQL = '''
+    SELECT
+        u.id,
+        u."firstName",
+        u."lastName",
+        u.email,
+        u.phone,
+        u.role,
+        u."willingToTake",
+        u."hasDriversLicense",
+        u."profilePath",
+        u."profileVariants",
+        ca."officeName" as company_office,
+        ca.street as company_street,
+        ca.city as company_city,
+        ca.zipcode as company_zipcode,
+        ha.id IS NOT NULL as has_home,
+        ha.city as home_city,
+        ha.zipcode as home_zipcode,
+        m.*,
+        s.match_score
+    FROM "User" u
+    JOIN "CompanyAddress" ca ON ca."userId" = u.id
+    LEFT JOIN "HomeAddress" ha ON ha."userId" = u.id
+    CROSS JOIN LATERAL (
+        SELECT
+            COALESCE(lower(ha.city) = lower($5), FALSE) as same_home_city,
+            COALESCE(ha.zipcode = $6, FALSE) as same_home_zipcode,
+            COALESCE(lower(ha.street) = lower($7), FALSE) as same_home_street,
+            COALESCE($8 AND lower(ca."officeName") = lower($2), FALSE) as same_office,
+            COALESCE($9 AND lower(ca.street) = lower($3), FALSE) as same_work_street,
+            COALESCE(lower(ca.city) = lower($4), FALSE) as same_work_city
+    ) m
+    CROSS JOIN LATERAL (
+        SELECT
+            CASE WHEN m.same_office THEN 2000 ELSE 0 END
+            + CASE WHEN m.same_home_city THEN 1000 ELSE 0 END
+            + CASE WHEN m.same_home_zipcode THEN 500 ELSE 0 END
+            + CASE WHEN m.same_home_street THEN 300 ELSE 0 END
+            + CASE WHEN m.same_work_street THEN 150 ELSE 0 END
+            + CASE WHEN m.same_work_city THEN 50 ELSE 0 END as match_score
+    ) s
+    WHERE u.id != $1
+      AND ({where})
+      AND ($10::int IS NULL
+           OR s.match_score < $10::int
+           OR (s.match_score = $10::int AND u.id > $11::int))
+    ORDER BY s.match_score DESC, u.id
+    LIMIT $12
+'''
+
+
+async def _stored_matches(user_id: int, after: Optional[list], size: int):
+    """
+    One page of precomputed matches from "UserMatch" (kept current by
+    match_refresher.py), formatted like the live /search?type=all results.
+    Pages are keyed on (score, candidateId), which the
+    UserMatch_userId_score_candidateId_idx index serves directly.
+    
+    Returns:
+        (results, next_cursor), or None when the user has no stored matches yet
+    """
+    after_score, after_id = after if after else (None, None)
+    try:
+        rows = await db.query_raw(
+            '''
+            SELECT 
+                u.id,
+                u."firstName",
+                u."lastName",
+                u.email,
+                u.phone,
+                u.role,
+                u."willingToTake",
+                u."hasDriversLicense",
+                u."profilePath",
+                u."profileVariants",
+                ca."officeName" as company_office,
+                ca.street as company_street,
+                ca.city as company_city,
+                ca.zipcode as company_zipcode,
+                ha.city as home_city,
+                ha.zipcode as home_zipcode,
+                m."workDistance",
+                m."homeDistance",
+                m."sameOffice",
+                m."sameWorkCity",
+                m."sameHomeCity",
+                m."sameHomeZipcode",
+                m.score
+            FROM "UserMatch" m
+            JOIN "User" u ON u.id = m."candidateId"
+            LEFT JOIN "CompanyAddress" ca ON ca."userId" = u.id
+            LEFT JOIN "HomeAddress" ha ON ha."userId" = u.id
+            WHERE m."userId" = $1
+              AND ($2::float8 IS NULL
+                   OR m.score < $2::float8
+                   OR (m.score = $2::float8 AND m."candidateId" > $3::int))
+            ORDER BY m.score DESC, m."candidateId"
+            LIMIT $4
+            ''',
+            user_id, after_score, after_id, size + 1
+        )
+    except Exception as e:
+        # Table not migrated yet - use the live query
+        if "usermatch" not in str(e).lower():
+            raise
+        return None
+    if not rows and after is None:
+        return None
+    
+    rows, next_cursor = seek_page(rows, size, "stored", lambda r: (r["score"], r["id"]))
+    results = []
+    for user in rows:
+        results.append({
+            "id": user["id"],
+            "firstName": user["firstName"],
+            "lastName": user["lastName"],
+            "email": user["email"],
+            "phone": user["phone"],
+            "role": user["role"],
+            "willingToTake": user["willingToTake"],
+            "hasDriversLicense": user["hasDriversLicense"],
+            "profilePath": storage_service.get_file_url(user["profilePath"]),
+            "profileVariants": storage_service.get_variant_urls(user["profileVariants"]),
+            "companyAddress": {
+                "officeName": user["company_office"],
+                "street": user["company_street"],
+                "city": user["company_city"],
+                "zipcode": user["company_zipcode"]
+            } if user["company_city"] else None,
+            "homeAddress": {
+                "city": user["home_city"],
+                "zipcode": user["home_zipcode"]
+            } if user["home_city"] else None,
+            "matchScore": {
+                "sameHomeCity": user["sameHomeCity"],
+                "sameHomeZipcode": user["sameHomeZipcode"],
+                "sameOffice": user["sameOffice"],
+                "sameWorkCity": user["sameWorkCity"],
+                "workDistanceMiles": round(user["workDistance"] / 1609.34, 1) if user["workDistance"] else None,
+                "homeDistanceMiles": round(user["homeDistance"] / 1609.34, 1) if user["homeDistance"] else None
+            }
+        })
+    return results, next_cursor
+
+
+async def _query_users_near_office(lat: float, lng: float, radius_meters: float):
+    """
+    Users working within radius_meters of an office, nearest first.
+    
+    The result does not depend on who is asking (the caller is filtered out
+    afterwards), so concurrent searches from one office can share it.
+    Up to MATCH_STORE_SIZE candidates are ranked, like the stored matches,
+    plus one extra row to make up for removing the caller.
+    """
+    return await db.query_raw(
+        '''
+        SELECT 
+            u.id,
+            u."firstName",
+            u."lastName",
+            u.email,
+            u.phone,
+            u.role,
+            u."willingToTake",
+            u."hasDriversLicense",
+            u."profilePath",
+            u."profileVariants",
+            ca."officeName" as company_office,
+            ca.street as company_street,
+            ca.city as company_city,
+            ca.zipcode as company_zipcode,
+            ha.city as home_city,
+            ha.zipcode as home_zipcode,
+            ha.latitude as home_lat,
+            ha.longitude as home_lng,
+            ST_Distance(
+                ca.location,
+                ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography
+            ) as work_distance_meters
+        FROM "User" u
+        JOIN "CompanyAddress" ca ON ca."userId" = u.id
+        LEFT JOIN "HomeAddress" ha ON ha."userId" = u.id
+        WHERE ca.location IS NOT NULL
+          AND ST_DWithin(
+              ca.location,
+              ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography,
+              $3
+          )
+        ORDER BY work_distance_meters ASC, u.id
+        LIMIT $4
+        ''',
+        lng, lat, radius_meters, MATCH_STORE_SIZE + 1
+    )
+
+
+async def _index_users_near_office(lat: float, lng: float, radius_meters: float):
+    """
+    Same rows as _query_users_near_office, answered from the in-memory
+    spatial index instead of PostGIS. Empty if the index is not loaded.
+    """
+    if not spatial_indexes.work.loaded:
+        return []
+    hits = spatial_indexes.work.within(lat, lng, radius_meters, limit=MATCH_STORE_SIZE + 1)
+    users = await db.user.find_many(
+        where={"id": {"in": [user_id for user_id, _ in hits]}},
+        include={"companyAddress": True, "homeAddress": True}
+    )
+    users_by_id = {u.id: u for u in users}
+    rows = []
+    for user_id, distance in hits:
+        user = users_by_id.get(user_id)
+        if not user or not user.companyAddress:
+            continue
+        home = user.homeAddress
+        rows.append({
+            "id": user.id,
+            "firstName": user.firstName,
+            "lastName": user.lastName,
+            "email": user.email,
+            "phone": user.phone,
+            "role": user.role,
+            "willingToTake": user.willingToTake,
+            "hasDriversLicense": user.hasDriversLicense,
+            "profilePath": user.profilePath,
+            "profileVariants": user.profileVariants,
+            "company_office": user.companyAddress.officeName,
+            "company_street": user.companyAddress.street,
+            "company_city": user.companyAddress.city,
+            "company_zipcode": user.companyAddress.zipcode,
+            "home_city": home.city if home else None,
+            "home_zipcode": home.zipcode if home else None,
+            "home_lat": home.latitude if home else None,
+            "home_lng": home.longitude if home else None,
+            "work_distance_meters": distance
+        })
+    return rows
+
+
+def _with_next_cursor(response: Response, results: list, next_cursor: Optional[str]) -> list:
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return results
+
+
 @app.get("/search")
 async def search_carpools(
-    request: Request,
-    type: str
+    type: str,
+    response: Response,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user_id: int = Depends(get_current_user_id),
+    current_user = Depends(get_current_user)
 ):
-    """Search for carpool matches based on current user's office location"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    current_user_id = payload.get("user_id")
-    if not current_user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
-    # Get current user's addresses for matching
-    current_user = await db.user.find_unique(
-        where={"id": current_user_id},
-        include={
-            "companyAddress": True,
-            "homeAddress": True
-        }
-    )
-    if not current_user:
-        raise HTTPException(status_code=404, detail="User not found")
+    """
+    Search for carpool matches based on current user's office location.
     
+    Returns one page of matches, best first (SEARCH_PAGE_SIZE by default,
+    at most SEARCH_MAX_PAGE_SIZE). When more remain, the X-Next-Cursor
+    response header holds the cursor for the next page.
+    """
     if not current_user.companyAddress:
         raise HTTPException(status_code=400, detail="Please complete your company address in your profile first")
     
-    # Build search query based on type using current user's company address
-    where_clause = {}
+    size = page_size(limit, SEARCH_PAGE_SIZE)
+    # A cursor pins the ranking it came from, so a later page never switches
+    # between stored, live and string-matched results
+    source, after = None, None
+    if cursor:
+        kinds = [f"match-{type}"] + (["stored", "live"] if type == "all" else [])
+        try:
+            source, after = decode_cursor(cursor, kinds)
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
     
+    # Build search query based on type using current user's company address
+    # (parameters are numbered as in _SEARCH_MATCH_SQL)
     if type == "all":
         # Use PostGIS geospatial search for "top matches" when coordinates available
         # This finds users within ~10 miles of your work location, ranked by distance + match criteria
         if current_user.companyAddress.latitude and current_user.companyAddress.longitude:
             lat = current_user.companyAddress.latitude
             lng = current_user.companyAddress.longitude
-            radius_meters = 16093.4  # ~10 miles
+            radius_meters = MATCH_RADIUS_METERS  # ~10 miles
             
-            try:
-                # PostGIS spatial query - find nearby users at work
-                nearby_users = await db.query_raw(
-                    '''
-                    SELECT 
-                        u.id,
-                        u."firstName",
-                        u."lastName",
-                        u.email,
-                        u.phone,
-                        u.role,
-                        u."willingToTake",
-                        u."hasDriversLicense",
-                        u."profilePath",
-                        ca."officeName" as company_office,
-                        ca.street as company_street,
-                        ca.city as company_city,
-                        ca.zipcode as company_zipcode,
-                        ha.city as home_city,
-                        ha.zipcode as home_zipcode,
-                        ST_Distance(
-                            ca.location,
-                            ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography
-                        ) as work_distance_meters,
-                        CASE WHEN ha.location IS NOT NULL THEN
-                            ST_Distance(
-                                ha.location,
-                                (SELECT location FROM "HomeAddress" WHERE "userId" = $3)
-                            )
-                        ELSE NULL END as home_distance_meters
-                    FROM "User" u
-                    JOIN "CompanyAddress" ca ON ca."userId" = u.id
-                    LEFT JOIN "HomeAddress" ha ON ha."userId" = u.id
-                    WHERE u.id != $3
-                      AND ca.location IS NOT NULL
-                      AND ST_DWithin(
-                          ca.location,
-                          ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography,
-                          $4
-                      )
-                    ORDER BY work_distance_meters ASC
-                    LIMIT 20
-                    ''',
-                    lng, lat, current_user_id, radius_meters
-                )
+            # Precomputed matches turn this into a single indexed read
+            if source in (None, "stored"):
+                stored = await _stored_matches(current_user_id, after, size)
+                if stored is not None:
+                    return _with_next_cursor(response, *stored)
+                if source == "stored":
+                    return []
+            
+            nearby_users = []
+            if source in (None, "live"):
+                try:
+                    # PostGIS spatial query - find nearby users at work.
+                    # Colleagues at the same office share one in-flight query.
+                    nearby_users = await search_flight.do(
+                        ("office", lat, lng, radius_meters),
+                        lambda: _query_users_near_office(lat, lng, radius_meters)
+                    )
+                except Exception as e:
+                    error_str = str(e).lower()
+                    if "st_dwithin" not in error_str and "postgis" not in error_str and "location" not in error_str:
+                        raise  # Re-raise if it's not a PostGIS error
+                    # PostGIS not available - answer from the in-memory spatial index
+                    nearby_users = await _index_users_near_office(lat, lng, radius_meters)
+            
+            if nearby_users:
+                nearby_users = [u for u in nearby_users if u["id"] != current_user_id][:MATCH_STORE_SIZE]
+                my_home = current_user.homeAddress
                 
                 # Format and score the PostGIS results
                 results = []
                 for user in nearby_users:
                     work_dist_miles = round(user["work_distance_meters"] / 1609.34, 1) if user["work_distance_meters"] else None
-                    home_dist_miles = round(user["home_distance_meters"] / 1609.34, 1) if user.get("home_distance_meters") else None
+                    home_dist_miles = None
+                    if (my_home and my_home.latitude is not None and my_home.longitude is not None
+                            and user["home_lat"] is not None and user["home_lng"] is not None):
+                        home_dist_meters = haversine_meters(
+                            my_home.latitude, my_home.longitude, user["home_lat"], user["home_lng"]
+                        )
+                        home_dist_miles = round(home_dist_meters / 1609.34, 1) if home_dist_meters else None
                     
                     # Calculate match score for sorting
                     score = 0
@@ -427,7 +746,8 @@ async def search_carpools(
                         "role": user["role"],
                         "willingToTake": user["willingToTake"],
                         "hasDriversLicense": user["hasDriversLicense"],
-                        "profilePath": user["profilePath"],
+                        "profilePath": storage_service.get_file_url(user["profilePath"]),
+                        "profileVariants": storage_service.get_variant_urls(user["profileVariants"]),
                         "companyAddress": {
                             "officeName": user["company_office"],
                             "street": user["company_street"],
@@ -442,228 +762,164 @@ async def search_carpools(
                         "_score": score
                     })
                 
-                # Sort by score and return top 6
-                results.sort(key=lambda x: x["_score"], reverse=True)
-                top_results = results[:6]
+                # Sort by score (ties by id) and return the requested page
+                top_results, next_cursor = paginate(
+                    results, lambda r: (-r["_score"], r["id"]), after, size, "live"
+                )
                 for r in top_results:
                     del r["_score"]
                 
-                # If PostGIS returned results, use them; otherwise fall through to string matching
-                if top_results:
-                    return top_results
-                # Fall through - PostGIS worked but no geocoded users found
-                
-            except Exception as e:
-                # PostGIS not available - fall back to string matching
-                error_str = str(e).lower()
-                if "st_dwithin" not in error_str and "postgis" not in error_str and "location" not in error_str:
-                    raise  # Re-raise if it's not a PostGIS error
-                # Fall through to string matching below
+                # If the spatial search found matches, use them; otherwise fall through to string matching
+                if top_results or source == "live":
+                    return _with_next_cursor(response, top_results, next_cursor)
+            if source == "live":
+                return []
+            # Fall through - no geocoded users nearby (or no spatial search available)
         
         # Fallback: string matching on city (when no coordinates or PostGIS unavailable)
         if current_user.companyAddress.city:
-            where_clause = {
-                "companyAddress": {
-                    "is": {
-                        "city": {"equals": current_user.companyAddress.city, "mode": "insensitive"}
-                    }
-                }
-            }
+            where_sql = 'lower(ca.city) = lower($4)'
         else:
-            where_clause = {
-                "companyAddress": {
-                    "isNot": None
-                }
-            }
+            where_sql = 'TRUE'  # anyone with a company address
     elif type == "office":
         # Match same office name (exact match)
         if not current_user.companyAddress.officeName:
             raise HTTPException(status_code=400, detail="Office name not set in your profile")
-        where_clause = {
-            "companyAddress": {
-                "is": {
-                    "officeName": {"equals": current_user.companyAddress.officeName, "mode": "insensitive"}
-                }
-            }
-        }
+        where_sql = 'lower(ca."officeName") = lower($2)'
     elif type == "street":
         # Match same street and city
         if not current_user.companyAddress.street:
             raise HTTPException(status_code=400, detail="Street address not set in your profile")
-        where_clause = {
-            "companyAddress": {
-                "is": {
-                    "AND": [
-                        {"street": {"equals": current_user.companyAddress.street, "mode": "insensitive"}},
-                        {"city": {"equals": current_user.companyAddress.city, "mode": "insensitive"}}
-                    ]
-                }
-            }
-        }
+        where_sql = 'lower(ca.street) = lower($3) AND lower(ca.city) = lower($4)'
     elif type == "city":
         # Match same city
         if not current_user.companyAddress.city:
             raise HTTPException(status_code=400, detail="City not set in your profile")
-        where_clause = {
-            "companyAddress": {
-                "is": {
-                    "city": {"equals": current_user.companyAddress.city, "mode": "insensitive"}
-                }
-            }
-        }
+        where_sql = 'lower(ca.city) = lower($4)'
     else:
         raise HTTPException(status_code=400, detail="Invalid search type. Must be 'all', 'office', 'street', or 'city'")
     
-    # Exclude current user from results
-    where_clause["id"] = {"not": current_user_id}
-    
-    # Find matching users
-    users = await db.user.find_many(
-        where=where_clause,
-        include={
-            "companyAddress": True,
-            "homeAddress": True
-        }
+    # Filter, score, sort and cut one page in one query, so memory and
+    # latency don't grow with the number of users in the city. Pages are
+    # keyed on (score, id) instead of an OFFSET.
+    company = current_user.companyAddress
+    home = current_user.homeAddress
+    after_score, after_id = after if source == f"match-{type}" else (None, None)
+    rows = await db.query_raw(
+        _SEARCH_MATCH_SQL.format(where=where_sql),
+        current_user_id,                                # $1
+        company.officeName or None,                     # $2
+        company.street or None,                         # $3
+        company.city or None,                           # $4
+        (home.city or None) if home else None,          # $5
+        (home.zipcode or None) if home else None,       # $6
+        (home.street or None) if home else None,        # $7
+        type in ["all", "office"],                      # $8 same office counts
+        type in ["all", "office", "street"],            # $9 same work street counts
+        after_score,                                    # $10
+        after_id,                                       # $11
+        size + 1                                        # $12
     )
+    rows, next_cursor = seek_page(rows, size, f"match-{type}", lambda r: (r["match_score"], r["id"]))
     
-    # Sort users by home location match priority
-    def calculate_match_score(user):
-        score = 0
-        match_info = {
-            "sameHomeCity": False,
-            "sameHomeStreet": False,
-            "sameHomeZipcode": False,
-            "sameOffice": False,
-            "sameWorkStreet": False,
-            "sameWorkCity": False
-        }
-        
-        if current_user.homeAddress and user.homeAddress:
-            # Check home city match
-            if current_user.homeAddress.city and user.homeAddress.city:
-                if current_user.homeAddress.city.lower() == user.homeAddress.city.lower():
-                    score += 1000  # Highest priority
-                    match_info["sameHomeCity"] = True
-            
-            # Check home zipcode match
-            if current_user.homeAddress.zipcode and user.homeAddress.zipcode:
-                if current_user.homeAddress.zipcode == user.homeAddress.zipcode:
-                    score += 500
-                    match_info["sameHomeZipcode"] = True
-            
-            # Check home street match
-            if current_user.homeAddress.street and user.homeAddress.street:
-                if current_user.homeAddress.street.lower() == user.homeAddress.street.lower():
-                    score += 300
-                    match_info["sameHomeStreet"] = True
-        
-        # Add office match bonus
-        if user.companyAddress and current_user.companyAddress:
-            # Same office name (for "all" or "office" types)
-            if type in ["all", "office"] and user.companyAddress.officeName and current_user.companyAddress.officeName:
-                if user.companyAddress.officeName.lower() == current_user.companyAddress.officeName.lower():
-                    score += 2000  # Highest priority - same office
-                    match_info["sameOffice"] = True
-            
-            # Same work street (for "all", "office", or "street" types)
-            if type in ["all", "office", "street"] and user.companyAddress.street and current_user.companyAddress.street:
-                if user.companyAddress.street.lower() == current_user.companyAddress.street.lower():
-                    score += 150
-                    match_info["sameWorkStreet"] = True
-            
-            # Same work city (always applicable)
-            if user.companyAddress.city and current_user.companyAddress.city:
-                if user.companyAddress.city.lower() == current_user.companyAddress.city.lower():
-                    score += 50
-                    match_info["sameWorkCity"] = True
-        
-        return score, match_info
-    
-    # Add match scores and sort
     results = []
-    for user in users:
-        score, match_info = calculate_match_score(user)
-        user_data = {
-            "id": user.id,
-            "firstName": user.firstName,
-            "lastName": user.lastName,
-            "email": user.email,
-            "phone": user.phone,
-            "role": user.role,
-            "willingToTake": user.willingToTake,
-            "hasDriversLicense": user.hasDriversLicense,
-            "profilePath": user.profilePath,
-            "companyAddress": None,
-            "homeAddress": None,
-            "matchScore": match_info,
-            "_score": score
-        }
-        
-        if user.companyAddress:
-            user_data["companyAddress"] = {
-                "officeName": user.companyAddress.officeName,
-                "street": user.companyAddress.street,
-                "city": user.companyAddress.city,
-                "zipcode": user.companyAddress.zipcode
-            }
-        
-        if user.homeAddress:
+    for user in rows:
+        results.append({
+            "id": user["id"],
+            "firstName": user["firstName"],
+            "lastName": user["lastName"],
+            "email": user["email"],
+            "phone": user["phone"],
+            "role": user["role"],
+            "willingToTake": user["willingToTake"],
+            "hasDriversLicense": user["hasDriversLicense"],
+            "profilePath": storage_service.get_file_url(user["profilePath"]),
+            "profileVariants": storage_service.get_variant_urls(user["profileVariants"]),
+            "companyAddress": {
+                "officeName": user["company_office"],
+                "street": user["company_street"],
+                "city": user["company_city"],
+                "zipcode": user["company_zipcode"]
+            },
             # Don't reveal home street for privacy
-            user_data["homeAddress"] = {
-                "city": user.homeAddress.city,
-                "zipcode": user.homeAddress.zipcode
+            "homeAddress": {
+                "city": user["home_city"],
+                "zipcode": user["home_zipcode"]
+            } if user["has_home"] else None,
+            "matchScore": {
+                "sameHomeCity": user["same_home_city"],
+                "sameHomeStreet": user["same_home_street"],
+                "sameHomeZipcode": user["same_home_zipcode"],
+                "sameOffice": user["same_office"],
+                "sameWorkStreet": user["same_work_street"],
+                "sameWorkCity": user["same_work_city"]
             }
-        
-        results.append(user_data)
-    
-    # Sort by match score (highest first)
-    results.sort(key=lambda x: x["_score"], reverse=True)
-    
-    # Return top 6 best matches
-    top_results = results[:6]
-    
-    # Remove internal score field
-    for r in top_results:
-        del r["_score"]
+        })
     
-    return top_results
+    return _with_next_cursor(response, results, next_cursor)
 
 
 @app.get("/search/nearby")
 async def search_nearby_carpools(
-    request: Request,
     radius_miles: float = 5.0,
-    search_type: str = "home"  # "home" or "work"
+    search_type: str = "home",  # "home" or "work"
+    mode: str = "radius",  # "radius" or "nearest"
+    max_miles: Optional[float] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user_id: int = Depends(get_current_user_id),
+    current_user = Depends(get_current_user)
 ):
     """
     High-performance geospatial search using PostGIS.
     
     Finds users within a specified radius using spatial indexing (GiST).
     This is much faster and more accurate than string matching.
+    Falls back to the in-memory spatial index (spatial_index.py) when
+    PostGIS is unavailable.
+    
+    mode="nearest" returns the nearest users instead, up to max_miles away
+    (NEAREST_MAX_RADIUS_METERS, 200 km, when not given): the GiST index hands rows over in distance order (KNN, the <->
+    operator), so the query stops after one page in sparse suburbs and
+    dense downtowns alike.
     
     Args:
-        radius_miles: Search radius in miles (default: 5.0)
+        radius_miles: Search radius in miles (default: 5.0), radius mode only
         search_type: "home" to search near your home, "work" to search near your workplace
+        mode: "radius" (everyone within radius_miles) or "nearest" (the nearest users)
+        max_miles: Distance cap for nearest mode (default: NEAREST_MAX_RADIUS_METERS)
+        limit: Page size (default: NEARBY_PAGE_SIZE, at most SEARCH_MAX_PAGE_SIZE)
+        cursor: nextCursor from the previous page
     
     Returns:
-        List of nearby users with distance in miles, sorted by proximity
+        One page of nearby users with distance in miles, sorted by proximity,
+        and nextCursor (None on the last page)
     """
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    current_user_id = payload.get("user_id")
-    if not current_user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Validate search type
     if search_type not in ["home", "work"]:
         raise HTTPException(status_code=400, detail="search_type must be 'home' or 'work'")
-    
-    # Convert miles to meters for PostGIS
-    radius_meters = radius_miles * 1609.34
+    if mode not in ["radius", "nearest"]:
+        raise HTTPException(status_code=400, detail="mode must be 'radius' or 'nearest'")
+    if max_miles is not None and max_miles <= 0:
+        raise HTTPException(status_code=400, detail="max_miles must be positive")
+    
+    # Pages are keyed on (distance, id) of the previous page's last user
+    size = page_size(limit, NEARBY_PAGE_SIZE)
+    cursor_kind = f"{'nearby' if mode == 'radius' else 'nearest'}-{search_type}"
+    after_distance, after_id = None, None
+    if cursor:
+        try:
+            _, (after_distance, after_id) = decode_cursor(cursor, [cursor_kind])
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # Convert miles to meters for PostGIS. Nearest mode without max_miles is
+    # capped at NEAREST_MAX_RADIUS_METERS, the same as the spatial index, so
+    # both backends return the same users
+    if mode == "radius":
+        radius_meters = radius_miles * 1609.34
+    else:
+        radius_meters = max_miles * 1609.34 if max_miles else NEAREST_MAX_RADIUS_METERS
     
     # Determine which table to search
     if search_type == "home":
@@ -673,18 +929,6 @@ async def search_nearby_carpools(
         table = "CompanyAddress"
         relation = "companyAddress"
     
-    # Get current user's coordinates
-    current_user = await db.user.find_unique(
-        where={"id": current_user_id},
-        include={
-            "companyAddress": True,
-            "homeAddress": True
-        }
-    )
-    
-    if not current_user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     # Get the relevant address
     user_address = current_user.homeAddress if search_type == "home" else current_user.companyAddress
     
@@ -704,7 +948,30 @@ async def search_nearby_carpools(
     lng = user_address.longitude
     
     # PostGIS spatial query using ST_DWithin for efficient radius search
-    # ST_DWithin uses the GiST index for sub-100ms performance
+    # ST_DWithin uses the GiST index for sub-100ms performance.
+    # Nearest mode orders by the <-> operator instead, which the GiST index
+    # (idx_home_address_location / idx_company_address_location) serves as
+    # an index-ordered KNN scan, so only the rows of one page are visited.
+    point_sql = 'ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography'
+    if mode == "radius":
+        distance_sql = f'ST_Distance(a.location, {point_sql})'
+    else:
+        distance_sql = f'a.location <-> {point_sql}'
+    params = [
+        lng,  # $1 - longitude comes first in ST_MakePoint
+        lat,  # $2 - latitude
+        current_user_id,  # $3 - exclude current user
+        after_distance,  # $4/$5 - last row of the previous page
+        after_id,
+        size + 1  # $6 - one extra row tells whether another page exists
+    ]
+    # The keyset filter is on a computed distance, which no index can seek
+    # to: later pages re-scan and re-sort every row before the cursor (see
+    # pagination.py). ST_DWithin or the KNN scan keeps that bounded.
+    within_sql = ''
+    if radius_meters is not None:
+        params.append(radius_meters)  # $7 - search radius in meters
+        within_sql = f'AND ST_DWithin(a.location, {point_sql}, $7)'
     try:
         nearby_users = await db.query_raw(
             f'''
@@ -718,38 +985,69 @@ async def search_nearby_carpools(
                 u."willingToTake",
                 u."hasDriversLicense",
                 u."profilePath",
+                u."profileVariants",
                 a.city,
                 a.zipcode,
-                ST_Distance(
-                    a.location,
-                    ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography
-                ) as distance_meters
+                {distance_sql} as distance_meters
             FROM "User" u
             JOIN "{table}" a ON a."userId" = u.id
             WHERE u.id != $3
               AND a.location IS NOT NULL
-              AND ST_DWithin(
-                  a.location,
-                  ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography,
-                  $4
-              )
-            ORDER BY distance_meters ASC
-            LIMIT 20
+              {within_sql}
+              AND ($4::float8 IS NULL OR ({distance_sql}, u.id) > ($4::float8, $5::int))
+            ORDER BY {distance_sql}, u.id
+            LIMIT $6
             ''',
-            lng,  # $1 - longitude comes first in ST_MakePoint
-            lat,  # $2 - latitude
-            current_user_id,  # $3 - exclude current user
-            radius_meters  # $4 - search radius in meters
+            *params
         )
     except Exception as e:
-        # If PostGIS isn't available, fall back to a helpful error
         error_str = str(e).lower()
-        if "st_dwithin" in error_str or "postgis" in error_str or "geography" in error_str:
+        if "st_dwithin" not in error_str and "postgis" not in error_str and "geography" not in error_str:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        # PostGIS isn't available - answer from the in-memory spatial index
+        index = spatial_indexes.get(search_type)
+        if not index.loaded:
             raise HTTPException(
                 status_code=503,
                 detail="Geospatial search is not available. PostGIS extension may not be enabled on the database."
             )
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        after = (after_distance, after_id) if cursor else None
+        if mode == "radius":
+            hits = index.within(lat, lng, radius_meters, exclude=current_user_id, limit=size + 1, after=after)
+        else:
+            hits = index.nearest(
+                lat, lng, size + 1, exclude=current_user_id, max_radius_meters=radius_meters, after=after
+            )
+        users = await db.user.find_many(
+            where={"id": {"in": [user_id for user_id, _ in hits]}},
+            include={relation: True}
+        )
+        users_by_id = {u.id: u for u in users}
+        nearby_users = []
+        for user_id, distance in hits:
+            user = users_by_id.get(user_id)
+            address = getattr(user, relation) if user else None
+            if not address:
+                continue
+            nearby_users.append({
+                "id": user.id,
+                "firstName": user.firstName,
+                "lastName": user.lastName,
+                "email": user.email,
+                "phone": user.phone,
+                "role": user.role,
+                "willingToTake": user.willingToTake,
+                "hasDriversLicense": user.hasDriversLicense,
+                "profilePath": user.profilePath,
+                "profileVariants": user.profileVariants,
+                "city": address.city,
+                "zipcode": address.zipcode,
+                "distance_meters": distance
+            })
+    
+    nearby_users, next_cursor = seek_page(
+        nearby_users, size, cursor_kind, lambda u: (u["distance_meters"], u["id"])
+    )
     
     # Format results with distance in miles
     results = []
@@ -764,7 +1062,8 @@ async def search_nearby_carpools(
             "role": user["role"],
             "willingToTake": user["willingToTake"],
             "hasDriversLicense": user["hasDriversLicense"],
-            "profilePath": user["profilePath"],
+            "profilePath": storage_service.get_file_url(user["profilePath"]),
+            "profileVariants": storage_service.get_variant_urls(user["profileVariants"]),
             f"{search_type}Address": {
                 "city": user["city"],
                 "zipcode": user["zipcode"]
@@ -775,28 +1074,125 @@ async def search_nearby_carpools(
     
     return {
         "searchType": search_type,
-        "radiusMiles": radius_miles,
+        "mode": mode,
+        "radiusMiles": radius_miles if mode == "radius" else max_miles,
         "resultsCount": len(results),
-        "users": results
+        "users": results,
+        "nextCursor": next_cursor
+    }
+
+
+@app.get("/search/commute")
+async def search_commute_partners(
+    home_miles: float = 5.0,
+    work_miles: float = 5.0,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    current_user_id: int = Depends(get_current_user_id),
+    current_user = Depends(get_current_user)
+):
+    """
+    Find people who live near you AND work near you (commute.py).
+    
+    Both ends are GiST-indexed radius scans intersected in one query, ranked
+    by combined detour (home-to-home plus office-to-office distance).
+    
+    Args:
+        home_miles: Maximum distance between the two homes (default: 5.0)
+        work_miles: Maximum distance between the two offices (default: 5.0)
+        limit: Page size (default: NEARBY_PAGE_SIZE, at most SEARCH_MAX_PAGE_SIZE)
+        cursor: nextCursor from the previous page
+    """
+    if home_miles <= 0 or work_miles <= 0:
+        raise HTTPException(status_code=400, detail="home_miles and work_miles must be positive")
+    
+    home = current_user.homeAddress
+    company = current_user.companyAddress
+    if not home or not company:
+        raise HTTPException(status_code=400, detail="Please set your home and company addresses in your profile first")
+    if (home.latitude is None or home.longitude is None
+            or company.latitude is None or company.longitude is None):
+        raise HTTPException(
+            status_code=400,
+            detail="Your addresses could not be geocoded yet. Please update them with a valid location."
+        )
+    
+    size = page_size(limit, NEARBY_PAGE_SIZE)
+    after = None
+    if cursor:
+        try:
+            _, after = decode_cursor(cursor, ["commute"])
+        except InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    home_radius_meters = home_miles * 1609.34
+    work_radius_meters = work_miles * 1609.34
+    try:
+        rows = await query_commute_matches(
+            current_user_id, home_radius_meters, work_radius_meters, after, size + 1
+        )
+    except Exception as e:
+        error_str = str(e).lower()
+        if "st_dwithin" not in error_str and "postgis" not in error_str and "geography" not in error_str:
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+        if not (spatial_indexes.home.loaded and spatial_indexes.work.loaded):
+            raise HTTPException(
+                status_code=503,
+                detail="Geospatial search is not available. PostGIS extension may not be enabled on the database."
+            )
+        rows = await index_commute_matches(
+            current_user_id,
+            (home.latitude, home.longitude),
+            (company.latitude, company.longitude),
+            home_radius_meters,
+            work_radius_meters,
+            after,
+            size + 1
+        )
+    rows, next_cursor = seek_page(rows, size, "commute", lambda r: (r["detour"], r["id"]))
+    
+    results = []
+    for user in rows:
+        results.append({
+            "id": user["id"],
+            "firstName": user["firstName"],
+            "lastName": user["lastName"],
+            "email": user["email"],
+            "phone": user["phone"],
+            "role": user["role"],
+            "willingToTake": user["willingToTake"],
+            "hasDriversLicense": user["hasDriversLicense"],
+            "profilePath": storage_service.get_file_url(user["profilePath"]),
+            "profileVariants": storage_service.get_variant_urls(user["profileVariants"]),
+            # Don't reveal home street for privacy
+            "homeAddress": {
+                "city": user["home_city"],
+                "zipcode": user["home_zipcode"]
+            },
+            "companyAddress": {
+                "officeName": user["company_office"],
+                "city": user["company_city"]
+            },
+            "homeDistanceMiles": round(user["home_distance"] / 1609.34, 1),
+            "workDistanceMiles": round(user["work_distance"] / 1609.34, 1),
+            "detourMiles": round(user["detour"] / 1609.34, 1)
+        })
+    
+    return {
+        "homeMiles": home_miles,
+        "workMiles": work_miles,
+        "resultsCount": len(results),
+        "users": results,
+        "nextCursor": next_cursor
     }
 
 
 @app.post("/connection-requests")
 async def send_connection_request(
-    request: Request,
-    receiverId: int = Form(...)
+    receiverId: int = Form(...),
+    sender_id: int = Depends(get_current_user_id)
 ):
     """Send a connection request to another user"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    sender_id = payload.get("user_id")
-    if not sender_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Validate: can't send request to yourself
     if sender_id == receiverId:
         raise HTTPException(status_code=400, detail="Cannot send connection request to yourself")
@@ -833,18 +1229,8 @@ async def send_connection_request(
 
 
 @app.get("/connection-requests")
-async def get_connection_requests(request: Request):
+async def get_connection_requests(user_id: int = Depends(get_current_user_id)):
     """Get all connection requests for the current user (sent and received)"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get received requests (pending)
     received_requests = await db.connectionrequest.find_many(
         where={
@@ -892,7 +1278,8 @@ async def get_connection_requests(request: Request):
                 "email": req.sender.email,
                 "phone": req.sender.phone,
                 "role": req.sender.role,
-                "profilePath": req.sender.profilePath,
+                "profilePath": storage_service.get_file_url(req.sender.profilePath),
+                "profileVariants": storage_service.get_variant_urls(req.sender.profileVariants),
                 "companyAddress": {
                     "officeName": req.sender.companyAddress.officeName if req.sender.companyAddress else None,
                     "city": req.sender.companyAddress.city if req.sender.companyAddress else None
@@ -917,7 +1304,8 @@ async def get_connection_requests(request: Request):
                 "email": req.receiver.email,
                 "phone": req.receiver.phone,
                 "role": req.receiver.role,
-                "profilePath": req.receiver.profilePath,
+                "profilePath": storage_service.get_file_url(req.receiver.profilePath),
+                "profileVariants": storage_service.get_variant_urls(req.receiver.profileVariants),
                 "companyAddress": {
                     "officeName": req.receiver.companyAddress.officeName if req.receiver.companyAddress else None,
                     "city": req.receiver.companyAddress.city if req.receiver.companyAddress else None
@@ -936,20 +1324,10 @@ async def get_connection_requests(request: Request):
 
 @app.patch("/connection-requests/{request_id}/accept")
 async def accept_connection_request(
-    request: Request,
-    request_id: int
+    request_id: int,
+    user_id: int = Depends(get_current_user_id)
 ):
     """Accept a connection request"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Find the connection request
     conn_request = await db.connectionrequest.find_unique(where={"id": request_id})
     if not conn_request:
@@ -978,20 +1356,10 @@ async def accept_connection_request(
 
 @app.patch("/connection-requests/{request_id}/reject")
 async def reject_connection_request(
-    request: Request,
-    request_id: int
+    request_id: int,
+    user_id: int = Depends(get_current_user_id)
 ):
     """Reject a connection request"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Find the connection request
     conn_request = await db.connectionrequest.find_unique(where={"id": request_id})
     if not conn_request:
@@ -1014,18 +1382,8 @@ async def reject_connection_request(
 
 
 @app.get("/connected-users")
-async def get_connected_users(request: Request):
+async def get_connected_users(user_id: int = Depends(get_current_user_id)):
     """Get all users connected to the current user (accepted connections)"""
-    # Verify authentication
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get all accepted connections where user is sender or receiver
     connections = await db.connectionrequest.find_many(
         where={
@@ -1067,7 +1425,8 @@ async def get_connected_users(request: Request):
             "role": other_user.role,
             "willingToTake": other_user.willingToTake,
             "hasDriversLicense": other_user.hasDriversLicense,
-            "profilePath": other_user.profilePath,
+            "profilePath": storage_service.get_file_url(other_user.profilePath),
+            "profileVariants": storage_service.get_variant_urls(other_user.profileVariants),
             "companyAddress": {
                 "officeName": other_user.companyAddress.officeName if other_user.companyAddress else None,
                 "street": other_user.companyAddress.street if other_user.companyAddress else None,
@@ -1085,17 +1444,8 @@ async def get_connected_users(request: Request):
 
 
 @app.get("/conversations")
-async def get_conversations(request: Request):
+async def get_conversations(user_id: int = Depends(get_current_user_id)):
     """Get all conversations for the current user with last message"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get all conversations where user is participant
     conversations = await db.conversation.find_many(
         where={
@@ -1145,7 +1495,8 @@ async def get_conversations(request: Request):
                 "id": other_user.id,
                 "firstName": other_user.firstName,
                 "lastName": other_user.lastName,
-                "profilePath": other_user.profilePath,
+                "profilePath": storage_service.get_file_url(other_user.profilePath),
+                "profileVariants": storage_service.get_variant_urls(other_user.profileVariants),
                 "role": other_user.role,
                 "companyAddress": {
                     "city": other_user.companyAddress.city if other_user.companyAddress else None
@@ -1165,19 +1516,10 @@ async def get_conversations(request: Request):
 
 @app.get("/conversations/{other_user_id}/messages")
 async def get_messages(
-    request: Request,
-    other_user_id: int
+    other_user_id: int,
+    user_id: int = Depends(get_current_user_id)
 ):
     """Get all messages in a conversation with another user"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Find or create conversation
     conversation = await db.conversation.find_first(
         where={
@@ -1228,20 +1570,11 @@ async def get_messages(
 
 @app.post("/conversations/{other_user_id}/messages")
 async def send_message(
-    request: Request,
     other_user_id: int,
-    content: str = Form(...)
+    content: str = Form(...),
+    user_id: int = Depends(get_current_user_id)
 ):
     """Send a message to another user"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Validate content
     if not content or not content.strip():
         raise HTTPException(status_code=400, detail="Message content cannot be empty")
@@ -1304,37 +1637,112 @@ async def send_message(
 # Multi-passenger groups with atomic consensus
 # ============================================
 
+def _group_route(origin, destination, members) -> list:
+    """
+    [origin, *pickups, destination] in the group's current pickup order, as
+    (lat, lng) for routing.py. Passengers without coordinates are left out.
+    """
+    passengers = sorted(
+        (m for m in members if m.role != "driver" and m.pickupLat is not None and m.pickupLng is not None),
+        key=lambda m: (m.pickupOrder or 0, m.id)
+    )
+    return [origin] + [(m.pickupLat, m.pickupLng) for m in passengers] + [destination]
+
+
+async def _index_open_groups(lat: float, lng: float, max_meters: float, user_id: int) -> list:
+    """
+    Same rows as the PostGIS /groups/open query, with the route filter
+    answered by the in-process open group index.
+    """
+    hits = await open_group_index.near_route(
+        lat, lng, max_meters, exclude_driver=user_id, limit=OPEN_GROUP_CANDIDATES
+    )
+    groups = await db.carpoolgroup.find_many(
+        where={"id": {"in": [group_id for group_id, _ in hits]}},
+        include={"driver": {"include": {"companyAddress": True}}}
+    )
+    groups_by_id = {g.id: g for g in groups}
+    rows = []
+    for group_id, off_route_meters in hits:
+        g = groups_by_id.get(group_id)
+        # The index may be a little stale; re-check against the live row
+        if not g or g.status != "OPEN" or g.currentOccupancy >= g.maxSeats or g.driverId == user_id:
+            continue
+        office = g.driver.companyAddress
+        rows.append({
+            "id": g.id,
+            "name": g.name,
+            "maxSeats": g.maxSeats,
+            "currentOccupancy": g.currentOccupancy,
+            "baseDistanceMiles": g.baseDistanceMiles,
+            "driver_id": g.driver.id,
+            "driver_first_name": g.driver.firstName,
+            "driver_last_name": g.driver.lastName,
+            "driver_profile": g.driver.profilePath,
+            "driver_profile_variants": g.driver.profileVariants,
+            "dest_city": office.city if office else None,
+            "dest_office": office.officeName if office else None,
+            "originLat": g.originLat,
+            "originLng": g.originLng,
+            "destLat": g.destLat,
+            "destLng": g.destLng,
+            "off_route_miles": off_route_meters / METERS_PER_MILE
+        })
+    return rows
+
+
+def _has_route(group) -> bool:
+    return None not in (group.originLat, group.originLng, group.destLat, group.destLng)
+
+
+async def _replan_group_pickups(group_id: int):
+    """
+    Re-optimize a group's pickup order after its passengers change and store
+    each passenger's pickupOrder and detourMiles (how much longer the drive
+    is because of that pickup). Passengers without coordinates keep their
+    relative order after the routed ones.
+    """
+    group = await db.carpoolgroup.find_unique(where={"id": group_id}, include={"members": True})
+    if not group or not _has_route(group):
+        return
+    passengers = sorted((m for m in group.members if m.role != "driver"), key=lambda m: (m.pickupOrder or 0, m.id))
+    routed = [m for m in passengers if m.pickupLat is not None and m.pickupLng is not None]
+    order, detours, _ = plan_pickups(
+        (group.originLat, group.originLng),
+        (group.destLat, group.destLng),
+        [(m.pickupLat, m.pickupLng) for m in routed]
+    )
+    plan = [(routed[i].id, round(detours[i] / METERS_PER_MILE, 1)) for i in order]
+    plan += [(m.id, m.detourMiles) for m in passengers if m.pickupLat is None or m.pickupLng is None]
+    if not plan:
+        return
+    values = []
+    params = []
+    for i, (member_id, detour) in enumerate(plan):
+        values.append(f"(${3 * i + 1}::int, ${3 * i + 2}::int, ${3 * i + 3}::float8)")
+        params.extend([member_id, i + 1, detour])
+    await db.execute_raw(
+        f'''
+        UPDATE "GroupMember" AS m
+        SET "pickupOrder" = v.pickup_order, "detourMiles" = v.detour
+        FROM (VALUES {", ".join(values)}) AS v(id, pickup_order, detour)
+        WHERE m.id = v.id
+        ''',
+        *params
+    )
+
+
 @app.post("/groups")
 async def create_carpool_group(
-    request: Request,
     name: Optional[str] = Form(None),
-    maxSeats: int = Form(4)
+    maxSeats: int = Form(4),
+    user_id: int = Depends(get_current_user_id),
+    user = Depends(get_current_user)
 ):
     """
     Create a new carpool group. The creator becomes the driver.
     Group starts with 1 occupant (the driver).
     """
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
-    # Get user with addresses for route calculation
-    user = await db.user.find_unique(
-        where={"id": user_id},
-        include={
-            "homeAddress": True,
-            "companyAddress": True
-        }
-    )
-    
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
     if user.role != "driver":
         raise HTTPException(status_code=400, detail="Only drivers can create carpool groups")
     
@@ -1376,6 +1784,8 @@ async def create_carpool_group(
         "baseDistanceMiles": base_distance
     })
     
+    open_group_index.invalidate()
+    
     # Add driver as first member
     await db.groupmember.create({
         "groupId": group.id,
@@ -1400,17 +1810,8 @@ async def create_carpool_group(
 
 
 @app.get("/groups")
-async def get_user_groups(request: Request):
+async def get_user_groups(user_id: int = Depends(get_current_user_id)):
     """Get all groups the user is part of (as driver or passenger)"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get groups where user is a member
     memberships = await db.groupmember.find_many(
         where={"userId": user_id},
@@ -1439,7 +1840,8 @@ async def get_user_groups(request: Request):
                 "id": group.driver.id,
                 "firstName": group.driver.firstName,
                 "lastName": group.driver.lastName,
-                "profilePath": group.driver.profilePath
+                "profilePath": storage_service.get_file_url(group.driver.profilePath),
+                "profileVariants": storage_service.get_variant_urls(group.driver.profileVariants)
             },
             "maxSeats": group.maxSeats,
             "currentOccupancy": group.currentOccupancy,
@@ -1450,7 +1852,8 @@ async def get_user_groups(request: Request):
                     "id": m.user.id,
                     "firstName": m.user.firstName,
                     "lastName": m.user.lastName,
-                    "profilePath": m.user.profilePath,
+                    "profilePath": storage_service.get_file_url(m.user.profilePath),
+                    "profileVariants": storage_service.get_variant_urls(m.user.profileVariants),
                     "role": m.role,
                     "pickupOrder": m.pickupOrder
                 }
@@ -1463,30 +1866,24 @@ async def get_user_groups(request: Request):
 
 @app.get("/groups/open")
 async def search_open_groups(
-    request: Request,
-    max_detour_miles: float = 3.0
+    max_detour_miles: float = 3.0,
+    user_id: int = Depends(get_current_user_id),
+    user = Depends(get_current_user)
 ):
     """
     Search for open carpool groups where user's home is "on the way".
-    Uses PostGIS to calculate if pickup adds acceptable detour.
-    Falls back to city/office matching if geospatial not available.
+    Uses PostGIS to find groups whose route passes within max_detour_miles of
+    the user's home: each group's precomputed route line is GiST-indexed, so
+    only groups passing near the user are ever looked at. Those are ranked
+    by the real detour - how much longer each group's drive gets with the
+    user's pickup, given its current passengers (routing.py).
+    Without PostGIS the route filter runs in-process over every open group
+    (group_index.py). Falls back to city/office matching if the user's home
+    is not geocoded or no group passes nearby; every matching group is
+    considered there, ranked by match type and then by real detour for
+    geocoded users.
     """
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
-    # Get user's home location
-    user = await db.user.find_unique(
-        where={"id": user_id},
-        include={"homeAddress": True, "companyAddress": True}
-    )
-    
-    if not user or not user.homeAddress:
+    if not user.homeAddress:
         raise HTTPException(status_code=400, detail="Please set your home address first")
     
     # Check if user already in a group
@@ -1512,158 +1909,220 @@ async def search_open_groups(
                     u."firstName" as driver_first_name,
                     u."lastName" as driver_last_name,
                     u."profilePath" as driver_profile,
+                    u."profileVariants" as driver_profile_variants,
                     ca.city as dest_city,
                     ca."officeName" as dest_office,
-                    calculate_detour_miles(
-                        g."originLng", g."originLat",
-                        g."destLng", g."destLat",
-                        $1, $2
-                    ) as detour_miles
+                    g."originLat",
+                    g."originLng",
+                    g."destLat",
+                    g."destLng",
+                    ST_Distance(
+                        g.route,
+                        ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography
+                    ) / 1609.34 as off_route_miles
                 FROM "CarpoolGroup" g
                 JOIN "User" u ON u.id = g."driverId"
                 LEFT JOIN "CompanyAddress" ca ON ca."userId" = g."driverId"
                 WHERE g.status = 'OPEN'
                   AND g."currentOccupancy" < g."maxSeats"
                   AND g."driverId" != $3
-                  AND g."originLat" IS NOT NULL
-                  AND g."destLat" IS NOT NULL
-                  AND is_on_the_way(
-                      g."originLng", g."originLat",
-                      g."destLng", g."destLat",
-                      $1, $2,
+                  AND ST_DWithin(
+                      g.route,
+                      ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography,
                       $4
                   )
-                ORDER BY detour_miles ASC
-                LIMIT 10
+                ORDER BY off_route_miles ASC, g.id
+                LIMIT $5
                 ''',
                 user.homeAddress.longitude,
                 user.homeAddress.latitude,
                 user_id,
-                max_detour_miles
+                max_detour_miles * 1609.34,  # route distance cap in meters
+                OPEN_GROUP_CANDIDATES
             )
-            
-            if groups:
-                return {
-                    "searchType": "geospatial",
-                    "maxDetourMiles": max_detour_miles,
-                    "alreadyInGroup": existing_membership is not None,
-                    "groups": [
-                        {
-                            "id": g["id"],
-                            "name": g["name"],
-                            "driver": {
-                                "id": g["driver_id"],
-                                "firstName": g["driver_first_name"],
-                                "lastName": g["driver_last_name"],
-                                "profilePath": g["driver_profile"]
-                            },
-                            "destination": {
-                                "city": g["dest_city"],
-                                "officeName": g["dest_office"]
-                            },
-                            "maxSeats": g["maxSeats"],
-                            "currentOccupancy": g["currentOccupancy"],
-                            "availableSeats": g["maxSeats"] - g["currentOccupancy"],
-                            "detourMiles": round(g["detour_miles"], 1) if g["detour_miles"] else None,
-                            "detourText": f"{round(g['detour_miles'], 1)} mi off route" if g["detour_miles"] else None
-                        }
-                        for g in groups
-                    ]
-                }
-            # If PostGIS returned empty, fall through to fallback
-                
         except Exception as e:
-            # PostGIS not available - fall through to fallback
             error_str = str(e).lower()
-            if "calculate_detour_miles" not in error_str and "is_on_the_way" not in error_str and "function" not in error_str:
+            postgis_missing = "st_dwithin" in error_str or "postgis" in error_str
+            # `prisma db push` deployments never get the migration's route column
+            route_missing = "route" in error_str and "does not exist" in error_str
+            if not postgis_missing and not route_missing:
                 raise HTTPException(status_code=500, detail=str(e))
-            # Fall through to fallback below
+            # PostGIS not available - check every open group's route in-process
+            groups = await _index_open_groups(
+                user.homeAddress.latitude,
+                user.homeAddress.longitude,
+                max_detour_miles * 1609.34,
+                user_id
+            )
+        
+        if groups:
+            # Rank every candidate group by real detour in one batched computation
+            members = await db.groupmember.find_many(
+                where={"groupId": {"in": [g["id"] for g in groups]}}
+            )
+            members_by_group = {}
+            for m in members:
+                members_by_group.setdefault(m.groupId, []).append(m)
+            added = join_costs_many(
+                [
+                    _group_route(
+                        (g["originLat"], g["originLng"]),
+                        (g["destLat"], g["destLng"]),
+                        members_by_group.get(g["id"], [])
+                    )
+                    for g in groups
+                ],
+                (user.homeAddress.latitude, user.homeAddress.longitude)
+            )
+            for g, meters in zip(groups, added):
+                g["detour_miles"] = max(float(meters), 0.0) / METERS_PER_MILE
+            groups.sort(key=lambda g: (g["detour_miles"], g["id"]))
+            groups = groups[:10]
+            
+            return {
+                "searchType": "geospatial",
+                "maxDetourMiles": max_detour_miles,
+                "alreadyInGroup": existing_membership is not None,
+                "groups": [
+                    {
+                        "id": g["id"],
+                        "name": g["name"],
+                        "driver": {
+                            "id": g["driver_id"],
+                            "firstName": g["driver_first_name"],
+                            "lastName": g["driver_last_name"],
+                            "profilePath": storage_service.get_file_url(g["driver_profile"]),
+                            "profileVariants": storage_service.get_variant_urls(g["driver_profile_variants"])
+                        },
+                        "destination": {
+                            "city": g["dest_city"],
+                            "officeName": g["dest_office"]
+                        },
+                        "maxSeats": g["maxSeats"],
+                        "currentOccupancy": g["currentOccupancy"],
+                        "availableSeats": g["maxSeats"] - g["currentOccupancy"],
+                        "detourMiles": round(g["detour_miles"], 1),
+                        "detourText": f"+{round(g['detour_miles'], 1)} mi detour",
+                        "offRouteMiles": round(g["off_route_miles"], 1)
+                    }
+                    for g in groups
+                ]
+            }
+        # If no group passes nearby, fall through to city/office matching
     
     # Fallback: Find groups by matching city/office when PostGIS unavailable
-    # This finds groups where driver works at same office or lives in same city
-    fallback_where = {
-        "status": "OPEN",
-        "driverId": {"not": user_id},  # Exclude own groups
-    }
-    
-    fallback_groups = await db.carpoolgroup.find_many(
-        where=fallback_where,
-        include={
-            "driver": {
-                "include": {
-                    "companyAddress": True,
-                    "homeAddress": True
-                }
-            }
-        },
-        take=20
+    # This finds groups where driver works at same office or lives in same city.
+    # Matching and the not-full check run in the query, so every matching
+    # group is considered, not just the first few open ones.
+    office = user.companyAddress.officeName if user.companyAddress else None
+    work_city = user.companyAddress.city if user.companyAddress else None
+    home_city = user.homeAddress.city if user.homeAddress else None
+    fallback_groups = await db.query_raw(
+        '''
+        SELECT * FROM (
+            SELECT
+                g.id,
+                g.name,
+                g."maxSeats",
+                g."currentOccupancy",
+                g."originLat",
+                g."originLng",
+                g."destLat",
+                g."destLng",
+                d.id as driver_id,
+                d."firstName" as driver_first_name,
+                d."lastName" as driver_last_name,
+                d."profilePath" as driver_profile,
+                d."profileVariants" as driver_profile_variants,
+                dca.city as dest_city,
+                dca."officeName" as dest_office,
+                CASE
+                    WHEN lower(dca."officeName") = lower($2::text) THEN 100
+                    WHEN lower(dca.city) = lower($3::text) THEN 50
+                    WHEN lower(dha.city) = lower($4::text) THEN 30
+                END as match_score
+            FROM "CarpoolGroup" g
+            JOIN "User" d ON d.id = g."driverId"
+            LEFT JOIN "CompanyAddress" dca ON dca."userId" = d.id
+            LEFT JOIN "HomeAddress" dha ON dha."userId" = d.id
+            WHERE g.status = 'OPEN'
+              AND g."currentOccupancy" < g."maxSeats"
+              AND g."driverId" != $1
+        ) matched
+        WHERE match_score IS NOT NULL
+        ORDER BY match_score DESC, id
+        ''',
+        user_id, office, work_city, home_city
     )
+    match_types = {100: "Same Office", 50: "Same Work City", 30: "Same Home City"}
+    
+    # Geocoded users: within a match type, the smallest real detour first
+    detours = {}
+    if user.homeAddress and user.homeAddress.latitude is not None and user.homeAddress.longitude is not None:
+        routed = [
+            g for g in fallback_groups
+            if None not in (g["originLat"], g["originLng"], g["destLat"], g["destLng"])
+        ]
+        if routed:
+            members = await db.groupmember.find_many(
+                where={"groupId": {"in": [g["id"] for g in routed]}}
+            )
+            members_by_group = {}
+            for m in members:
+                members_by_group.setdefault(m.groupId, []).append(m)
+            added = join_costs_many(
+                [
+                    _group_route(
+                        (g["originLat"], g["originLng"]),
+                        (g["destLat"], g["destLng"]),
+                        members_by_group.get(g["id"], [])
+                    )
+                    for g in routed
+                ],
+                (user.homeAddress.latitude, user.homeAddress.longitude)
+            )
+            detours = {
+                g["id"]: max(float(meters), 0.0) / METERS_PER_MILE
+                for g, meters in zip(routed, added)
+            }
+    fallback_groups.sort(key=lambda g: (
+        -g["match_score"],
+        detours.get(g["id"], float("inf")),
+        g["id"]
+    ))
     
-    # Filter and score groups by matching criteria
-    result_groups = []
-    for g in fallback_groups:
-        # Double check it's not full
-        if g.currentOccupancy >= g.maxSeats:
-            continue
-            
-        # Calculate match type (priority: office > work city > home city)
-        match_type = None
-        match_score = 0
-        
-        if user.companyAddress and g.driver.companyAddress:
-            if user.companyAddress.officeName and g.driver.companyAddress.officeName:
-                if user.companyAddress.officeName.lower() == g.driver.companyAddress.officeName.lower():
-                    match_type = "Same Office"
-                    match_score = 100
-            if not match_type and user.companyAddress.city and g.driver.companyAddress.city:
-                if user.companyAddress.city.lower() == g.driver.companyAddress.city.lower():
-                    match_type = "Same Work City"
-                    match_score = 50
-                    
-        if not match_type and user.homeAddress and g.driver.homeAddress:
-            if user.homeAddress.city and g.driver.homeAddress.city:
-                if user.homeAddress.city.lower() == g.driver.homeAddress.city.lower():
-                    match_type = "Same Home City"
-                    match_score = 30
-        
-        # Only include groups with at least one match
-        if match_type is None:
-            continue
-        
-        result_groups.append({
-            "id": g.id,
-            "name": g.name,
+    result_groups = [
+        {
+            "id": g["id"],
+            "name": g["name"],
             "driver": {
-                "id": g.driver.id,
-                "firstName": g.driver.firstName,
-                "lastName": g.driver.lastName,
-                "profilePath": g.driver.profilePath
+                "id": g["driver_id"],
+                "firstName": g["driver_first_name"],
+                "lastName": g["driver_last_name"],
+                "profilePath": storage_service.get_file_url(g["driver_profile"]),
+                "profileVariants": storage_service.get_variant_urls(g["driver_profile_variants"])
             },
             "destination": {
-                "city": g.driver.companyAddress.city if g.driver.companyAddress else None,
-                "officeName": g.driver.companyAddress.officeName if g.driver.companyAddress else None
+                "city": g["dest_city"],
+                "officeName": g["dest_office"]
             },
-            "maxSeats": g.maxSeats,
-            "currentOccupancy": g.currentOccupancy,
-            "availableSeats": g.maxSeats - g.currentOccupancy,
-            "matchType": match_type,
-            "detourMiles": None,
-            "detourText": match_type,
-            "_score": match_score
-        })
-    
-    # Sort by match score (best matches first)
-    result_groups.sort(key=lambda x: x["_score"], reverse=True)
-    for g in result_groups:
-        del g["_score"]
+            "maxSeats": g["maxSeats"],
+            "currentOccupancy": g["currentOccupancy"],
+            "availableSeats": g["maxSeats"] - g["currentOccupancy"],
+            "matchType": match_types[g["match_score"]],
+            "detourMiles": round(detours[g["id"]], 1) if g["id"] in detours else None,
+            "detourText": match_types[g["match_score"]]
+        }
+        for g in fallback_groups[:OPEN_GROUP_FALLBACK_RESULTS]
+    ]
     
     # Debug info to help diagnose matching issues
     debug_info = {
         "userCompanyCity": user.companyAddress.city if user.companyAddress else None,
         "userOfficeName": user.companyAddress.officeName if user.companyAddress else None,
         "userHomeCity": user.homeAddress.city if user.homeAddress else None,
-        "totalOpenGroups": len(fallback_groups),
-        "matchedGroups": len(result_groups)
+        "totalOpenGroups": await db.carpoolgroup.count(where={"status": "OPEN"}),
+        "matchedGroups": len(fallback_groups)
     }
     
     return {
@@ -1677,17 +2136,8 @@ async def search_open_groups(
 
 
 @app.get("/groups/{group_id}")
-async def get_group_details(request: Request, group_id: int):
+async def get_group_details(group_id: int, user_id: int = Depends(get_current_user_id)):
     """Get detailed information about a specific group"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     group = await db.carpoolgroup.find_unique(
         where={"id": group_id},
         include={
@@ -1729,7 +2179,8 @@ async def get_group_details(request: Request, group_id: int):
             "id": group.driver.id,
             "firstName": group.driver.firstName,
             "lastName": group.driver.lastName,
-            "profilePath": group.driver.profilePath,
+            "profilePath": storage_service.get_file_url(group.driver.profilePath),
+            "profileVariants": storage_service.get_variant_urls(group.driver.profileVariants),
             "companyAddress": {
                 "officeName": group.driver.companyAddress.officeName if group.driver.companyAddress else None,
                 "city": group.driver.companyAddress.city if group.driver.companyAddress else None
@@ -1740,7 +2191,8 @@ async def get_group_details(request: Request, group_id: int):
                 "id": m.user.id,
                 "firstName": m.user.firstName,
                 "lastName": m.user.lastName,
-                "profilePath": m.user.profilePath,
+                "profilePath": storage_service.get_file_url(m.user.profilePath),
+                "profileVariants": storage_service.get_variant_urls(m.user.profileVariants),
                 "role": m.role,
                 "pickupOrder": m.pickupOrder,
                 "detourMiles": m.detourMiles
@@ -1757,7 +2209,8 @@ async def get_group_details(request: Request, group_id: int):
                     "id": r.user.id,
                     "firstName": r.user.firstName,
                     "lastName": r.user.lastName,
-                    "profilePath": r.user.profilePath
+                    "profilePath": storage_service.get_file_url(r.user.profilePath),
+                    "profileVariants": storage_service.get_variant_urls(r.user.profileVariants)
                 },
                 "detourMiles": r.detourMiles,
                 "votesRequired": r.votesRequired,
@@ -1770,21 +2223,17 @@ async def get_group_details(request: Request, group_id: int):
 
 
 @app.post("/groups/{group_id}/requests")
-async def request_to_join_group(request: Request, group_id: int):
+async def request_to_join_group(
+    group_id: int,
+    user_id: int = Depends(get_current_user_id),
+    user = Depends(get_current_user)
+):
     """
     Request to join a carpool group.
-    Calculates detour distance using PostGIS.
+    Calculates the detour - how much longer the group's drive gets with this
+    pickup, re-ordering pickups optimally (routing.py).
     All current members must approve (atomic consensus).
     """
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get group
     group = await db.carpoolgroup.find_unique(
         where={"id": group_id},
@@ -1811,32 +2260,18 @@ async def request_to_join_group(request: Request, group_id: int):
     if existing:
         raise HTTPException(status_code=409, detail="You already have a pending request for this group")
     
-    # Get user's home address for detour calculation
-    user = await db.user.find_unique(
-        where={"id": user_id},
-        include={"homeAddress": True}
-    )
-    
-    if not user or not user.homeAddress:
+    if not user.homeAddress:
         raise HTTPException(status_code=400, detail="Please set your home address first")
     
-    # Calculate detour using PostGIS
+    # Calculate detour against the group's current pickups
     detour_miles = None
-    if (group.originLat and group.originLng and group.destLat and group.destLng and
-        user.homeAddress.latitude and user.homeAddress.longitude):
-        try:
-            result = await db.query_raw(
-                '''
-                SELECT calculate_detour_miles($1, $2, $3, $4, $5, $6) as detour
-                ''',
-                group.originLng, group.originLat,
-                group.destLng, group.destLat,
-                user.homeAddress.longitude, user.homeAddress.latitude
-            )
-            if result:
-                detour_miles = round(result[0]["detour"], 1)
-        except:
-            pass  # If function not available, skip
+    if (_has_route(group) and
+            user.homeAddress.latitude is not None and user.homeAddress.longitude is not None):
+        added, _ = join_costs(
+            [_group_route((group.originLat, group.originLng), (group.destLat, group.destLng), group.members)],
+            [(user.homeAddress.latitude, user.homeAddress.longitude)]
+        )
+        detour_miles = round(max(float(added[0, 0]), 0.0) / METERS_PER_MILE, 1)
     
     # Create the request
     join_request = await db.grouprequest.create({
@@ -1860,17 +2295,8 @@ async def request_to_join_group(request: Request, group_id: int):
 
 
 @app.get("/groups/{group_id}/requests")
-async def get_group_requests(request: Request, group_id: int):
+async def get_group_requests(group_id: int, user_id: int = Depends(get_current_user_id)):
     """Get all pending join requests for a group (members only)"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Verify user is a member
     membership = await db.groupmember.find_first(
         where={"groupId": group_id, "userId": user_id}
@@ -1899,7 +2325,8 @@ async def get_group_requests(request: Request, group_id: int):
                 "id": r.user.id,
                 "firstName": r.user.firstName,
                 "lastName": r.user.lastName,
-                "profilePath": r.user.profilePath,
+                "profilePath": storage_service.get_file_url(r.user.profilePath),
+                "profileVariants": storage_service.get_variant_urls(r.user.profileVariants),
                 "role": r.user.role,
                 "homeCity": r.user.homeAddress.city if r.user.homeAddress else None,
                 "workCity": r.user.companyAddress.city if r.user.companyAddress else None
@@ -1914,150 +2341,182 @@ async def get_group_requests(request: Request, group_id: int):
     ]
 
 
+async def _cast_group_vote_tx(group_id: int, request_id: int, voter_id: int, vote: str) -> dict:
+    """
+    cast_group_vote() as a Prisma interactive transaction, for databases
+    built with `prisma db push` where the SQL migrations never ran. Same
+    lock order (group, then request), same outcomes and same result row.
+    """
+    def result(outcome, request=None, received=None, occupancy=None, first_name=None):
+        return {
+            "outcome": outcome,
+            "votes_received": received if received is not None else (request["votesReceived"] if request else None),
+            "votes_required": request["votesRequired"] if request else None,
+            "requester_id": request["userId"] if request else None,
+            "requester_first_name": first_name,
+            "new_occupancy": occupancy
+        }
+
+    try:
+        async with db.tx() as tx:
+            membership = await tx.groupmember.find_first(where={"groupId": group_id, "userId": voter_id})
+            if not membership:
+                return result("not_member")
+
+            # Lock order: group, then request (same for every voter, so no deadlocks)
+            groups = await tx.query_raw(
+                'SELECT status, "maxSeats", "currentOccupancy" FROM "CarpoolGroup" WHERE id = $1 FOR UPDATE',
+                group_id
+            )
+            requests = await tx.query_raw(
+                '''
+                SELECT "groupId", "userId", status, "votesReceived", "votesRequired", "detourMiles"
+                FROM "GroupRequest" WHERE id = $1 FOR UPDATE
+                ''',
+                request_id
+            )
+            if not groups or not requests:
+                return result("not_found")
+            group, request = groups[0], requests[0]
+            if request["groupId"] != group_id:
+                return result("wrong_group")
+            if request["status"] != "pending":
+                return result("already_processed", request, occupancy=group["currentOccupancy"])
+
+            # Unique on (requestId, voterId); a repeat vote rolls the transaction back
+            await tx.groupvote.create({"requestId": request_id, "voterId": voter_id, "vote": vote})
+
+            if vote == "reject":
+                # Any rejection = request denied immediately
+                await tx.grouprequest.update(where={"id": request_id}, data={"status": "rejected"})
+                return result("rejected", request, occupancy=group["currentOccupancy"])
+
+            updated = await tx.grouprequest.update(
+                where={"id": request_id},
+                data={"votesReceived": {"increment": 1}}
+            )
+            received = updated.votesReceived
+            if received < request["votesRequired"]:
+                return result("pending", request, received, group["currentOccupancy"])
+
+            # Consensus reached, but the group may have filled up meanwhile
+            if group["status"] != "OPEN" or group["currentOccupancy"] >= group["maxSeats"]:
+                await tx.grouprequest.update(where={"id": request_id}, data={"status": "rejected"})
+                return result("full", request, received, group["currentOccupancy"])
+
+            # Provisional pickup order (last in the route); the app re-plans it
+            requester = await tx.user.find_unique(
+                where={"id": request["userId"]},
+                include={"homeAddress": True}
+            )
+            last = await tx.groupmember.find_first(where={"groupId": group_id}, order={"pickupOrder": "desc"})
+            await tx.groupmember.create({
+                "groupId": group_id,
+                "userId": request["userId"],
+                "role": "passenger",
+                "pickupLat": requester.homeAddress.latitude if requester.homeAddress else None,
+                "pickupLng": requester.homeAddress.longitude if requester.homeAddress else None,
+                "pickupOrder": (last.pickupOrder or 0) + 1 if last else 1,
+                "detourMiles": request["detourMiles"]
+            })
+            # Without the check_group_capacity() trigger, mark the group FULL here
+            occupancy = group["currentOccupancy"] + 1
+            await tx.carpoolgroup.update(
+                where={"id": group_id},
+                data={
+                    "currentOccupancy": {"increment": 1},
+                    **({"status": "FULL"} if occupancy >= group["maxSeats"] else {})
+                }
+            )
+            await tx.grouprequest.update(where={"id": request_id}, data={"status": "approved"})
+            return result("approved", request, received, occupancy, requester.firstName)
+    except UniqueViolationError:
+        return result("already_voted")
+
+
 @app.post("/groups/{group_id}/requests/{request_id}/vote")
 async def vote_on_join_request(
-    request: Request,
     group_id: int,
     request_id: int,
-    vote: str = Form(...)  # "approve" or "reject"
+    background_tasks: BackgroundTasks,
+    vote: str = Form(...),  # "approve" or "reject"
+    user_id: int = Depends(get_current_user_id)
 ):
     """
     Vote on a join request. Implements atomic consensus:
     - All members must vote "approve" for user to join
     - Any "reject" vote immediately denies the request
-    """
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
     
+    The whole vote is one database round trip (cast_group_vote, see the
+    add_cast_group_vote migration), or one interactive transaction where
+    that function was never created.
+    """
     if vote not in ["approve", "reject"]:
         raise HTTPException(status_code=400, detail="Vote must be 'approve' or 'reject'")
     
-    # Verify user is a member
-    membership = await db.groupmember.find_first(
-        where={"groupId": group_id, "userId": user_id}
-    )
-    if not membership:
+    # Membership check, vote, counting and (on consensus) joining the group
+    # all happen in cast_group_vote() under a row lock on the group, so
+    # concurrent votes can't lose increments or overfill the group
+    try:
+        rows = await db.query_raw(
+            'SELECT * FROM cast_group_vote($1, $2, $3, $4)',
+            group_id, request_id, user_id, vote
+        )
+        result = rows[0] if rows else None
+    except Exception as e:
+        error_str = str(e).lower()
+        if "cast_group_vote" not in error_str or "does not exist" not in error_str:
+            raise HTTPException(status_code=500, detail=str(e))
+        # Migrations not applied (prisma db push) - same steps, locked the same way
+        result = await _cast_group_vote_tx(group_id, request_id, user_id, vote)
+    if not result:
+        raise HTTPException(status_code=500, detail="Vote could not be recorded")
+    outcome = result["outcome"]
+    
+    if outcome == "not_member":
         raise HTTPException(status_code=403, detail="You must be a group member to vote")
-    
-    # Get the request
-    join_request = await db.grouprequest.find_unique(
-        where={"id": request_id},
-        include={
-            "user": {"include": {"homeAddress": True}},
-            "group": True,
-            "votes": True
-        }
-    )
-    
-    if not join_request:
+    if outcome == "not_found":
         raise HTTPException(status_code=404, detail="Request not found")
-    
-    if join_request.groupId != group_id:
+    if outcome == "wrong_group":
         raise HTTPException(status_code=400, detail="Request does not belong to this group")
-    
-    if join_request.status != "pending":
+    if outcome == "already_processed":
         raise HTTPException(status_code=400, detail="This request has already been processed")
-    
-    # Check if already voted
-    existing_vote = next((v for v in join_request.votes if v.voterId == user_id), None)
-    if existing_vote:
+    if outcome == "already_voted":
         raise HTTPException(status_code=400, detail="You have already voted on this request")
     
-    # Record the vote
-    await db.groupvote.create({
-        "requestId": request_id,
-        "voterId": user_id,
-        "vote": vote
-    })
-    
-    if vote == "reject":
-        # Any rejection = request denied immediately
-        await db.grouprequest.update(
-            where={"id": request_id},
-            data={"status": "rejected"}
-        )
+    if outcome == "rejected":
         return {
             "status": "rejected",
             "message": "Request rejected"
         }
     
-    # Increment votes received
-    new_votes = join_request.votesReceived + 1
+    if outcome == "full":
+        return {
+            "status": "rejected",
+            "message": "The group filled up before every member approved"
+        }
     
-    # Check if consensus reached
-    if new_votes >= join_request.votesRequired:
-        # All members approved! Add user to group
-        group = join_request.group
-        requester = join_request.user
-        
-        # Calculate pickup order (last in the route)
-        max_order = await db.groupmember.find_first(
-            where={"groupId": group_id},
-            order={"pickupOrder": "desc"}
-        )
-        new_order = (max_order.pickupOrder or 0) + 1 if max_order else 1
-        
-        # Add as member
-        await db.groupmember.create({
-            "groupId": group_id,
-            "userId": requester.id,
-            "role": "passenger",
-            "pickupLat": requester.homeAddress.latitude if requester.homeAddress else None,
-            "pickupLng": requester.homeAddress.longitude if requester.homeAddress else None,
-            "pickupOrder": new_order,
-            "detourMiles": join_request.detourMiles
-        })
-        
-        # Update group occupancy (trigger will auto-set status to FULL if needed)
-        await db.carpoolgroup.update(
-            where={"id": group_id},
-            data={"currentOccupancy": group.currentOccupancy + 1}
-        )
-        
-        # Mark request as approved
-        await db.grouprequest.update(
-            where={"id": request_id},
-            data={"status": "approved", "votesReceived": new_votes}
-        )
-        
+    if outcome == "approved":
+        open_group_index.invalidate()
+        # Fit the new pickup into the best route for everyone, after responding
+        background_tasks.add_task(_replan_group_pickups, group_id)
         return {
             "status": "approved",
-            "message": f"Consensus reached! {requester.firstName} has been added to the group.",
-            "newOccupancy": group.currentOccupancy + 1
+            "message": f"Consensus reached! {result['requester_first_name']} has been added to the group.",
+            "newOccupancy": result["new_occupancy"]
         }
     
-    # Update votes received
-    await db.grouprequest.update(
-        where={"id": request_id},
-        data={"votesReceived": new_votes}
-    )
-    
     return {
         "status": "pending",
-        "votesReceived": new_votes,
-        "votesRequired": join_request.votesRequired,
-        "message": f"Vote recorded. {new_votes}/{join_request.votesRequired} approvals received."
+        "votesReceived": result["votes_received"],
+        "votesRequired": result["votes_required"],
+        "message": f"Vote recorded. {result['votes_received']}/{result['votes_required']} approvals received."
     }
 
 
 @app.delete("/groups/{group_id}/leave")
-async def leave_group(request: Request, group_id: int):
+async def leave_group(group_id: int, user_id: int = Depends(get_current_user_id)):
     """Leave a carpool group. Drivers cannot leave (must close group instead)."""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     # Get membership
     membership = await db.groupmember.find_first(
         where={"groupId": group_id, "userId": user_id}
@@ -2077,22 +2536,17 @@ async def leave_group(request: Request, group_id: int):
         where={"id": group_id},
         data={"currentOccupancy": {"decrement": 1}}
     )
+    open_group_index.invalidate()
+    
+    # The remaining pickups may have a shorter order now
+    await _replan_group_pickups(group_id)
     
     return {"message": "You have left the group"}
 
 
 @app.patch("/groups/{group_id}/close")
-async def close_group(request: Request, group_id: int):
+async def close_group(group_id: int, user_id: int = Depends(get_current_user_id)):
     """Close a carpool group (driver only). Removes all members."""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     group = await db.carpoolgroup.find_unique(where={"id": group_id})
     
     if not group:
@@ -2106,22 +2560,14 @@ async def close_group(request: Request, group_id: int):
         where={"id": group_id},
         data={"status": "CLOSED"}
     )
+    open_group_index.invalidate()
     
     return {"message": "Group has been closed"}
 
 
 @app.get("/my-group-requests")
-async def get_my_group_requests(request: Request):
+async def get_my_group_requests(user_id: int = Depends(get_current_user_id)):
     """Get all group join requests made by the current user"""
-    auth = request.headers.get("authorization") or request.headers.get("Authorization")
-    if not auth or not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=401, detail="Missing bearer token")
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    user_id = payload.get("user_id")
-    if not user_id:
-        raise HTTPException(status_code=400, detail="Malformed token payload")
-    
     requests = await db.grouprequest.find_many(
         where={"userId": user_id},
         include={
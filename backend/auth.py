@@ -0,0 +1,148 @@
+"""
+Authentication helpers: JWT creation/verification and the FastAPI dependencies
+that resolve the caller from the "Authorization: Bearer <token>" header.
+
+Verified tokens are kept in a bounded LRU cache until they expire, so a page
+that fires several API calls with the same token only pays for HMAC
+verification once.
+"""
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Request
+from jose import jwt, JWTError
+
+from database import db
+
+# Authentication configuration
+JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
+JWT_ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 60
+
+# Max number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "2048"))
+
+
+class TokenCache:
+    """
+    Bounded LRU cache mapping a raw token to its decoded claims.
+
+    Entries are dropped once the token's "exp" claim has passed, so a cached
+    token is never accepted after it would have failed verification.
+    """
+
+    def __init__(self, maxsize: int = TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, claims = entry
+        if expires_at <= time.time():
+            del self._entries[token]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, claims: dict) -> None:
+        exp = claims.get("exp")
+        if exp is None or self.maxsize <= 0:
+            # Tokens without an expiry are verified every time
+            return
+        self._entries[token] = (float(exp), claims)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxSize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+token_cache = TokenCache()
+
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    """Create a JWT access token"""
+    to_encode = data.copy()
+    if expires_delta:
+        expire = datetime.utcnow() + expires_delta
+    else:
+        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    to_encode.update({"exp": expire})
+    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return encoded_jwt
+
+
+def decode_token(token: str):
+    """Verify a token and return its claims, using the cache when possible"""
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    try:
+        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    token_cache.put(token, payload)
+    return payload
+
+
+async def get_current_user_id(request: Request) -> int:
+    """FastAPI dependency: return the caller's user id from the bearer token"""
+    auth = request.headers.get("authorization") or request.headers.get("Authorization")
+    if not auth or not auth.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    token = auth.split(" ", 1)[1].strip()
+    payload = decode_token(token)
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=400, detail="Malformed token payload")
+    return user_id
+
+
+async def get_current_user(request: Request, user_id: int = Depends(get_current_user_id)):
+    """
+    FastAPI dependency: return the caller with both addresses loaded.
+
+    The user is memoized on request.state, so any other code handling the same
+    request gets the already-loaded object instead of querying again.
+    """
+    cached = getattr(request.state, "current_user", None)
+    if cached is not None and cached.id == user_id:
+        return cached
+    user = await db.user.find_unique(
+        where={"id": user_id},
+        include={
+            "companyAddress": True,
+            "homeAddress": True
+        }
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    request.state.current_user = user
+    return user
@@ -0,0 +1,152 @@
+"""
+Benchmark the one-query commute search against the two-step approach.
+
+Two-step (what /search?type=all did): fetch everyone whose office is within
+the work radius, with a correlated subquery looking up the caller's home for
+every candidate row, then keep the ones whose home is close enough and rank
+them in Python.
+
+One query (commute.py): both radius scans on their GiST indexes, joined on
+user id, ranked and cut in the database.
+
+Both are run for the same sample of users, checked to return the same
+partners, and timed.
+
+Usage:
+    python benchmark_commute.py
+    python benchmark_commute.py --users 200 --home-miles 3 --work-miles 2 --explain
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+from commute import COMMUTE_MATCH_SQL, query_commute_matches  # noqa: E402
+from database import db  # noqa: E402
+
+TWO_STEP_SQL = '''
+    SELECT
+        u.id,
+        ST_Distance(
+            ca.location,
+            ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography
+        ) as work_distance_meters,
+        CASE WHEN ha.location IS NOT NULL THEN
+            ST_Distance(
+                ha.location,
+                (SELECT location FROM "HomeAddress" WHERE "userId" = $3)
+            )
+        ELSE NULL END as home_distance_meters
+    FROM "User" u
+    JOIN "CompanyAddress" ca ON ca."userId" = u.id
+    LEFT JOIN "HomeAddress" ha ON ha."userId" = u.id
+    WHERE u.id != $3
+      AND ca.location IS NOT NULL
+      AND ST_DWithin(
+          ca.location,
+          ST_SetSRID(ST_MakePoint($1, $2), 4326)::geography,
+          $4
+      )
+    ORDER BY work_distance_meters ASC
+'''
+
+
+async def two_step(user, home_radius: float, work_radius: float, limit: int):
+    rows = await db.query_raw(TWO_STEP_SQL, user["work_lng"], user["work_lat"], user["id"], work_radius)
+    pairs = [
+        (r["home_distance_meters"] + r["work_distance_meters"], r["id"])
+        for r in rows
+        if r["home_distance_meters"] is not None and r["home_distance_meters"] <= home_radius
+    ]
+    pairs.sort()
+    return [uid for _, uid in pairs[:limit]], len(rows)
+
+
+async def one_query(user, home_radius: float, work_radius: float, limit: int):
+    rows = await query_commute_matches(user["id"], home_radius, work_radius, None, limit)
+    return [r["id"] for r in rows]
+
+
+def summarize(name: str, timings: list) -> str:
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return (
+        f"{name:<10} mean {statistics.mean(timings):7.2f} ms   "
+        f"p50 {statistics.median(timings):7.2f} ms   p95 {p95:7.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare commute search strategies")
+    parser.add_argument("--users", type=int, default=100, help="Sample size")
+    parser.add_argument("--home-miles", type=float, default=5.0)
+    parser.add_argument("--work-miles", type=float, default=5.0)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3, help="Timed passes over the sample")
+    parser.add_argument("--explain", action="store_true", help="Print the one-query plan for the first user")
+    args = parser.parse_args()
+
+    home_radius = args.home_miles * 1609.34
+    work_radius = args.work_miles * 1609.34
+
+    await db.connect()
+    try:
+        users = await db.query_raw(
+            '''
+            SELECT ca."userId" AS id, ca.latitude AS work_lat, ca.longitude AS work_lng
+            FROM "CompanyAddress" ca
+            JOIN "HomeAddress" ha ON ha."userId" = ca."userId"
+            WHERE ca.location IS NOT NULL AND ha.location IS NOT NULL
+            ORDER BY random()
+            LIMIT $1
+            ''',
+            args.users
+        )
+        if not users:
+            print("No users with both addresses geocoded.")
+            return
+        print(f"{len(users)} users, home within {args.home_miles} mi, work within {args.work_miles} mi")
+
+        # Warm-up pass doubles as the correctness check
+        mismatches = 0
+        scanned = 0
+        for user in users:
+            expected, candidates = await two_step(user, home_radius, work_radius, args.limit)
+            scanned += candidates
+            if await one_query(user, home_radius, work_radius, args.limit) != expected:
+                mismatches += 1
+        print(f"two-step fetched {scanned / len(users):.1f} office-radius rows per search")
+        print(f"{mismatches} of {len(users)} searches returned different partners")
+
+        timings = {"two-step": [], "one-query": []}
+        for _ in range(args.rounds):
+            for user in users:
+                started = time.perf_counter()
+                await two_step(user, home_radius, work_radius, args.limit)
+                timings["two-step"].append((time.perf_counter() - started) * 1000)
+                started = time.perf_counter()
+                await one_query(user, home_radius, work_radius, args.limit)
+                timings["one-query"].append((time.perf_counter() - started) * 1000)
+        for name, values in timings.items():
+            print(summarize(name, values))
+        speedup = statistics.mean(timings["two-step"]) / statistics.mean(timings["one-query"])
+        print(f"one-query is {speedup:.1f}x faster on average")
+
+        if args.explain:
+            plan = await db.query_raw(
+                "EXPLAIN (ANALYZE, BUFFERS) " + COMMUTE_MATCH_SQL,
+                users[0]["id"], home_radius, work_radius, None, None, args.limit
+            )
+            for row in plan:
+                print(row["QUERY PLAN"])
+    finally:
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
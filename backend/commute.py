@@ -0,0 +1,144 @@
+"""
+Two-ended commute matching: users whose home is near ours AND whose office
+is near ours.
+
+The caller's home and office locations are resolved once in a CTE, each end
+is a GiST-indexed ST_DWithin scan, and the two candidate sets are joined on
+user id, so only people who match at both ends are ever formatted or
+scored. Results are ranked by combined detour - the distance between the
+two homes plus the distance between the two offices - then by user id.
+
+Without PostGIS the same intersection is answered from the in-memory
+spatial indexes.
+"""
+from typing import Optional
+
+from database import db
+from spatial_index import spatial_indexes
+
+# $1 current user id, $2 home radius (m), $3 work radius (m),
+# $4/$5 detour and id of the previous page's last row (NULL for page one),
+# $6 rows to fetch
+COMMUTE_MATCH_SQL = '''
+    WITH me AS (
+        SELECT ha.location AS home, ca.location AS work
+        FROM "HomeAddress" ha
+        JOIN "CompanyAddress" ca ON ca."userId" = ha."userId"
+        WHERE ha."userId" = $1
+          AND ha.location IS NOT NULL
+          AND ca.location IS NOT NULL
+    ),
+    near_home AS (
+        SELECT ha."userId", ST_Distance(ha.location, me.home) AS home_distance
+        FROM me
+        JOIN "HomeAddress" ha ON ST_DWithin(ha.location, me.home, $2)
+        WHERE ha."userId" != $1
+    ),
+    near_work AS (
+        SELECT ca."userId", ST_Distance(ca.location, me.work) AS work_distance
+        FROM me
+        JOIN "CompanyAddress" ca ON ST_DWithin(ca.location, me.work, $3)
+        WHERE ca."userId" != $1
+    ),
+    pairs AS (
+        SELECT nh."userId", nh.home_distance, nw.work_distance,
+               nh.home_distance + nw.work_distance AS detour
+        FROM near_home nh
+        JOIN near_work nw ON nw."userId" = nh."userId"
+    )
+    SELECT
+        u.id,
+        u."firstName",
+        u."lastName",
+        u.email,
+        u.phone,
+        u.role,
+        u."willingToTake",
+        u."hasDriversLicense",
+        u."profilePath",
+        u."profileVariants",
+        ca."officeName" as company_office,
+        ca.city as company_city,
+        ha.city as home_city,
+        ha.zipcode as home_zipcode,
+        p.home_distance,
+        p.work_distance,
+        p.detour
+    FROM pairs p
+    JOIN "User" u ON u.id = p."userId"
+    JOIN "CompanyAddress" ca ON ca."userId" = u.id
+    JOIN "HomeAddress" ha ON ha."userId" = u.id
+    WHERE $4::float8 IS NULL OR (p.detour, u.id) > ($4::float8, $5::int)
+    ORDER BY p.detour, u.id
+    LIMIT $6
+'''
+
+
+async def query_commute_matches(
+    user_id: int,
+    home_radius_meters: float,
+    work_radius_meters: float,
+    after: Optional[list],
+    limit: int
+) -> list:
+    """Up to limit commute partners after the (detour, id) key, best first"""
+    after_detour, after_id = after if after else (None, None)
+    return await db.query_raw(
+        COMMUTE_MATCH_SQL,
+        user_id, home_radius_meters, work_radius_meters, after_detour, after_id, limit
+    )
+
+
+async def index_commute_matches(
+    user_id: int,
+    home: tuple,
+    work: tuple,
+    home_radius_meters: float,
+    work_radius_meters: float,
+    after: Optional[list],
+    limit: int
+) -> list:
+    """
+    Same rows as query_commute_matches, answered from the in-memory spatial
+    indexes. home and work are the caller's (lat, lng).
+    """
+    near_home = dict(spatial_indexes.home.within(*home, home_radius_meters, exclude=user_id))
+    pairs = sorted(
+        (near_home[uid] + work_distance, uid, near_home[uid], work_distance)
+        for uid, work_distance in spatial_indexes.work.within(*work, work_radius_meters, exclude=user_id)
+        if uid in near_home
+    )
+    if after:
+        pairs = [p for p in pairs if (p[0], p[1]) > tuple(after)]
+    pairs = pairs[:limit]
+
+    users = await db.user.find_many(
+        where={"id": {"in": [uid for _, uid, _, _ in pairs]}},
+        include={"companyAddress": True, "homeAddress": True}
+    )
+    users_by_id = {u.id: u for u in users}
+    rows = []
+    for detour, uid, home_distance, work_distance in pairs:
+        user = users_by_id.get(uid)
+        if not user or not user.companyAddress or not user.homeAddress:
+            continue
+        rows.append({
+            "id": user.id,
+            "firstName": user.firstName,
+            "lastName": user.lastName,
+            "email": user.email,
+            "phone": user.phone,
+            "role": user.role,
+            "willingToTake": user.willingToTake,
+            "hasDriversLicense": user.hasDriversLicense,
+            "profilePath": user.profilePath,
+            "profileVariants": user.profileVariants,
+            "company_office": user.companyAddress.officeName,
+            "company_city": user.companyAddress.city,
+            "home_city": user.homeAddress.city,
+            "home_zipcode": user.homeAddress.zipcode,
+            "home_distance": home_distance,
+            "work_distance": work_distance,
+            "detour": detour
+        })
+    return rows
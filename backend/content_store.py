@@ -0,0 +1,195 @@
+"""
+Content-addressed local file store.
+
+Files are named after the SHA-256 of their content and sharded into two
+directory levels (uploads/ab/cd/abcd...ef.webp), so:
+    - identical uploads are stored once and reference counted
+    - two uploads can never overwrite each other
+    - no single directory grows without bound
+    - a URL always refers to the same bytes, so it can be cached forever
+
+Uploads are hashed while they stream to a temp file, which is then
+atomically renamed into place. Reference counts live in a small SQLite
+index; placing/removing a file and updating its count happen inside one
+SQLite write transaction, so concurrent workers cannot delete a file that
+another one has just referenced.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from typing import Optional
+
+import aiofiles
+from fastapi.staticfiles import StaticFiles
+
+CONTENT_STORE_INDEX = os.getenv(
+    "CONTENT_STORE_INDEX",
+    os.path.join(os.path.dirname(__file__), "content_store.sqlite3")
+)
+_READ_CHUNK = 1024 * 1024
+_ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+
+# Relative paths produced by ContentStore: ab/cd/<64 hex chars>.<ext>
+CONTENT_PATH = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$")
+
+
+class ContentStore:
+    def __init__(self, root: str, index_path: str = CONTENT_STORE_INDEX):
+        self.root = root
+        self.index_path = index_path
+        self.tmp_dir = os.path.join(root, ".tmp")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_deduplicated = 0
+        self.released = 0
+        self.deleted = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.index_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS content_refs (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refs INTEGER NOT NULL
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def relative_path(digest: str, ext: str) -> str:
+        return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+    @staticmethod
+    def extension(filename: str) -> str:
+        ext = os.path.splitext(filename)[1].lower()
+        return ext if ext in _ALLOWED_EXTENSIONS else ".bin"
+
+    def _commit_sync(self, tmp_path: str, rel_path: str, size: int) -> bool:
+        """Move the temp file into place (or drop it if the content exists) and add a reference"""
+        final_path = os.path.join(self.root, rel_path)
+        with self._lock:
+            conn = self._connection()
+            # IMMEDIATE takes the write lock up front, serializing with other workers
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if os.path.exists(final_path):
+                    os.unlink(tmp_path)
+                    duplicate = True
+                else:
+                    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                    os.replace(tmp_path, final_path)
+                    duplicate = False
+                conn.execute(
+                    """
+                    INSERT INTO content_refs (path, size, refs) VALUES (?, ?, 1)
+                    ON CONFLICT(path) DO UPDATE SET refs = refs + 1
+                    """,
+                    (rel_path, size)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return duplicate
+
+    def _release_sync(self, rel_path: str) -> bool:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("UPDATE content_refs SET refs = refs - 1 WHERE path = ?", (rel_path,))
+                row = conn.execute("SELECT refs FROM content_refs WHERE path = ?", (rel_path,)).fetchone()
+                deleted = row is not None and row[0] <= 0
+                if deleted:
+                    conn.execute("DELETE FROM content_refs WHERE path = ?", (rel_path,))
+                    try:
+                        os.unlink(os.path.join(self.root, rel_path))
+                    except FileNotFoundError:
+                        pass
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return deleted
+
+    async def put(self, upload, filename: str) -> str:
+        """
+        Stream an upload into the store.
+
+        Returns:
+            Path relative to the store root, e.g. "ab/cd/abcd...ef.webp"
+        """
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                while chunk := await upload.read(_READ_CHUNK):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+            rel_path = self.relative_path(digest.hexdigest(), self.extension(filename))
+            duplicate = await asyncio.to_thread(self._commit_sync, tmp_path, rel_path, size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if duplicate:
+            self.deduplicated += 1
+            self.bytes_deduplicated += size
+        else:
+            self.stored += 1
+        return rel_path
+
+    async def release(self, rel_path: str) -> bool:
+        """Drop one reference; the file is deleted with its last reference"""
+        deleted = await asyncio.to_thread(self._release_sync, rel_path)
+        self.released += 1
+        self.deleted += int(deleted)
+        return deleted
+
+    def _totals_sync(self):
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM content_refs"
+            ).fetchone()
+
+    def stats(self) -> dict:
+        files, size, refs = self._totals_sync()
+        return {
+            "files": files,
+            "bytes": size,
+            "references": refs,
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "bytesDeduplicated": self.bytes_deduplicated,
+            "released": self.released,
+            "deleted": self.deleted,
+        }
+
+
+class UploadsStaticFiles(StaticFiles):
+    """
+    /uploads mount that marks content-addressed files as immutable, so
+    browsers and CDNs never revalidate them. Legacy timestamped files are
+    served with the default headers.
+    """
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304) and CONTENT_PATH.match(path.replace(os.sep, "/")):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
@@ -0,0 +1,7 @@
+"""
+Shared Prisma client so the API, helper modules and background workers
+all use the same connection.
+"""
+from prisma import Prisma
+
+db = Prisma()
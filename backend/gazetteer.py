@@ -0,0 +1,233 @@
+"""
+Offline ZIP / city centroid gazetteer.
+
+Answers ZIP-only and city-only lookups locally so they never wait on the
+Nominatim rate limit. The data lives in one compact binary file that is
+memory-mapped read-only: it opens in milliseconds and every worker process
+shares the same pages through the OS page cache.
+
+File layout (little-endian):
+    header     "GZT1", version u32, zip count u32, city count u32
+    zip keys   u32[n]   sorted 5-digit ZIPs
+    zip lat    f32[n]
+    zip lng    f32[n]
+    (padding to 8 bytes)
+    city keys  u64[m]   sorted 64-bit hashes of normalized "city" / "city|state"
+    city lat   f32[m]
+    city lng   f32[m]
+
+Build it from the Census Bureau gazetteer files
+(https://www.census.gov/geographies/reference-files/time-series/geo/gazetteer-files.html):
+    python gazetteer.py build --zcta 2020_Gaz_zcta_national.txt \\
+        --places 2020_Gaz_place_national.txt
+"""
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+GAZETTEER_PATH = os.getenv(
+    "GAZETTEER_PATH",
+    os.path.join(os.path.dirname(__file__), "data", "gazetteer.bin")
+)
+
+_MAGIC = b"GZT1"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIII")
+
+# Census place names carry a legal/statistical suffix ("Mountain View city")
+_PLACE_SUFFIX = re.compile(
+    r"\s+(city and borough|consolidated government.*|metropolitan government.*|"
+    r"unified government.*|city|town|village|borough|cdp|municipality|comunidad|zona urbana)$"
+)
+_CITY_PREFIXES = {"st": "saint", "ste": "sainte", "ft": "fort", "mt": "mount"}
+
+
+class GazetteerHit(NamedTuple):
+    latitude: float
+    longitude: float
+    precision: str  # "zip" or "city"
+
+
+def normalize_city(city: str, state: Optional[str] = None) -> str:
+    words = re.sub(r"[.,'-]", " ", city.lower()).split()
+    if words and words[0] in _CITY_PREFIXES:
+        words[0] = _CITY_PREFIXES[words[0]]
+    key = " ".join(words)
+    return f"{key}|{state.lower()}" if state else key
+
+
+def _city_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def _normalize_zip(zipcode: str) -> Optional[int]:
+    digits = zipcode.strip()[:5]
+    return int(digits) if len(digits) == 5 and digits.isdigit() else None
+
+
+class Gazetteer:
+    def __init__(self, path: str = GAZETTEER_PATH):
+        self.path = path
+        self._loaded = False
+        self._mmap = None
+        self.zip_hits = 0
+        self.city_hits = 0
+        self.misses = 0
+
+    def _load(self):
+        self._loaded = True
+        if not os.path.exists(self.path):
+            logger.info(f"No gazetteer file at {self.path}; ZIP/city lookups will use the geocoder")
+            return
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_zip, n_city = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            logger.error(f"Unsupported gazetteer file {self.path}")
+            self._mmap.close()
+            self._mmap = None
+            return
+
+        view = memoryview(self._mmap)
+        offset = _HEADER.size
+        self._zip_keys = view[offset:offset + 4 * n_zip].cast("I")
+        offset += 4 * n_zip
+        self._zip_lat = view[offset:offset + 4 * n_zip].cast("f")
+        offset += 4 * n_zip
+        self._zip_lng = view[offset:offset + 4 * n_zip].cast("f")
+        offset += 4 * n_zip
+        offset += -offset % 8
+        self._city_keys = view[offset:offset + 8 * n_city].cast("Q")
+        offset += 8 * n_city
+        self._city_lat = view[offset:offset + 4 * n_city].cast("f")
+        offset += 4 * n_city
+        self._city_lng = view[offset:offset + 4 * n_city].cast("f")
+        logger.info(f"Loaded gazetteer: {n_zip} ZIPs, {n_city} cities")
+
+    @property
+    def available(self) -> bool:
+        if not self._loaded:
+            self._load()
+        return self._mmap is not None
+
+    @staticmethod
+    def _find(keys, key) -> int:
+        i = bisect_left(keys, key)
+        return i if i < len(keys) and keys[i] == key else -1
+
+    def lookup(
+        self,
+        city: Optional[str] = None,
+        zipcode: Optional[str] = None,
+        state: Optional[str] = None
+    ) -> Optional[GazetteerHit]:
+        """
+        Return the ZIP centroid if the ZIP is known, else the city centroid.
+
+        City-only names that exist in several states are only answered when a
+        state is given, so an ambiguous "Springfield" falls through to the
+        geocoder instead of landing in the wrong state.
+        """
+        if not self.available:
+            return None
+        if zipcode:
+            key = _normalize_zip(zipcode)
+            i = self._find(self._zip_keys, key) if key is not None else -1
+            if i >= 0:
+                self.zip_hits += 1
+                return GazetteerHit(round(self._zip_lat[i], 5), round(self._zip_lng[i], 5), "zip")
+        if city:
+            i = self._find(self._city_keys, _city_hash(normalize_city(city, state)))
+            if i >= 0:
+                self.city_hits += 1
+                return GazetteerHit(round(self._city_lat[i], 5), round(self._city_lng[i], 5), "city")
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "available": self.available,
+            "zipHits": self.zip_hits,
+            "cityHits": self.city_hits,
+            "misses": self.misses,
+        }
+
+
+gazetteer = Gazetteer()
+
+
+def _read_census_file(path: str):
+    with open(path, encoding="latin-1") as f:
+        header = [h.strip() for h in f.readline().split("\t")]
+        for line in f:
+            yield dict(zip(header, (v.strip() for v in line.split("\t"))))
+
+
+def build(zcta_path: Optional[str], places_path: Optional[str], out_path: str = GAZETTEER_PATH) -> tuple:
+    """Write the binary gazetteer from Census ZCTA and place gazetteer files"""
+    zips = {}
+    if zcta_path:
+        for row in _read_census_file(zcta_path):
+            key = _normalize_zip(row["GEOID"])
+            if key is not None:
+                zips[key] = (float(row["INTPTLAT"]), float(row["INTPTLONG"]))
+
+    cities = {}
+    if places_path:
+        by_name = {}
+        for row in _read_census_file(places_path):
+            name = _PLACE_SUFFIX.sub("", row["NAME"].lower())
+            coords = (float(row["INTPTLAT"]), float(row["INTPTLONG"]))
+            cities[_city_hash(normalize_city(name, row["USPS"]))] = coords
+            by_name.setdefault(normalize_city(name), set()).add(row["USPS"])
+        # City names without a state are only stored when unique nationwide
+        for row in _read_census_file(places_path):
+            name = normalize_city(_PLACE_SUFFIX.sub("", row["NAME"].lower()))
+            if len(by_name[name]) == 1:
+                cities[_city_hash(name)] = (float(row["INTPTLAT"]), float(row["INTPTLONG"]))
+
+    zip_keys = sorted(zips)
+    city_keys = sorted(cities)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(zip_keys), len(city_keys)))
+        f.write(array("I", zip_keys).tobytes())
+        f.write(array("f", (zips[k][0] for k in zip_keys)).tobytes())
+        f.write(array("f", (zips[k][1] for k in zip_keys)).tobytes())
+        f.write(b"\0" * (-f.tell() % 8))
+        f.write(array("Q", city_keys).tobytes())
+        f.write(array("f", (cities[k][0] for k in city_keys)).tobytes())
+        f.write(array("f", (cities[k][1] for k in city_keys)).tobytes())
+    os.replace(tmp_path, out_path)
+    return len(zip_keys), len(city_keys)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the offline ZIP/city gazetteer")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build")
+    build_cmd.add_argument("--zcta", help="Census ZCTA gazetteer file (e.g. 2020_Gaz_zcta_national.txt)")
+    build_cmd.add_argument("--places", help="Census places gazetteer file (e.g. 2020_Gaz_place_national.txt)")
+    build_cmd.add_argument("--out", default=GAZETTEER_PATH)
+    lookup_cmd = sub.add_parser("lookup")
+    lookup_cmd.add_argument("--city")
+    lookup_cmd.add_argument("--zip")
+    lookup_cmd.add_argument("--state")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        n_zip, n_city = build(args.zcta, args.places, args.out)
+        print(f"Wrote {args.out}: {n_zip} ZIPs, {n_city} city keys")
+    else:
+        print(gazetteer.lookup(city=args.city, zipcode=args.zip, state=args.state))
@@ -0,0 +1,17 @@
+"""
+Geometry helpers used when distances are computed in Python instead of PostGIS.
+"""
+import math
+
+METERS_PER_MILE = 1609.34
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def haversine_meters(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in meters"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
@@ -0,0 +1,180 @@
+"""
+Backfill coordinates for addresses that were never geocoded.
+
+Scans CompanyAddress and HomeAddress for rows with NULL latitude, geocodes
+them with the batch engine (deduplicated, cache-aware, rate limited) and
+writes the results back with one bulk UPDATE per batch. Progress is
+checkpointed after every batch, so an interrupted run picks up where it
+stopped. Rows that fail to geocode are kept in the checkpoint and retried
+first on the next run.
+
+Usage:
+    python geocode_backfill.py                      # both tables
+    python geocode_backfill.py --table home --rate 10 --concurrency 16
+    python geocode_backfill.py --reset              # ignore the checkpoint
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+import geocoding  # noqa: E402
+from database import db  # noqa: E402
+from rate_limit import create_rate_limiter  # noqa: E402
+
+TABLES = {
+    "company": "CompanyAddress",
+    "home": "HomeAddress",
+}
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(__file__), "geocode_backfill.checkpoint.json")
+
+
+def load_checkpoint(path: str) -> dict:
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+async def write_coordinates(table: str, rows: list):
+    """Bulk-update (id, lat, lng) rows in a single statement"""
+    if not rows:
+        return
+    values = []
+    params = []
+    for i, (address_id, lat, lng) in enumerate(rows):
+        values.append(f"(${3 * i + 1}::int, ${3 * i + 2}::double precision, ${3 * i + 3}::double precision)")
+        params.extend([address_id, lat, lng])
+    await db.execute_raw(
+        f'''
+        UPDATE "{table}" AS a
+        SET latitude = v.lat, longitude = v.lng
+        FROM (VALUES {", ".join(values)}) AS v(id, lat, lng)
+        WHERE a.id = v.id
+          AND a.latitude IS NULL
+        ''',
+        *params
+    )
+
+
+async def geocode_rows(table: str, rows: list, concurrency: int) -> list:
+    """Geocode and store one batch; returns the ids that failed"""
+    results = await geocoding.geocode_addresses_batch(rows, concurrency=concurrency)
+    updates = [
+        (row["id"], result.latitude, result.longitude)
+        for row, result in zip(rows, results)
+        if result
+    ]
+    await write_coordinates(table, updates)
+    return [row["id"] for row, result in zip(rows, results) if not result]
+
+
+async def retry_failed(table: str, state: dict, checkpoint: dict, checkpoint_path: str, batch_size: int, concurrency: int):
+    """Retry the rows earlier runs could not geocode"""
+    failed_ids = state["failedIds"]
+    still_failed = []
+    for start in range(0, len(failed_ids), batch_size):
+        batch = failed_ids[start:start + batch_size]
+        placeholders = ", ".join(f"${i + 1}::int" for i in range(len(batch)))
+        # Rows geocoded or deleted since then drop out here
+        rows = await db.query_raw(
+            f'''
+            SELECT id, street, city, zipcode
+            FROM "{table}"
+            WHERE latitude IS NULL
+              AND id IN ({placeholders})
+            ORDER BY id
+            ''',
+            *batch
+        )
+        if rows:
+            failed = await geocode_rows(table, rows, concurrency)
+            state["geocoded"] += len(rows) - len(failed)
+            still_failed += failed
+        state["failedIds"] = still_failed + failed_ids[start + batch_size:]
+        state["failed"] = len(state["failedIds"])
+        save_checkpoint(checkpoint_path, checkpoint)
+    if failed_ids:
+        print(f"[{table}] retried {len(failed_ids)} failed rows: {len(still_failed)} still failing")
+
+
+async def backfill_table(key: str, checkpoint: dict, checkpoint_path: str, batch_size: int, concurrency: int):
+    table = TABLES[key]
+    state = checkpoint.setdefault(key, {"lastId": 0, "geocoded": 0, "failed": 0})
+    state.setdefault("failedIds", [])
+    await retry_failed(table, state, checkpoint, checkpoint_path, batch_size, concurrency)
+    started = time.perf_counter()
+    scanned = 0
+    while True:
+        rows = await db.query_raw(
+            f'''
+            SELECT id, street, city, zipcode
+            FROM "{table}"
+            WHERE latitude IS NULL
+              AND id > $1
+            ORDER BY id
+            LIMIT $2
+            ''',
+            state["lastId"], batch_size
+        )
+        if not rows:
+            break
+
+        failed = await geocode_rows(table, rows, concurrency)
+
+        scanned += len(rows)
+        # lastId moves past failures too; they are retried from failedIds
+        state["lastId"] = rows[-1]["id"]
+        state["geocoded"] += len(rows) - len(failed)
+        state["failedIds"] += failed
+        state["failed"] = len(state["failedIds"])
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        elapsed = time.perf_counter() - started
+        print(
+            f"[{table}] through id {state['lastId']}: {state['geocoded']} geocoded, "
+            f"{state['failed']} failed ({scanned / elapsed:.1f} rows/s)"
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Geocode addresses that are missing coordinates")
+    parser.add_argument("--table", choices=["company", "home", "all"], default="all")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=geocoding.GEOCODER_CONCURRENCY)
+    parser.add_argument("--rate", type=float, help="Requests/second for the geocoder (default: GEOCODER_RATE)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--reset", action="store_true", help="Start over instead of resuming")
+    args = parser.parse_args()
+
+    if args.rate is not None:
+        geocoding.rate_limiter = create_rate_limiter(rate=args.rate, burst=max(1, int(args.rate)))
+
+    checkpoint = {} if args.reset else load_checkpoint(args.checkpoint)
+    keys = list(TABLES) if args.table == "all" else [args.table]
+
+    await db.connect()
+    await geocoding.geocoder.start()
+    try:
+        for key in keys:
+            await backfill_table(key, checkpoint, args.checkpoint, args.batch_size, args.concurrency)
+    finally:
+        await geocoding.geocoder.close()
+        await db.disconnect()
+    print(f"Done. Geocoder stats: {geocoding.geocoder.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+"""
+Persistent cache in front of the geocoder.
+
+Results are stored in a local SQLite file keyed by a normalized address
+string, so "1600 Amphitheatre Pkwy" and "1600 amphitheatre parkway" share
+one entry. Successful lookups live for GEOCODE_CACHE_TTL_DAYS; addresses
+the geocoder could not resolve are cached for the much shorter
+GEOCODE_NEGATIVE_TTL_HOURS so they get retried later.
+
+Warm the cache from addresses that already have coordinates:
+    python geocode_cache.py warm
+"""
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+GEOCODE_CACHE_PATH = os.getenv(
+    "GEOCODE_CACHE_PATH",
+    os.path.join(os.path.dirname(__file__), "geocode_cache.sqlite3")
+)
+GEOCODE_CACHE_TTL_DAYS = float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "90"))
+GEOCODE_NEGATIVE_TTL_HOURS = float(os.getenv("GEOCODE_NEGATIVE_TTL_HOURS", "6"))
+
+# Street suffix / direction abbreviations expanded before keying
+_STREET_ABBREVIATIONS = {
+    "st": "street",
+    "ave": "avenue",
+    "av": "avenue",
+    "blvd": "boulevard",
+    "rd": "road",
+    "dr": "drive",
+    "ln": "lane",
+    "ct": "court",
+    "pl": "place",
+    "pkwy": "parkway",
+    "pky": "parkway",
+    "hwy": "highway",
+    "expy": "expressway",
+    "fwy": "freeway",
+    "cir": "circle",
+    "ter": "terrace",
+    "sq": "square",
+    "trl": "trail",
+    "ste": "suite",
+    "apt": "apartment",
+    "fl": "floor",
+    "n": "north",
+    "s": "south",
+    "e": "east",
+    "w": "west",
+    "ne": "northeast",
+    "nw": "northwest",
+    "se": "southeast",
+    "sw": "southwest",
+}
+
+_COUNTRY_ALIASES = {
+    "us": "usa",
+    "united states": "usa",
+    "united states of america": "usa",
+}
+
+
+def _clean(value: Optional[str]) -> str:
+    if not value:
+        return ""
+    value = value.lower().replace("#", " ")
+    value = re.sub(r"[.,;]", " ", value)
+    return " ".join(value.split())
+
+
+def normalize_address(
+    street: Optional[str] = None,
+    city: Optional[str] = None,
+    zipcode: Optional[str] = None,
+    country: str = "USA"
+) -> str:
+    """
+    Build the cache key for an address.
+
+    Case, punctuation and whitespace are ignored and common street
+    abbreviations (St, Ave, Pkwy, N, ...) are expanded. Abbreviations are only
+    expanded in the street part so cities like "St Louis" keep their name.
+
+    Example:
+        >>> normalize_address("1600 Amphitheatre Pkwy", "Mountain View", "94043")
+        '1600 amphitheatre parkway|mountain view|94043|usa'
+    """
+    street_words = [_STREET_ABBREVIATIONS.get(w, w) for w in _clean(street).split()]
+    zipcode = _clean(zipcode).replace(" ", "")
+    # ZIP+4 -> 5-digit ZIP
+    if re.fullmatch(r"\d{5}-?\d{4}", zipcode):
+        zipcode = zipcode[:5]
+    country = _clean(country)
+    country = _COUNTRY_ALIASES.get(country, country)
+    return "|".join([" ".join(street_words), _clean(city), zipcode, country])
+
+
+class GeocodeCache:
+    """SQLite-backed geocode cache with TTLs and hit-rate counters"""
+
+    def __init__(
+        self,
+        path: str = GEOCODE_CACHE_PATH,
+        ttl_seconds: float = GEOCODE_CACHE_TTL_DAYS * 86400,
+        negative_ttl_seconds: float = GEOCODE_NEGATIVE_TTL_HOURS * 3600,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # WAL lets several API workers share the file
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS geocode_cache (
+                    key TEXT PRIMARY KEY,
+                    latitude REAL,
+                    longitude REAL,
+                    expires_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn = conn
+        return self._conn
+
+    def _get_sync(self, key: str):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT latitude, longitude, expires_at FROM geocode_cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+        if row is None or row[2] <= time.time():
+            return False, None
+        if row[0] is None or row[1] is None:
+            return True, None
+        return True, (row[0], row[1])
+
+    def _put_many_sync(self, entries: list):
+        now = time.time()
+        rows = []
+        for key, coords in entries:
+            ttl = self.ttl_seconds if coords else self.negative_ttl_seconds
+            lat, lng = coords if coords else (None, None)
+            rows.append((key, lat, lng, now + ttl, now))
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            conn.executemany(
+                """
+                INSERT INTO geocode_cache (key, latitude, longitude, expires_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    latitude = excluded.latitude,
+                    longitude = excluded.longitude,
+                    expires_at = excluded.expires_at,
+                    updated_at = excluded.updated_at
+                """,
+                rows
+            )
+            conn.execute("COMMIT")
+
+    def _purge_expired_sync(self) -> int:
+        with self._lock:
+            cur = self._connection().execute(
+                "DELETE FROM geocode_cache WHERE expires_at <= ?", (time.time(),)
+            )
+            return cur.rowcount
+
+    def _size_sync(self) -> int:
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM geocode_cache").fetchone()[0]
+
+    async def get(self, key: str) -> Tuple[bool, Optional[Tuple[float, float]]]:
+        """
+        Look up a normalized address.
+
+        Returns:
+            (found, coords) - found is True for both positive and negative
+            entries; coords is None for a cached failure
+        """
+        found, coords = await asyncio.to_thread(self._get_sync, key)
+        if not found:
+            self.misses += 1
+        elif coords is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return found, coords
+
+    async def put(self, key: str, coords: Optional[Tuple[float, float]]):
+        """Store a result; None records a failed lookup with the negative TTL"""
+        await self.put_many([(key, coords)])
+
+    async def put_many(self, entries: list):
+        if not entries:
+            return
+        await asyncio.to_thread(self._put_many_sync, entries)
+        self.writes += len(entries)
+
+    async def purge_expired(self) -> int:
+        return await asyncio.to_thread(self._purge_expired_sync)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "hits": self.hits,
+            "negativeHits": self.negative_hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hitRate": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0,
+        }
+
+
+geocode_cache = GeocodeCache()
+
+
+async def warm_from_database(batch_size: int = 500) -> int:
+    """Preload the cache from CompanyAddress/HomeAddress rows that have coordinates"""
+    from database import db
+
+    await db.connect()
+    total = 0
+    try:
+        for table in ("CompanyAddress", "HomeAddress"):
+            last_id = 0
+            while True:
+                rows = await db.query_raw(
+                    f'''
+                    SELECT id, street, city, zipcode, latitude, longitude
+                    FROM "{table}"
+                    WHERE latitude IS NOT NULL
+                      AND longitude IS NOT NULL
+                      AND id > $1
+                    ORDER BY id
+                    LIMIT $2
+                    ''',
+                    last_id, batch_size
+                )
+                if not rows:
+                    break
+                entries = [
+                    (
+                        normalize_address(r["street"], r["city"], r["zipcode"]),
+                        (r["latitude"], r["longitude"])
+                    )
+                    for r in rows
+                    if r["street"] or r["city"] or r["zipcode"]
+                ]
+                await geocode_cache.put_many(entries)
+                total += len(entries)
+                last_id = rows[-1]["id"]
+    finally:
+        await db.disconnect()
+    return total
+
+
+if __name__ == "__main__":
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "warm":
+        count = asyncio.run(warm_from_database())
+        print(f"Warmed geocode cache with {count} addresses")
+    elif command == "purge":
+        print(f"Removed {asyncio.run(geocode_cache.purge_expired())} expired entries")
+    elif command == "stats":
+        print(f"{geocode_cache._size_sync()} entries in {geocode_cache.path}")
+    else:
+        print("Usage: python geocode_cache.py [warm|purge|stats]")
+        sys.exit(1)
@@ -0,0 +1,252 @@
+"""
+Background geocoding worker.
+
+Signup stores addresses with NULL coordinates and queues one GeocodeJob per
+address. The worker claims due jobs with FOR UPDATE SKIP LOCKED (so several
+API processes or standalone workers never grab the same job), geocodes the
+address and writes latitude/longitude back. The update_location_from_coords
+trigger then fills the PostGIS "location" column.
+
+The API runs a worker in-process when GEOCODE_WORKER_ENABLED is true (the
+default). It can also run on its own:
+    python geocode_worker.py
+"""
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from database import db
+from geocoding import geocode_address
+from spatial_index import spatial_indexes
+
+logger = logging.getLogger(__name__)
+
+GEOCODE_WORKER_ENABLED = os.getenv("GEOCODE_WORKER_ENABLED", "true").lower() == "true"
+GEOCODE_WORKER_POLL_SECONDS = float(os.getenv("GEOCODE_WORKER_POLL_SECONDS", "5"))
+GEOCODE_WORKER_BATCH = int(os.getenv("GEOCODE_WORKER_BATCH", "5"))
+GEOCODE_JOB_MAX_ATTEMPTS = int(os.getenv("GEOCODE_JOB_MAX_ATTEMPTS", "5"))
+# Jobs stuck in "running" this long (e.g. the worker crashed) are claimed again
+GEOCODE_JOB_STALE_MINUTES = int(os.getenv("GEOCODE_JOB_STALE_MINUTES", "10"))
+
+_ADDRESS_TABLES = {
+    "company": "companyaddress",
+    "home": "homeaddress",
+}
+
+
+async def enqueue_geocode_jobs(user) -> int:
+    """Queue a geocoding job for each address of a newly created user"""
+    jobs = []
+    if user.companyAddress:
+        jobs.append({"userId": user.id, "addressType": "company", "addressId": user.companyAddress.id})
+    if user.homeAddress:
+        jobs.append({"userId": user.id, "addressType": "home", "addressId": user.homeAddress.id})
+    if jobs:
+        await db.geocodejob.create_many(data=jobs)
+        geocode_worker.wake()
+    return len(jobs)
+
+
+async def geocoding_status(user_id: int) -> dict:
+    """
+    Summarize geocoding progress for a user.
+
+    Overall status is "complete" once every address has coordinates,
+    "pending" while jobs are queued or running, "failed" if a job gave up,
+    and "none" when the user has no addresses.
+    """
+    user = await db.user.find_unique(
+        where={"id": user_id},
+        include={"companyAddress": True, "homeAddress": True, "geocodeJobs": True}
+    )
+    if not user:
+        return {"status": "none", "addresses": {}}
+
+    latest_jobs = {}
+    for job in sorted(user.geocodeJobs, key=lambda j: j.id):
+        latest_jobs[job.addressType] = job
+
+    addresses = {}
+    for address_type, address in (("company", user.companyAddress), ("home", user.homeAddress)):
+        if not address:
+            continue
+        if address.latitude is not None and address.longitude is not None:
+            addresses[address_type] = "complete"
+        elif address_type in latest_jobs:
+            job_status = latest_jobs[address_type].status
+            addresses[address_type] = "failed" if job_status == "failed" else "pending"
+        else:
+            addresses[address_type] = "failed"
+
+    if not addresses:
+        status = "none"
+    elif all(s == "complete" for s in addresses.values()):
+        status = "complete"
+    elif any(s == "pending" for s in addresses.values()):
+        status = "pending"
+    else:
+        status = "failed"
+    return {
+        "status": status,
+        "addresses": addresses,
+        "spatialSearchReady": addresses.get("company") == "complete" or addresses.get("home") == "complete"
+    }
+
+
+class GeocodeWorker:
+    def __init__(self, batch_size: int = GEOCODE_WORKER_BATCH, poll_seconds: float = GEOCODE_WORKER_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def wake(self):
+        """Process newly queued jobs now instead of at the next poll"""
+        self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logger.error(f"Geocode worker error: {e}")
+                processed = 0
+            if processed:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim_jobs(self) -> list:
+        return await db.query_raw(
+            '''
+            UPDATE "GeocodeJob"
+            SET status = 'running', attempts = attempts + 1, "updatedAt" = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT id FROM "GeocodeJob"
+                WHERE (status = 'pending' AND "runAfter" <= CURRENT_TIMESTAMP)
+                   OR (status = 'running' AND "updatedAt" < CURRENT_TIMESTAMP - make_interval(mins => $2))
+                ORDER BY id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, "userId", "addressType", "addressId", attempts
+            ''',
+            self.batch_size, GEOCODE_JOB_STALE_MINUTES
+        )
+
+    async def run_once(self) -> int:
+        """Claim and process one batch of due jobs; returns how many were claimed"""
+        jobs = await self.claim_jobs()
+        for job in jobs:
+            await self._process(job)
+        return len(jobs)
+
+    async def _process(self, job: dict):
+        table = getattr(db, _ADDRESS_TABLES[job["addressType"]])
+        address = await table.find_unique(where={"id": job["addressId"]})
+        if not address:
+            # Address was removed since the job was queued
+            await db.geocodejob.update(where={"id": job["id"]}, data={"status": "done"})
+            return
+
+        coords = await geocode_address(
+            street=address.street,
+            city=address.city,
+            zipcode=address.zipcode
+        )
+        if coords:
+            await table.update(
+                where={"id": address.id},
+                data={"latitude": coords[0], "longitude": coords[1]}
+            )
+            spatial_indexes.get(job["addressType"]).upsert(job["userId"], coords[0], coords[1])
+            await db.geocodejob.update(where={"id": job["id"]}, data={"status": "done", "lastError": None})
+            self.completed += 1
+            return
+
+        if job["attempts"] >= GEOCODE_JOB_MAX_ATTEMPTS:
+            await db.geocodejob.update(
+                where={"id": job["id"]},
+                data={"status": "failed", "lastError": "Address could not be geocoded"}
+            )
+            self.failed += 1
+            return
+
+        # Back off exponentially before the next attempt
+        await db.execute_raw(
+            '''
+            UPDATE "GeocodeJob"
+            SET status = 'pending',
+                "lastError" = 'Address could not be geocoded',
+                "runAfter" = CURRENT_TIMESTAMP + make_interval(secs => $2),
+                "updatedAt" = CURRENT_TIMESTAMP
+            WHERE id = $1
+            ''',
+            job["id"], float(60 * 2 ** (job["attempts"] - 1))
+        )
+        self.retried += 1
+
+    async def queue_stats(self) -> dict:
+        rows = await db.query_raw(
+            '''
+            SELECT status, COUNT(*)::int AS count
+            FROM "GeocodeJob"
+            GROUP BY status
+            '''
+        )
+        return {r["status"]: r["count"] for r in rows}
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+        }
+
+
+geocode_worker = GeocodeWorker()
+
+
+async def _main():
+    await db.connect()
+    try:
+        geocode_worker.start()
+        await asyncio.Event().wait()
+    finally:
+        await geocode_worker.stop()
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_main())
+    except KeyboardInterrupt:
+        pass
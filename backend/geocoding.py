@@ -1,18 +1,183 @@
 """
 Geocoding utility for converting addresses to coordinates.
 Uses OpenStreetMap Nominatim API (free, no API key required).
+Results are cached persistently (see geocode_cache.py), and ZIP/city-only
+addresses are answered from the offline gazetteer (see gazetteer.py).
 """
 
 import httpx
 import asyncio
-from typing import Optional, Tuple
+import os
+import time
+from typing import NamedTuple, Optional, Tuple
 import logging
 
+from geocode_cache import geocode_cache, normalize_address
+from gazetteer import gazetteer
+from rate_limit import RateLimitTimeout, create_rate_limiter
+from singleflight import SingleFlight
+
 logger = logging.getLogger(__name__)
 
-# Rate limiting: Nominatim requires max 1 request per second
-_last_request_time = 0
-_rate_limit_lock = asyncio.Lock()
+# Geocoder backend: public Nominatim by default, or a self-hosted instance
+GEOCODER_URL = os.getenv("GEOCODER_URL", "https://nominatim.openstreetmap.org/search")
+GEOCODER_USER_AGENT = os.getenv(
+    "GEOCODER_USER_AGENT",
+    # Nominatim requires a User-Agent identifying your app
+    "CarpoolConnectApp/1.0 (https://carpoolconnect.netlify.app)"
+)
+GEOCODER_TIMEOUT = float(os.getenv("GEOCODER_TIMEOUT", "10"))
+GEOCODER_CONNECT_TIMEOUT = float(os.getenv("GEOCODER_CONNECT_TIMEOUT", "5"))
+GEOCODER_HTTP2 = os.getenv("GEOCODER_HTTP2", "false").lower() == "true"
+GEOCODER_MAX_RETRIES = int(os.getenv("GEOCODER_MAX_RETRIES", "2"))
+GEOCODER_BACKOFF_SECONDS = float(os.getenv("GEOCODER_BACKOFF_SECONDS", "1.0"))
+
+# Rate limiting: the public Nominatim allows max 1 request per second.
+# GEOCODER_RATE / GEOCODER_RATE_LIMITER configure it (see rate_limit.py).
+rate_limiter = create_rate_limiter()
+
+# In-flight lookups per batch; only useful when GEOCODER_RATE allows it
+GEOCODER_CONCURRENCY = int(os.getenv("GEOCODER_CONCURRENCY", "4"))
+
+# Concurrent lookups of the same normalized address share one request
+geocode_flight = SingleFlight("geocode")
+
+
+class GeocoderClient:
+    """
+    Long-lived HTTP client for the geocoding backend.
+    
+    Keeps a keep-alive connection pool open for the lifetime of the app so
+    lookups skip DNS and TCP/TLS setup, retries 429/5xx responses with
+    exponential backoff, and records per-request latency.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        url: str = GEOCODER_URL,
+        timeout: float = GEOCODER_TIMEOUT,
+        connect_timeout: float = GEOCODER_CONNECT_TIMEOUT,
+        http2: bool = GEOCODER_HTTP2,
+        max_retries: int = GEOCODER_MAX_RETRIES,
+        backoff_seconds: float = GEOCODER_BACKOFF_SECONDS,
+    ):
+        self.url = url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http2 = http2
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._client: Optional[httpx.AsyncClient] = None
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    async def start(self):
+        if self._client is not None:
+            return
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("GEOCODER_HTTP2 is set but the 'h2' package is missing; using HTTP/1.1")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            http2=http2,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60),
+            headers={"User-Agent": GEOCODER_USER_AGENT},
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        delay = self.backoff_seconds * (2 ** attempt)
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            delay = max(delay, float(response.headers["Retry-After"]))
+        return delay
+
+    async def search(self, address: str) -> list:
+        """
+        Run a free-form search and return the decoded JSON results.
+        
+        Raises httpx errors once retries are exhausted.
+        """
+        await self.start()
+        attempt = 0
+        while True:
+            await rate_limiter.acquire()
+            started = time.perf_counter()
+            response = None
+            try:
+                response = await self._client.get(
+                    self.url,
+                    params={
+                        "q": address,
+                        "format": "json",
+                        "limit": 1,
+                        "addressdetails": 0
+                    }
+                )
+                if response.status_code not in self.RETRY_STATUSES:
+                    if response.is_error:
+                        self.errors += 1
+                    response.raise_for_status()
+                    return response.json()
+                error = httpx.HTTPStatusError(
+                    f"Geocoder returned {response.status_code}",
+                    request=response.request,
+                    response=response,
+                )
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error = e
+            finally:
+                self._record(time.perf_counter() - started)
+            
+            if attempt >= self.max_retries:
+                self.errors += 1
+                raise error
+            delay = self._retry_delay(attempt, response)
+            logger.warning(f"Geocoder request failed ({error}); retrying in {delay:.1f}s")
+            self.retries += 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _record(self, seconds: float):
+        self.requests += 1
+        self._latency_total += seconds
+        self._latency_max = max(self._latency_max, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "http2": self.http2,
+            "avgLatencyMs": round(self._latency_total / self.requests * 1000, 1) if self.requests else 0.0,
+            "maxLatencyMs": round(self._latency_max * 1000, 1),
+            "totalLatencyMs": round(self._latency_total * 1000, 1),
+        }
+
+
+geocoder = GeocoderClient()
+
+
+class GeocodeResult(NamedTuple):
+    latitude: float
+    longitude: float
+    precision: str  # "street", "zip" or "city"
+
+
+def _is_usa(country: Optional[str]) -> bool:
+    return (country or "").strip().lower() in ("usa", "us", "united states", "united states of america")
+
 
 async def geocode_address(
     street: Optional[str] = None,
@@ -24,6 +189,8 @@ async def geocode_address(
     Convert an address to latitude/longitude coordinates.
     
     Uses OpenStreetMap Nominatim API which is free but rate-limited to 1 req/sec.
+    Cached results (including recent failures) are returned without a request.
+    See geocode_address_detailed for the precision of the result.
     
     Args:
         street: Street address (e.g., "123 Main St")
@@ -38,7 +205,33 @@ async def geocode_address(
         >>> coords = await geocode_address(city="Mountain View", zipcode="94043")
         >>> print(coords)  # (37.3861, -122.0839)
     """
-    global _last_request_time
+    result = await geocode_address_detailed(street, city, zipcode, country)
+    return (result.latitude, result.longitude) if result else None
+
+
+async def geocode_address_detailed(
+    street: Optional[str] = None,
+    city: Optional[str] = None,
+    zipcode: Optional[str] = None,
+    country: str = "USA"
+) -> Optional[GeocodeResult]:
+    """
+    Geocode an address and report how precise the coordinates are.
+    
+    ZIP-only and city-only US addresses are answered from the offline
+    gazetteer without a network call. Street addresses go to Nominatim; if
+    that fails, the ZIP/city centroid is used so the user still gets
+    approximate coordinates.
+    
+    Returns:
+        GeocodeResult(latitude, longitude, precision) or None
+    """
+    if _is_usa(country):
+        local = gazetteer.lookup(city=city, zipcode=zipcode) if (city or zipcode) else None
+        if local and not street:
+            return GeocodeResult(local.latitude, local.longitude, local.precision)
+    else:
+        local = None
     
     # Build address components (skip empty values)
     parts = [p for p in [street, city, zipcode, country] if p]
@@ -46,72 +239,96 @@ async def geocode_address(
         return None
     
     address = ", ".join(parts)
+    cache_key = normalize_address(street, city, zipcode, country)
     
-    # Rate limiting - ensure at least 1 second between requests
-    async with _rate_limit_lock:
-        import time
-        current_time = time.time()
-        time_since_last = current_time - _last_request_time
-        if time_since_last < 1.0:
-            await asyncio.sleep(1.0 - time_since_last)
-        _last_request_time = time.time()
+    coords = await geocode_flight.do(cache_key, lambda: _cached_lookup(cache_key, address))
+    
+    if coords:
+        precision = "street" if street else ("zip" if zipcode else "city")
+        return GeocodeResult(coords[0], coords[1], precision)
+    if local:
+        return GeocodeResult(local.latitude, local.longitude, local.precision)
+    return None
+
+
+async def _cached_lookup(cache_key: str, address: str) -> Optional[Tuple[float, float]]:
+    """Answer from the cache, or query Nominatim and remember the result"""
+    found, coords = await geocode_cache.get(cache_key)
+    if not found:
+        coords, cacheable = await _query_nominatim(address)
+        if cacheable:
+            await geocode_cache.put(cache_key, coords)
+    return coords
+
+
+async def _query_nominatim(address: str) -> Tuple[Optional[Tuple[float, float]], bool]:
+    """
+    Look up one address with the shared geocoder client.
     
+    Returns:
+        (coords, cacheable) - cacheable is False for transient errors
+        (timeouts, HTTP errors) that should not be remembered
+    """
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(
-                "https://nominatim.openstreetmap.org/search",
-                params={
-                    "q": address,
-                    "format": "json",
-                    "limit": 1,
-                    "addressdetails": 0
-                },
-                headers={
-                    # Nominatim requires a User-Agent identifying your app
-                    "User-Agent": "CarpoolConnectApp/1.0 (https://carpoolconnect.netlify.app)"
-                }
-            )
-            response.raise_for_status()
-            data = response.json()
-            
-            if data and len(data) > 0:
-                lat = float(data[0]["lat"])
-                lon = float(data[0]["lon"])
-                logger.info(f"Geocoded '{address}' -> ({lat}, {lon})")
-                return (lat, lon)
-            else:
-                logger.warning(f"No results found for address: {address}")
-                return None
+        data = await geocoder.search(address)
+        if data and len(data) > 0:
+            lat = float(data[0]["lat"])
+            lon = float(data[0]["lon"])
+            logger.info(f"Geocoded '{address}' -> ({lat}, {lon})")
+            return (lat, lon), True
+        else:
+            logger.warning(f"No results found for address: {address}")
+            return None, True
                 
+    except RateLimitTimeout as e:
+        logger.warning(f"Rate limit queue full, skipping geocode of {address}: {e}")
+        return None, False
     except httpx.TimeoutException:
         logger.error(f"Timeout geocoding address: {address}")
-        return None
+        return None, False
     except httpx.HTTPError as e:
         logger.error(f"HTTP error geocoding address: {address} - {e}")
-        return None
+        return None, False
     except (KeyError, ValueError, IndexError) as e:
         logger.error(f"Error parsing geocoding response for {address}: {e}")
-        return None
+        return None, True
 
 
 async def geocode_addresses_batch(
-    addresses: list[dict]
-) -> list[Optional[Tuple[float, float]]]:
+    addresses: list[dict],
+    concurrency: int = GEOCODER_CONCURRENCY
+) -> list[Optional[GeocodeResult]]:
     """
-    Geocode multiple addresses sequentially (respecting rate limits).
+    Geocode many addresses at once (respecting rate limits).
+    
+    Identical addresses (after normalization) are looked up once, cache and
+    gazetteer hits return without a network call, and the remaining lookups
+    run concurrently behind the shared token bucket.
     
     Args:
         addresses: List of dicts with keys: street, city, zipcode
+        concurrency: Max lookups in flight at once
     
     Returns:
-        List of (lat, lng) tuples or None for each address
+        List of GeocodeResult (or None) aligned with the input
     """
-    results = []
+    unique = {}
+    keys = []
     for addr in addresses:
-        result = await geocode_address(
-            street=addr.get("street"),
-            city=addr.get("city"),
-            zipcode=addr.get("zipcode")
-        )
-        results.append(result)
-    return results
+        key = normalize_address(addr.get("street"), addr.get("city"), addr.get("zipcode"))
+        keys.append(key)
+        unique.setdefault(key, addr)
+    
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def lookup(addr):
+        async with semaphore:
+            return await geocode_address_detailed(
+                street=addr.get("street"),
+                city=addr.get("city"),
+                zipcode=addr.get("zipcode")
+            )
+    
+    results = await asyncio.gather(*(lookup(addr) for addr in unique.values()))
+    by_key = dict(zip(unique.keys(), results))
+    return [by_key[key] for key in keys]
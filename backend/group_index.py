@@ -0,0 +1,104 @@
+"""
+In-process index of open carpool groups for /groups/open without PostGIS.
+
+Keeps every OPEN, not-full group's route endpoints in NumPy arrays, so the
+"on the way" filter is one vectorized point-to-segment pass over all of
+them (routing.segment_distances) instead of a string match over a handful
+of arbitrary groups. The arrays are reloaded after group changes made by
+this process (invalidate()) and at least every OPEN_GROUP_CACHE_SECONDS to
+pick up changes made by others.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from database import db
+from routing import segment_distances
+
+logger = logging.getLogger(__name__)
+
+OPEN_GROUP_CACHE_SECONDS = float(os.getenv("OPEN_GROUP_CACHE_SECONDS", "60"))
+
+
+class OpenGroupIndex:
+    def __init__(self, ttl_seconds: float = OPEN_GROUP_CACHE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._ids = np.empty(0, dtype=np.int64)
+        self._drivers = np.empty(0, dtype=np.int64)
+        self._origins = np.empty((0, 2), dtype=np.float64)
+        self._dests = np.empty((0, 2), dtype=np.float64)
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self.loads = 0
+        self.queries = 0
+        self._query_seconds = 0.0
+
+    def invalidate(self):
+        """Reload before the next query (a group opened, filled, closed or moved)"""
+        self._loaded_at = None
+
+    def _fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+
+    async def _ensure_loaded(self):
+        if self._fresh():
+            return
+        async with self._lock:
+            if self._fresh():
+                return
+            rows = await db.query_raw(
+                '''
+                SELECT id, "driverId", "originLat", "originLng", "destLat", "destLng"
+                FROM "CarpoolGroup"
+                WHERE status = 'OPEN'
+                  AND "currentOccupancy" < "maxSeats"
+                  AND "originLat" IS NOT NULL AND "originLng" IS NOT NULL
+                  AND "destLat" IS NOT NULL AND "destLng" IS NOT NULL
+                '''
+            )
+            n = len(rows)
+            self._ids = np.fromiter((r["id"] for r in rows), dtype=np.int64, count=n)
+            self._drivers = np.fromiter((r["driverId"] for r in rows), dtype=np.int64, count=n)
+            self._origins = np.array([(r["originLat"], r["originLng"]) for r in rows], dtype=np.float64).reshape(n, 2)
+            self._dests = np.array([(r["destLat"], r["destLng"]) for r in rows], dtype=np.float64).reshape(n, 2)
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+
+    async def near_route(
+        self,
+        lat: float,
+        lng: float,
+        max_meters: float,
+        exclude_driver: Optional[int] = None,
+        limit: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """(group_id, meters off the origin->destination line) within max_meters, closest first"""
+        await self._ensure_loaded()
+        started = time.perf_counter()
+        distances = segment_distances((lat, lng), self._origins, self._dests)
+        keep = distances <= max_meters
+        if exclude_driver is not None:
+            keep &= self._drivers != exclude_driver
+        ids, distances = self._ids[keep], distances[keep]
+        order = np.lexsort((ids, distances))
+        if limit is not None:
+            order = order[:limit]
+        self.queries += 1
+        self._query_seconds += time.perf_counter() - started
+        return [(int(i), float(d)) for i, d in zip(ids[order], distances[order])]
+
+    def stats(self) -> dict:
+        return {
+            "groups": len(self._ids),
+            "loads": self.loads,
+            "queries": self.queries,
+            "avgQueryUs": round(self._query_seconds / self.queries * 1e6, 1) if self.queries else 0.0,
+            "ageSeconds": round(time.monotonic() - self._loaded_at) if self._loaded_at is not None else None,
+        }
+
+
+open_group_index = OpenGroupIndex()
@@ -0,0 +1,335 @@
+"""
+Batch assignment of unassigned passengers to open carpool groups.
+
+Matching through /groups/open is pull-only: each passenger picks a group on
+their own, so two neighbours can both ask for the last seat of one group
+while a group a mile further on goes empty. This job looks at every
+passenger who is in no group and has no pending request, and every OPEN
+group with free seats, and proposes the assignment with the least total
+detour, filling at most maxSeats - currentOccupancy seats per group.
+
+1. Pruning. Picking up p can only add D meters or less to a route of length
+   L if d(origin, p) + d(p, destination) <= L + D, an ellipse around the
+   origin -> destination line. Passengers are put in a SpatialIndex and
+   each group only looks at the box around its ellipse, so the job never
+   builds the dense passengers x groups matrix.
+2. Costs. The surviving pairs are priced with routing.join_costs against
+   the group's current pickups (best re-ordering included), and pairs
+   adding more than the detour cap are dropped.
+3. Assignment. Each group contributes one column per free seat, and each
+   passenger gets a private "unassigned" column costing more than any
+   allowed detour. scipy's min_weight_full_bipartite_matching (LAPJVsp)
+   solves the sparse min-cost assignment over that graph exactly.
+
+Detours are priced one passenger at a time, so two passengers proposed to
+the same group can add a little more together than the sum of their costs.
+Proposals are written as pending GroupRequest rows, the same as a
+passenger asking to join, and the group votes on them as usual.
+
+Usage:
+    python group_matcher.py --dry-run
+    python group_matcher.py --max-detour-miles 2
+"""
+import asyncio
+import math
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from database import db
+from geo import EARTH_RADIUS_METERS, METERS_PER_MILE
+from routing import join_costs, pairwise_meters
+from spatial_index import SpatialIndex
+
+GROUP_MATCH_MAX_DETOUR_MILES = float(os.getenv("GROUP_MATCH_MAX_DETOUR_MILES", "3"))
+# Rows per INSERT when writing proposals
+GROUP_MATCH_WRITE_BATCH = 500
+
+_METERS_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_METERS / 180
+
+
+async def load_passengers() -> Tuple[np.ndarray, np.ndarray]:
+    """(ids, (n, 2) home lat/lng) of geocoded passengers in no group and with no pending request"""
+    rows = await db.query_raw(
+        '''
+        SELECT u.id, ha.latitude AS lat, ha.longitude AS lng
+        FROM "User" u
+        JOIN "HomeAddress" ha ON ha."userId" = u.id
+        WHERE u.role = 'passenger'
+          AND ha.latitude IS NOT NULL
+          AND ha.longitude IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM "GroupMember" gm WHERE gm."userId" = u.id)
+          AND NOT EXISTS (
+              SELECT 1 FROM "GroupRequest" r WHERE r."userId" = u.id AND r.status = 'pending'
+          )
+        ORDER BY u.id
+        '''
+    )
+    ids = np.array([r["id"] for r in rows], dtype=np.int64)
+    coords = np.array([(r["lat"], r["lng"]) for r in rows], dtype=np.float64).reshape(-1, 2)
+    return ids, coords
+
+
+async def load_groups() -> List[dict]:
+    """OPEN groups with a route and free seats, each with its current route in pickup order"""
+    groups = await db.query_raw(
+        '''
+        SELECT g.id, g."currentOccupancy" AS occupancy,
+               g."maxSeats" - g."currentOccupancy" AS free_seats,
+               g."originLat", g."originLng", g."destLat", g."destLng"
+        FROM "CarpoolGroup" g
+        WHERE g.status = 'OPEN'
+          AND g."currentOccupancy" < g."maxSeats"
+          AND g."originLat" IS NOT NULL AND g."originLng" IS NOT NULL
+          AND g."destLat" IS NOT NULL AND g."destLng" IS NOT NULL
+        ORDER BY g.id
+        '''
+    )
+    pickups = await db.query_raw(
+        '''
+        SELECT gm."groupId", gm."pickupLat" AS lat, gm."pickupLng" AS lng
+        FROM "GroupMember" gm
+        JOIN "CarpoolGroup" g ON g.id = gm."groupId"
+        WHERE g.status = 'OPEN'
+          AND gm.role != 'driver'
+          AND gm."pickupLat" IS NOT NULL
+          AND gm."pickupLng" IS NOT NULL
+        ORDER BY gm."groupId", COALESCE(gm."pickupOrder", 0), gm.id
+        '''
+    )
+    # Same stop list as app._group_route
+    by_group = {}
+    for p in pickups:
+        by_group.setdefault(p["groupId"], []).append((p["lat"], p["lng"]))
+    for g in groups:
+        g["route"] = [
+            (g["originLat"], g["originLng"]),
+            *by_group.get(g["id"], []),
+            (g["destLat"], g["destLng"])
+        ]
+    return groups
+
+
+async def load_declined_pairs() -> dict:
+    """groupId -> userIds that already have a finished request there; never proposed again"""
+    rows = await db.query_raw(
+        '''
+        SELECT "groupId", "userId" FROM "GroupRequest" WHERE status != 'pending'
+        '''
+    )
+    declined = {}
+    for r in rows:
+        declined.setdefault(r["groupId"], set()).add(r["userId"])
+    return declined
+
+
+def candidate_edges(
+    passenger_ids: np.ndarray,
+    coords: np.ndarray,
+    groups: List[dict],
+    max_detour_meters: float,
+    skip: Optional[dict] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Every (passenger, group) pair whose pickup adds at most max_detour_meters,
+    except the user ids listed for a group id in skip.
+
+    Returns:
+        (passenger rows, group rows, added meters), indices into
+        passenger_ids/coords and groups
+    """
+    # Indexed by row, so query results are rows into passenger_ids
+    index = SpatialIndex("passengers")
+    index.load(zip(range(len(coords)), coords[:, 0].tolist(), coords[:, 1].tolist()))
+    skip = skip or {}
+
+    p_rows, g_rows, costs = [], [], []
+    for g, group in enumerate(groups):
+        stops = np.array(group["route"], dtype=np.float64)
+        origin, destination = stops[0], stops[-1]
+        length = float(pairwise_meters(stops[:-1, None, :], stops[1:, None, :])[..., 0, 0].sum())
+        direct = float(pairwise_meters(origin[None], destination[None])[0, 0])
+        budget = length + max_detour_meters
+        # Every point of the ellipse is within this distance of the origin -> destination line
+        reach = math.sqrt(max(budget * budget - direct * direct, 0.0)) / 2
+        dlat = reach / _METERS_PER_DEGREE_LAT
+        dlng = dlat / max(math.cos(math.radians(max(abs(origin[0]), abs(destination[0])) + dlat)), 1e-6)
+        rows, lats, lngs = index.points_in_box(
+            min(origin[0], destination[0]) - dlat, min(origin[1], destination[1]) - dlng,
+            max(origin[0], destination[0]) + dlat, max(origin[1], destination[1]) + dlng
+        )
+        points = np.column_stack([lats, lngs])
+        inside = pairwise_meters(points, stops[[0, -1]]).sum(axis=1) <= budget
+        rows, points = rows[inside], points[inside]
+        if not len(rows):
+            continue
+        added, _ = join_costs(stops[None], points)
+        added = np.maximum(added[0], 0.0)
+        keep = added <= max_detour_meters
+        if group["id"] in skip:
+            keep &= ~np.isin(passenger_ids[rows], list(skip[group["id"]]))
+        p_rows.append(rows[keep])
+        g_rows.append(np.full(int(keep.sum()), g, dtype=np.int64))
+        costs.append(added[keep])
+    if not p_rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    return np.concatenate(p_rows), np.concatenate(g_rows), np.concatenate(costs)
+
+
+def assign(
+    n_passengers: int,
+    seats: np.ndarray,
+    p_rows: np.ndarray,
+    g_rows: np.ndarray,
+    costs: np.ndarray,
+    unassigned_cost: float
+) -> np.ndarray:
+    """
+    Capacity-constrained min-cost assignment.
+
+    Args:
+        n_passengers: number of passengers
+        seats: free seats per group
+        p_rows, g_rows, costs: candidate pairs and their detour in meters
+        unassigned_cost: cost of leaving a passenger out; larger than any
+            pair cost, so seating someone always beats leaving them out
+
+    Returns:
+        group row for each passenger, -1 where unassigned
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+    result = np.full(n_passengers, -1, dtype=np.int64)
+    if not len(p_rows):
+        return result
+    # Only passengers with at least one candidate take part
+    active, p_local = np.unique(p_rows, return_inverse=True)
+    seats = np.asarray(seats, dtype=np.int64)
+    seat_start = np.concatenate([[0], np.cumsum(seats)])
+    total_seats = int(seat_start[-1])
+
+    # One edge per (pair, free seat of its group)
+    repeat = seats[g_rows]
+    first = np.repeat(np.cumsum(repeat) - repeat, repeat)
+    seat_rows = np.repeat(p_local, repeat)
+    seat_cols = np.repeat(seat_start[g_rows], repeat) + np.arange(int(repeat.sum())) - first
+    # Weights must be non-zero to count as edges
+    seat_costs = np.repeat(costs, repeat) + 1.0
+
+    n = len(active)
+    graph = csr_matrix(
+        (
+            np.concatenate([seat_costs, np.full(n, unassigned_cost)]),
+            (np.concatenate([seat_rows, np.arange(n)]), np.concatenate([seat_cols, total_seats + np.arange(n)]))
+        ),
+        shape=(n, total_seats + n)
+    )
+    _, columns = min_weight_full_bipartite_matching(graph)
+    seated = columns < total_seats
+    result[active[seated]] = np.searchsorted(seat_start, columns[seated], side="right") - 1
+    return result
+
+
+async def write_proposals(proposals: List[Tuple[int, int, int, float]]) -> int:
+    """
+    Insert (groupId, userId, votesRequired, detourMiles) as pending
+    GroupRequest rows. Pairs that already have a request are left alone.
+    The timestamps are set here: @updatedAt has no database default on a
+    schema built with `prisma db push`.
+    Returns the number of rows written.
+    """
+    written = 0
+    for start in range(0, len(proposals), GROUP_MATCH_WRITE_BATCH):
+        batch = proposals[start:start + GROUP_MATCH_WRITE_BATCH]
+        values = []
+        params = []
+        for i, proposal in enumerate(batch):
+            values.append(f"(${4 * i + 1}::int, ${4 * i + 2}::int, ${4 * i + 3}::int, ${4 * i + 4}::float8)")
+            params.extend(proposal)
+        written += await db.execute_raw(
+            f'''
+            INSERT INTO "GroupRequest" (
+                "groupId", "userId", status, "votesRequired", "votesReceived", "detourMiles",
+                "createdAt", "updatedAt"
+            )
+            SELECT v.group_id, v.user_id, 'pending', v.votes_required, 0, v.detour,
+                   CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+            FROM (VALUES {", ".join(values)}) AS v(group_id, user_id, votes_required, detour)
+            ON CONFLICT ("groupId", "userId") DO NOTHING
+            ''',
+            *params
+        )
+    return written
+
+
+async def run(max_detour_miles: float = GROUP_MATCH_MAX_DETOUR_MILES, dry_run: bool = False) -> dict:
+    """Propose groups for every unassigned passenger; returns a summary"""
+    started = time.perf_counter()
+    passenger_ids, coords = await load_passengers()
+    groups = await load_groups()
+    declined = await load_declined_pairs()
+    loaded = time.perf_counter()
+
+    max_detour_meters = max_detour_miles * METERS_PER_MILE
+    p_rows, g_rows, costs = candidate_edges(passenger_ids, coords, groups, max_detour_meters, declined)
+    priced = time.perf_counter()
+
+    seats = np.array([g["free_seats"] for g in groups], dtype=np.int64)
+    assigned = assign(len(passenger_ids), seats, p_rows, g_rows, costs, 2 * max_detour_meters + 1)
+    solved = time.perf_counter()
+
+    # Look up the detour of each chosen pair among the candidate pairs
+    seated = np.nonzero(assigned >= 0)[0]
+    pair_keys = p_rows * len(groups) + g_rows
+    by_key = np.argsort(pair_keys)
+    chosen = by_key[np.searchsorted(pair_keys, seated * len(groups) + assigned[seated], sorter=by_key)]
+    proposals = [
+        (
+            groups[g]["id"],
+            int(passenger_ids[p]),
+            groups[g]["occupancy"],  # All current members must approve
+            round(cost / METERS_PER_MILE, 1)
+        )
+        for p, g, cost in zip(seated.tolist(), assigned[seated].tolist(), costs[chosen].tolist())
+    ]
+    written = 0 if dry_run else await write_proposals(proposals)
+
+    return {
+        "passengers": len(passenger_ids),
+        "groups": len(groups),
+        "freeSeats": int(seats.sum()),
+        "candidatePairs": len(p_rows),
+        "proposed": len(proposals),
+        "written": written,
+        "totalDetourMiles": round(sum(p[3] for p in proposals), 1),
+        "loadSeconds": round(loaded - started, 3),
+        "pruneAndPriceSeconds": round(priced - loaded, 3),
+        "solveSeconds": round(solved - priced, 3),
+        "totalSeconds": round(time.perf_counter() - started, 3),
+    }
+
+
+async def _main(max_detour_miles: float, dry_run: bool):
+    await db.connect()
+    try:
+        summary = await run(max_detour_miles, dry_run)
+    finally:
+        await db.disconnect()
+    for key, value in summary.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    parser = argparse.ArgumentParser(description="Propose open groups for unassigned passengers")
+    parser.add_argument("--max-detour-miles", type=float, default=GROUP_MATCH_MAX_DETOUR_MILES)
+    parser.add_argument("--dry-run", action="store_true", help="Solve and report without writing requests")
+    args = parser.parse_args()
+    asyncio.run(_main(args.max_detour_miles, args.dry_run))
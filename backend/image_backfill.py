@@ -0,0 +1,94 @@
+"""
+Build avatar variants for profile images uploaded before the image pipeline.
+
+Walks users that have a profilePath but no profileVariants, reads the
+original back from wherever it lives (backend/uploads or the S3 profiles/
+prefix), and stores the WebP variants next to it. Users are processed in id
+order, and finished users drop out of the query, so re-running the job
+resumes where it stopped.
+
+Usage:
+    python image_backfill.py
+    python image_backfill.py --concurrency 8 --batch-size 100
+"""
+import argparse
+import asyncio
+import os
+import time
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+from prisma import Json  # noqa: E402
+
+from database import db  # noqa: E402
+from images import image_processor, store_variants  # noqa: E402
+from storage import storage_service  # noqa: E402
+
+
+async def backfill_user(user_id: int, profile_path: str) -> bool:
+    data = await storage_service.load_file(profile_path)
+    if data is None:
+        print(f"[user {user_id}] original not found: {profile_path}")
+        return False
+    filename = os.path.basename(urlparse(profile_path).path)
+    variants = await store_variants(data, filename)
+    if not variants:
+        return False
+    await db.user.update(
+        where={"id": user_id},
+        data={"profileVariants": Json(variants)}
+    )
+    return True
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Generate avatar variants for existing profile images")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=image_processor.workers)
+    parser.add_argument("--start-id", type=int, default=0)
+    args = parser.parse_args()
+
+    await db.connect()
+    image_processor.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(user):
+        async with semaphore:
+            return await backfill_user(user["id"], user["profilePath"])
+
+    last_id = args.start_id
+    done = failed = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            users = await db.query_raw(
+                '''
+                SELECT id, "profilePath"
+                FROM "User"
+                WHERE id > $1
+                  AND "profilePath" IS NOT NULL
+                  AND "profileVariants" IS NULL
+                ORDER BY id
+                LIMIT $2
+                ''',
+                last_id, args.batch_size
+            )
+            if not users:
+                break
+            results = await asyncio.gather(*(process(u) for u in users))
+            done += sum(results)
+            failed += len(results) - sum(results)
+            last_id = users[-1]["id"]
+            elapsed = time.perf_counter() - started
+            print(f"through user {last_id}: {done} done, {failed} failed ({(done + failed) / elapsed:.1f} users/s)")
+    finally:
+        image_processor.shutdown()
+        await db.disconnect()
+    print(f"Done. Image stats: {image_processor.stats()}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
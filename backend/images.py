@@ -0,0 +1,154 @@
+"""
+Profile image processing.
+
+Uploaded photos are decoded once, rotated according to their EXIF
+orientation, stripped of all metadata (EXIF carries GPS coordinates) and
+re-encoded as small square WebP avatars. List endpoints return these
+variants so avatar-heavy pages don't download full-size phone photos.
+
+Decoding and encoding are CPU-bound, so they run in a worker pool like
+password hashing (see passwords.py).
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from PIL import Image, ImageOps
+
+from storage import storage_service
+
+logger = logging.getLogger(__name__)
+
+AVATAR_SIZES = (64, 128, 256)
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+# Larger profile uploads are refused with 413 before anything is stored or decoded
+MAX_IMAGE_UPLOAD_BYTES = int(os.getenv("MAX_IMAGE_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# "process" (default) or "thread"
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "process")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(os.cpu_count() or 1, 2))))
+
+
+class InvalidImage(Exception):
+    """Raised when the upload cannot be decoded as an image"""
+
+
+def make_variants(data: bytes, sizes=AVATAR_SIZES, quality: int = IMAGE_WEBP_QUALITY) -> Dict[int, bytes]:
+    """
+    Decode an image and return {size: webp_bytes} for each square avatar size.
+
+    The output carries no EXIF/XMP/ICC metadata.
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            # Let the JPEG decoder scale down by up to 8x while decoding;
+            # a 12 MP photo then decodes at ~1/64th of the cost
+            largest = max(sizes)
+            img.draft("RGB", (largest * 2, largest * 2))
+            img = ImageOps.exif_transpose(img)
+            img = img.convert("RGBA" if img.mode in ("RGBA", "LA", "P") else "RGB")
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImage(str(e))
+
+    variants = {}
+    for size in sorted(sizes, reverse=True):
+        img = ImageOps.fit(img, (size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, "WEBP", quality=quality, method=4)
+        variants[size] = out.getvalue()
+    return variants
+
+
+def variant_filename(filename: str, size: int) -> str:
+    """photo.jpg -> photo_128.webp"""
+    stem = os.path.splitext(filename)[0]
+    return f"{stem}_{size}.webp"
+
+
+class ImageProcessor:
+    def __init__(self, workers: int = IMAGE_WORKERS, executor_type: str = IMAGE_EXECUTOR):
+        self.workers = max(1, workers)
+        self.executor_type = executor_type
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self.processed = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def start(self):
+        if self._executor is not None:
+            return
+        if self.executor_type == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="images")
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        logger.info(f"Image processor started ({self.workers} {self.executor_type} workers)")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def make_variants(self, data: bytes) -> Dict[int, bytes]:
+        """Build the avatar variants in the worker pool"""
+        self.start()
+        self._pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            variants = await loop.run_in_executor(self._executor, make_variants, data)
+        except InvalidImage:
+            self.failed += 1
+            raise
+        finally:
+            self._pending -= 1
+        elapsed = time.perf_counter() - started
+        self.processed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += sum(len(v) for v in variants.values())
+        self._total += elapsed
+        self._max = max(self._max, elapsed)
+        return variants
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "pending": self._pending,
+            "processed": self.processed,
+            "failed": self.failed,
+            "bytesIn": self.bytes_in,
+            "bytesOut": self.bytes_out,
+            "avgMs": round(self._total / self.processed * 1000, 1) if self.processed else 0.0,
+            "maxMs": round(self._max * 1000, 1),
+        }
+
+
+image_processor = ImageProcessor()
+
+
+async def store_variants(data: bytes, filename: str) -> Optional[Dict[str, str]]:
+    """
+    Build and store the avatar variants for an original upload.
+
+    Returns:
+        {"64": url, "128": url, "256": url}, or None if the file is not a
+        decodable image (the original is still served as-is)
+    """
+    try:
+        variants = await image_processor.make_variants(data)
+    except InvalidImage as e:
+        logger.warning(f"Could not build avatar variants for {filename}: {e}")
+        return None
+    sizes = sorted(variants)
+    urls = await asyncio.gather(*(
+        storage_service.save_file(variants[size], variant_filename(filename, size))
+        for size in sizes
+    ))
+    return {str(size): url for size, url in zip(sizes, urls)}
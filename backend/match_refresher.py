@@ -0,0 +1,203 @@
+"""
+Keeps the precomputed "UserMatch" table current.
+
+Triggers on CompanyAddress / HomeAddress / User put every user whose ranked
+candidates may have changed into "UserMatchDirty" (the changed user plus
+everyone whose office is within the match radius). This worker drains that
+queue and recomputes each user with the refresh_user_matches() SQL function,
+so /search?type=all becomes a single indexed read.
+
+Run it inside the API (MATCH_REFRESH_ENABLED=true, the default) or on its own:
+    python match_refresher.py            # drain the queue forever
+    python match_refresher.py rebuild    # recompute every user
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+MATCH_REFRESH_ENABLED = os.getenv("MATCH_REFRESH_ENABLED", "true").lower() == "true"
+MATCH_REFRESH_BATCH = int(os.getenv("MATCH_REFRESH_BATCH", "50"))
+MATCH_REFRESH_POLL_SECONDS = float(os.getenv("MATCH_REFRESH_POLL_SECONDS", "2"))
+# Must match the radius of the live /search?type=all query
+MATCH_RADIUS_METERS = float(os.getenv("MATCH_RADIUS_METERS", "16093.4"))
+# Candidates kept per user; /search pages through at most this many
+MATCH_STORE_SIZE = int(os.getenv("MATCH_STORE_SIZE", "100"))
+
+
+class MatchRefresher:
+    def __init__(self, batch_size: int = MATCH_REFRESH_BATCH, poll_seconds: float = MATCH_REFRESH_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.refreshed = 0
+        self.failed = 0
+        self.last_lag_seconds: Optional[float] = None
+        self.max_lag_seconds = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logger.error(f"Match refresher error: {e}")
+                processed = 0
+            if not processed:
+                await asyncio.sleep(self.poll_seconds)
+
+    async def claim(self) -> list:
+        """Remove up to one batch of users from the dirty queue, oldest first"""
+        return await db.query_raw(
+            '''
+            DELETE FROM "UserMatchDirty"
+            WHERE "userId" IN (
+                SELECT "userId"
+                FROM "UserMatchDirty"
+                ORDER BY "queuedAt"
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING "userId",
+                      EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - "queuedAt"))::double precision AS lag
+            ''',
+            self.batch_size
+        )
+
+    async def refresh_user(self, user_id: int) -> int:
+        rows = await db.query_raw(
+            'SELECT refresh_user_matches($1, $2, $3) AS stored',
+            user_id, MATCH_RADIUS_METERS, MATCH_STORE_SIZE
+        )
+        return rows[0]["stored"]
+
+    async def run_once(self) -> int:
+        """Refresh one batch of dirty users; returns how many were claimed"""
+        claimed = await self.claim()
+        for row in claimed:
+            try:
+                await self.refresh_user(row["userId"])
+            except Exception as e:
+                logger.error(f"Refreshing matches for user {row['userId']} failed: {e}")
+                self.failed += 1
+                # Put it back so the next pass retries it
+                await db.execute_raw(
+                    '''
+                    INSERT INTO "UserMatchDirty" ("userId") VALUES ($1)
+                    ON CONFLICT ("userId") DO NOTHING
+                    ''',
+                    row["userId"]
+                )
+                continue
+            self.refreshed += 1
+            self.last_lag_seconds = row["lag"]
+            self.max_lag_seconds = max(self.max_lag_seconds, row["lag"])
+        return len(claimed)
+
+    async def rebuild(self, batch_size: int = 500):
+        """
+        Recompute every user with an office address. Users already in the
+        dirty queue are left there; refreshing them again is harmless.
+        """
+        last_id = 0
+        done = 0
+        started = time.perf_counter()
+        while True:
+            rows = await db.query_raw(
+                '''
+                SELECT "userId"
+                FROM "CompanyAddress"
+                WHERE "userId" > $1
+                ORDER BY "userId"
+                LIMIT $2
+                ''',
+                last_id, batch_size
+            )
+            if not rows:
+                break
+            for row in rows:
+                await self.refresh_user(row["userId"])
+            done += len(rows)
+            last_id = rows[-1]["userId"]
+            print(f"Rebuilt matches for {done} users ({done / (time.perf_counter() - started):.0f} users/s)")
+
+    async def queue_stats(self) -> dict:
+        """Staleness of the stored matches"""
+        rows = await db.query_raw(
+            '''
+            SELECT
+                (SELECT COUNT(*)::int FROM "UserMatchDirty") AS dirty,
+                (SELECT EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - MIN("queuedAt")))::double precision
+                 FROM "UserMatchDirty") AS oldest_dirty_age,
+                (SELECT EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - MIN("computedAt")))::double precision
+                 FROM "UserMatch") AS oldest_match_age
+            '''
+        )
+        row = rows[0]
+        return {
+            "dirtyUsers": row["dirty"],
+            "oldestDirtyAgeSeconds": round(row["oldest_dirty_age"], 1) if row["oldest_dirty_age"] is not None else None,
+            "oldestMatchAgeSeconds": round(row["oldest_match_age"], 1) if row["oldest_match_age"] is not None else None,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+            "lastLagSeconds": round(self.last_lag_seconds, 2) if self.last_lag_seconds is not None else None,
+            "maxLagSeconds": round(self.max_lag_seconds, 2),
+        }
+
+
+match_refresher = MatchRefresher()
+
+
+async def _main(command: str):
+    await db.connect()
+    try:
+        if command == "rebuild":
+            await match_refresher.rebuild()
+            print(await match_refresher.queue_stats())
+            return
+        match_refresher.start()
+        await asyncio.Event().wait()
+    finally:
+        await match_refresher.stop()
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Maintain the precomputed UserMatch table")
+    parser.add_argument("command", nargs="?", choices=["run", "rebuild"], default="run")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_main(args.command))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,80 @@
+"""
+Keyset ("seek") pagination for the search endpoints.
+
+A cursor holds the sort key of the last row on a page - (score, id) or
+(distance, id) - tagged with the ranking it came from. The next page asks
+for rows strictly after that key instead of skipping OFFSET rows, and ties
+on score/distance are broken by user id so no row is repeated or skipped
+between pages. Clients treat cursors as opaque.
+
+Only the stored /search ranking ("UserMatch", keyed by its
+(userId, score DESC, candidateId) index) can seek straight to the cursor, so
+every page costs the same there. The distance-ordered endpoints
+(/search/nearby, /search/commute, live /search, paginate()) sort on a
+computed distance that no index covers: each page still scans and sorts
+every row before the cursor, so page N costs O(rows up to page N). The
+keyset only keeps those pages consistent; the radius caps and
+MATCH_STORE_SIZE are what bound the work.
+"""
+import base64
+import json
+import os
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "6"))
+NEARBY_PAGE_SIZE = int(os.getenv("NEARBY_PAGE_SIZE", "20"))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size(limit: Optional[int], default: int) -> int:
+    """Requested page size, clamped to 1..SEARCH_MAX_PAGE_SIZE"""
+    if limit is None:
+        limit = default
+    return max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+
+
+def encode_cursor(kind: str, *key) -> str:
+    raw = json.dumps([kind, *key], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, kinds: Iterable[str]) -> Tuple[str, list]:
+    """
+    Returns:
+        (kind, key) for a cursor made by encode_cursor with one of the given kinds
+
+    Raises:
+        InvalidCursor: the cursor is malformed or belongs to another ranking
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        kind, *key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    if kind not in set(kinds) or len(key) != 2:
+        raise InvalidCursor("Invalid cursor")
+    return kind, key
+
+
+def seek_page(rows: Sequence, size: int, kind: str, key: Callable) -> Tuple[list, Optional[str]]:
+    """
+    Split rows fetched with LIMIT size + 1 into the page and the cursor for
+    the next one (None on the last page).
+    """
+    if len(rows) <= size:
+        return list(rows), None
+    page = list(rows[:size])
+    return page, encode_cursor(kind, *key(page[-1]))
+
+
+def paginate(rows: Iterable, key: Callable, after: Optional[Sequence], size: int, kind: str) -> Tuple[List, Optional[str]]:
+    """Page through rows held in memory; key gives each row's ascending sort key"""
+    ordered = sorted(rows, key=key)
+    if after is not None:
+        after = tuple(after)
+        ordered = [row for row in ordered if key(row) > after]
+    return seek_page(ordered, size, kind, key)
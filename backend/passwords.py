@@ -0,0 +1,135 @@
+"""
+Password hashing service.
+
+bcrypt is deliberately slow (~200-300 ms per call), so hashing and
+verification run in a bounded worker pool instead of on the event loop.
+Calls beyond the queue limit are rejected right away so a login burst
+cannot pile up unbounded work behind the API.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+# Password hashing (also used inside the worker processes)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# "process" (default) or "thread" - bcrypt releases the GIL, so threads work too
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "process")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(os.cpu_count() or 1, 4))))
+# How many calls may wait for a free worker before new ones are rejected
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "32"))
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue is full"""
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, password_hash)
+
+
+class _LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avgMs": round(self.total / self.count * 1000, 1) if self.count else 0.0,
+            "maxMs": round(self.max * 1000, 1),
+        }
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        queue_size: int = PASSWORD_HASH_QUEUE,
+        executor_type: str = PASSWORD_HASH_EXECUTOR,
+    ):
+        self.workers = max(1, workers)
+        self.max_pending = self.workers + max(0, queue_size)
+        self.executor_type = executor_type
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self._stats = {"hash": _LatencyStats(), "verify": _LatencyStats()}
+
+    def start(self):
+        if self._executor is not None:
+            return
+        if self.executor_type == "thread":
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        logger.info(f"Password hasher started ({self.workers} {self.executor_type} workers)")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, op: str, fn, *args):
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy("Password hashing queue is full")
+        self.start()
+        self._pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+            self._stats[op].record(time.perf_counter() - started)
+
+    async def hash(self, password: str) -> str:
+        """Hash a password with bcrypt"""
+        return await self._run("hash", _hash, password)
+
+    async def verify_and_update(self, password: str, password_hash: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verify a password against its stored hash.
+
+        Returns:
+            (valid, new_hash) - new_hash is set when the stored hash uses
+            outdated settings and should be replaced
+        """
+        valid, new_hash = await self._run("verify", _verify_and_update, password, password_hash)
+        if new_hash:
+            self.rehashed += 1
+        return valid, new_hash
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "pending": self._pending,
+            "maxPending": self.max_pending,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "hash": self._stats["hash"].as_dict(),
+            "verify": self._stats["verify"].as_dict(),
+        }
+
+
+password_hasher = PasswordHasher()
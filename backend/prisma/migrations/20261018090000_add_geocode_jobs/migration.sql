@@ -0,0 +1,31 @@
+-- ============================================
+-- BACKGROUND GEOCODING JOB QUEUE
+-- Signup persists addresses with NULL coordinates and queues one job per
+-- address. Workers claim jobs with FOR UPDATE SKIP LOCKED and write
+-- latitude/longitude back; trigger_*_address_location then fills "location".
+-- ============================================
+
+-- CreateTable
+CREATE TABLE "GeocodeJob" (
+    "id" SERIAL NOT NULL,
+    "userId" INTEGER NOT NULL,
+    "addressType" TEXT NOT NULL,
+    "addressId" INTEGER NOT NULL,
+    "status" TEXT NOT NULL DEFAULT 'pending',
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+    "lastError" TEXT,
+    "runAfter" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "createdAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "GeocodeJob_pkey" PRIMARY KEY ("id")
+);
+
+-- CreateIndex
+CREATE INDEX "GeocodeJob_status_runAfter_idx" ON "GeocodeJob"("status", "runAfter");
+
+-- CreateIndex
+CREATE INDEX "GeocodeJob_userId_idx" ON "GeocodeJob"("userId");
+
+-- AddForeignKey
+ALTER TABLE "GeocodeJob" ADD CONSTRAINT "GeocodeJob_userId_fkey" FOREIGN KEY ("userId") REFERENCES "User"("id") ON DELETE CASCADE ON UPDATE CASCADE;
@@ -0,0 +1,14 @@
+-- ============================================
+-- CLUSTER-WIDE RATE LIMIT STATE
+-- Used when GEOCODER_RATE_LIMITER=postgres so every API host shares one
+-- Nominatim budget. Each reservation is a single conditional UPDATE of the
+-- bucket row (see rate_limit.PostgresRateLimiter).
+-- ============================================
+
+-- CreateTable
+CREATE TABLE "RateLimitBucket" (
+    "name" TEXT NOT NULL,
+    "tat" DOUBLE PRECISION NOT NULL DEFAULT 0,
+
+    CONSTRAINT "RateLimitBucket_pkey" PRIMARY KEY ("name")
+);
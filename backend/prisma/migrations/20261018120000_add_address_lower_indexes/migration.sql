@@ -0,0 +1,10 @@
+-- Functional indexes for the case-insensitive matching in /search
+-- (lower(column) = lower($n)); Prisma's schema language cannot express these.
+
+-- "city" and "street" searches: lower(city) alone uses the leading column
+CREATE INDEX IF NOT EXISTS "CompanyAddress_lower_city_street_idx"
+    ON "CompanyAddress" (lower(city), lower(street));
+
+-- "office" search
+CREATE INDEX IF NOT EXISTS "CompanyAddress_lower_officeName_idx"
+    ON "CompanyAddress" (lower("officeName"));
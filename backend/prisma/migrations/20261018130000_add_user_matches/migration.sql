@@ -0,0 +1,197 @@
+-- ============================================
+-- PRECOMPUTED "TOP MATCHES" PER USER
+-- /search?type=all reads a user's ranked candidates from "UserMatch"
+-- instead of re-running the radius scan and scoring on every request.
+-- Address changes mark the affected users in "UserMatchDirty"; the match
+-- refresher (match_refresher.py) recomputes them with refresh_user_matches().
+-- ============================================
+
+-- CreateTable
+CREATE TABLE "UserMatch" (
+    "userId" INTEGER NOT NULL,
+    "candidateId" INTEGER NOT NULL,
+    "score" DOUBLE PRECISION NOT NULL,
+    "workDistance" DOUBLE PRECISION,
+    "homeDistance" DOUBLE PRECISION,
+    "sameOffice" BOOLEAN NOT NULL DEFAULT false,
+    "sameWorkCity" BOOLEAN NOT NULL DEFAULT false,
+    "sameHomeCity" BOOLEAN NOT NULL DEFAULT false,
+    "sameHomeZipcode" BOOLEAN NOT NULL DEFAULT false,
+    "computedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "UserMatch_pkey" PRIMARY KEY ("userId","candidateId")
+);
+
+-- CreateTable
+CREATE TABLE "UserMatchDirty" (
+    "userId" INTEGER NOT NULL,
+    "queuedAt" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+    CONSTRAINT "UserMatchDirty_pkey" PRIMARY KEY ("userId")
+);
+
+-- CreateIndex
+CREATE INDEX "UserMatch_userId_score_idx" ON "UserMatch"("userId", "score" DESC);
+
+-- CreateIndex
+CREATE INDEX "UserMatch_candidateId_idx" ON "UserMatch"("candidateId");
+
+-- CreateIndex
+CREATE INDEX "UserMatchDirty_queuedAt_idx" ON "UserMatchDirty"("queuedAt");
+
+-- AddForeignKey
+ALTER TABLE "UserMatch" ADD CONSTRAINT "UserMatch_userId_fkey" FOREIGN KEY ("userId") REFERENCES "User"("id") ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- AddForeignKey
+ALTER TABLE "UserMatch" ADD CONSTRAINT "UserMatch_candidateId_fkey" FOREIGN KEY ("candidateId") REFERENCES "User"("id") ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- Recompute one user's candidates. Same scoring as the live /search path:
+-- same office +2000, same home city +1000, same home zipcode +500,
+-- same work city +100, and up to +200 for a short work distance.
+CREATE OR REPLACE FUNCTION refresh_user_matches(
+    p_user_id INTEGER,
+    p_radius_meters DOUBLE PRECISION DEFAULT 16093.4,
+    p_limit INTEGER DEFAULT 20
+)
+RETURNS INTEGER AS $$
+DECLARE
+    my_office TEXT;
+    my_work_city TEXT;
+    my_work_location geography;
+    my_home_city TEXT;
+    my_home_zipcode TEXT;
+    my_home_location geography;
+    stored INTEGER;
+BEGIN
+    DELETE FROM "UserMatch" WHERE "userId" = p_user_id;
+
+    SELECT NULLIF(ca."officeName", ''), NULLIF(ca.city, ''), ca.location,
+           NULLIF(ha.city, ''), NULLIF(ha.zipcode, ''), ha.location
+    INTO my_office, my_work_city, my_work_location,
+         my_home_city, my_home_zipcode, my_home_location
+    FROM "CompanyAddress" ca
+    LEFT JOIN "HomeAddress" ha ON ha."userId" = ca."userId"
+    WHERE ca."userId" = p_user_id;
+
+    IF my_work_location IS NULL THEN
+        RETURN 0;
+    END IF;
+
+    INSERT INTO "UserMatch" (
+        "userId", "candidateId", "score", "workDistance", "homeDistance",
+        "sameOffice", "sameWorkCity", "sameHomeCity", "sameHomeZipcode"
+    )
+    SELECT p_user_id, c.id, s.score, c.work_distance, c.home_distance,
+           c.same_office, c.same_work_city, c.same_home_city, c.same_home_zipcode
+    FROM (
+        SELECT
+            ca."userId" AS id,
+            ST_Distance(ca.location, my_work_location) AS work_distance,
+            CASE WHEN ha.location IS NOT NULL AND my_home_location IS NOT NULL
+                 THEN ST_Distance(ha.location, my_home_location) END AS home_distance,
+            COALESCE(lower(ca."officeName") = lower(my_office), FALSE) AS same_office,
+            COALESCE(lower(ca.city) = lower(my_work_city), FALSE) AS same_work_city,
+            COALESCE(lower(ha.city) = lower(my_home_city), FALSE) AS same_home_city,
+            COALESCE(ha.zipcode = my_home_zipcode, FALSE) AS same_home_zipcode
+        FROM "CompanyAddress" ca
+        LEFT JOIN "HomeAddress" ha ON ha."userId" = ca."userId"
+        WHERE ca."userId" != p_user_id
+          AND ca.location IS NOT NULL
+          AND ST_DWithin(ca.location, my_work_location, p_radius_meters)
+    ) c
+    CROSS JOIN LATERAL (
+        SELECT CASE WHEN c.same_office THEN 2000 ELSE 0 END
+             + CASE WHEN c.same_home_city THEN 1000 ELSE 0 END
+             + CASE WHEN c.same_home_zipcode THEN 500 ELSE 0 END
+             + CASE WHEN c.same_work_city THEN 100 ELSE 0 END
+             + GREATEST(0, 200 - round((c.work_distance / 1609.34)::numeric, 1) * 20) AS score
+    ) s
+    ORDER BY s.score DESC, c.work_distance
+    LIMIT p_limit;
+
+    GET DIAGNOSTICS stored = ROW_COUNT;
+    RETURN stored;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Queue a user and every user whose office is within the match radius of
+-- the given office location (they may have the user as a candidate)
+CREATE OR REPLACE FUNCTION queue_user_match_refresh_near(
+    p_user_id INTEGER,
+    p_work_location geography,
+    p_radius_meters DOUBLE PRECISION DEFAULT 16093.4
+)
+RETURNS VOID AS $$
+BEGIN
+    INSERT INTO "UserMatchDirty" ("userId")
+    VALUES (p_user_id)
+    ON CONFLICT ("userId") DO NOTHING;
+
+    IF p_work_location IS NOT NULL THEN
+        INSERT INTO "UserMatchDirty" ("userId")
+        SELECT ca."userId"
+        FROM "CompanyAddress" ca
+        WHERE ca.location IS NOT NULL
+          AND ST_DWithin(ca.location, p_work_location, p_radius_meters)
+        ON CONFLICT ("userId") DO NOTHING;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION queue_user_match_refresh_company()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Users near the old office lose this user as a candidate, users near
+    -- the new one gain it
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM queue_user_match_refresh_near(OLD."userId", OLD.location);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM queue_user_match_refresh_near(NEW."userId", NEW.location);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION queue_user_match_refresh_home()
+RETURNS TRIGGER AS $$
+DECLARE
+    changed_user INTEGER;
+BEGIN
+    changed_user := CASE WHEN TG_OP = 'DELETE' THEN OLD."userId" ELSE NEW."userId" END;
+    -- A home change only moves scores, so the affected users are the ones
+    -- around this user's (unchanged) office
+    PERFORM queue_user_match_refresh_near(
+        changed_user,
+        (SELECT location FROM "CompanyAddress" WHERE "userId" = changed_user)
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION queue_user_match_refresh_user_deleted()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- Their UserMatch rows cascade away; refill the lists they appeared in
+    INSERT INTO "UserMatchDirty" ("userId")
+    SELECT "userId" FROM "UserMatch" WHERE "candidateId" = OLD.id
+    ON CONFLICT ("userId") DO NOTHING;
+    DELETE FROM "UserMatchDirty" WHERE "userId" = OLD.id;
+    RETURN OLD;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_company_address_user_matches
+    AFTER INSERT OR DELETE OR UPDATE OF latitude, longitude, city, "officeName" ON "CompanyAddress"
+    FOR EACH ROW
+    EXECUTE FUNCTION queue_user_match_refresh_company();
+
+CREATE TRIGGER trigger_home_address_user_matches
+    AFTER INSERT OR DELETE OR UPDATE OF latitude, longitude, city, zipcode ON "HomeAddress"
+    FOR EACH ROW
+    EXECUTE FUNCTION queue_user_match_refresh_home();
+
+CREATE TRIGGER trigger_user_deleted_user_matches
+    BEFORE DELETE ON "User"
+    FOR EACH ROW
+    EXECUTE FUNCTION queue_user_match_refresh_user_deleted();
@@ -0,0 +1,11 @@
+-- ============================================
+-- KEYSET PAGINATION OVER STORED MATCHES
+-- /search?type=all pages through "UserMatch" by (score DESC, candidateId);
+-- with candidateId in the index each page is a single index range seek.
+-- ============================================
+
+-- DropIndex
+DROP INDEX IF EXISTS "UserMatch_userId_score_idx";
+
+-- CreateIndex
+CREATE INDEX "UserMatch_userId_score_candidateId_idx" ON "UserMatch"("userId", "score" DESC, "candidateId");
@@ -0,0 +1,47 @@
+-- ============================================
+-- PRECOMPUTED GROUP ROUTES FOR /groups/open
+-- Each group stores its driver's home -> office line as geography, kept in
+-- sync with the endpoint columns by trigger, so the "on the way" filter is
+-- an indexed ST_DWithin(route, pickup, max_detour) instead of building a
+-- line for every open group in is_on_the_way() / calculate_detour_miles().
+-- Like the address "location" columns, "route" is not in schema.prisma.
+-- ============================================
+
+-- AlterTable
+ALTER TABLE "CarpoolGroup" ADD COLUMN IF NOT EXISTS "route" geography(LineString, 4326);
+
+-- CreateIndex
+-- Only open groups are ever searched by route
+CREATE INDEX IF NOT EXISTS "idx_carpool_group_route" ON "CarpoolGroup" USING GIST("route") WHERE "status" = 'OPEN';
+
+-- Keep the route in step with origin/destination
+CREATE OR REPLACE FUNCTION update_group_route_from_coords()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW."originLat" IS NOT NULL AND NEW."originLng" IS NOT NULL
+       AND NEW."destLat" IS NOT NULL AND NEW."destLng" IS NOT NULL THEN
+        NEW."route" = ST_MakeLine(
+            ST_SetSRID(ST_MakePoint(NEW."originLng", NEW."originLat"), 4326)::geometry,
+            ST_SetSRID(ST_MakePoint(NEW."destLng", NEW."destLat"), 4326)::geometry
+        )::geography;
+    ELSE
+        NEW."route" = NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trigger_carpool_group_route ON "CarpoolGroup";
+CREATE TRIGGER trigger_carpool_group_route
+    BEFORE INSERT OR UPDATE OF "originLat", "originLng", "destLat", "destLng" ON "CarpoolGroup"
+    FOR EACH ROW
+    EXECUTE FUNCTION update_group_route_from_coords();
+
+-- Populate routes for existing groups
+UPDATE "CarpoolGroup"
+SET "route" = ST_MakeLine(
+    ST_SetSRID(ST_MakePoint("originLng", "originLat"), 4326)::geometry,
+    ST_SetSRID(ST_MakePoint("destLng", "destLat"), 4326)::geometry
+)::geography
+WHERE "originLat" IS NOT NULL AND "originLng" IS NOT NULL
+  AND "destLat" IS NOT NULL AND "destLng" IS NOT NULL;
@@ -0,0 +1,110 @@
+-- ============================================
+-- ATOMIC CONSENSUS VOTING IN ONE ROUND TRIP
+-- cast_group_vote() records a vote and, when it completes the consensus,
+-- adds the requester to the group - all in the caller's transaction.
+-- The group row is locked (FOR UPDATE) before the request row, so
+-- concurrent votes on a group are serialized: votesReceived and
+-- currentOccupancy only move through in-place increments, and a group can
+-- never be filled past maxSeats.
+--
+-- Outcomes: not_member, not_found, wrong_group, already_processed,
+-- already_voted, rejected, full, pending, approved
+-- ============================================
+
+CREATE OR REPLACE FUNCTION cast_group_vote(
+    p_group_id INTEGER,
+    p_request_id INTEGER,
+    p_voter_id INTEGER,
+    p_vote TEXT
+)
+RETURNS TABLE (
+    outcome TEXT,
+    votes_received INTEGER,
+    votes_required INTEGER,
+    requester_id INTEGER,
+    requester_first_name TEXT,
+    new_occupancy INTEGER
+) AS $$
+DECLARE
+    g "CarpoolGroup"%ROWTYPE;
+    r "GroupRequest"%ROWTYPE;
+    received INTEGER;
+    occupancy INTEGER;
+    first_name TEXT;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM "GroupMember" WHERE "groupId" = p_group_id AND "userId" = p_voter_id
+    ) THEN
+        RETURN QUERY SELECT 'not_member'::TEXT, NULL::INTEGER, NULL::INTEGER, NULL::INTEGER, NULL::TEXT, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    -- Lock order: group, then request (same for every voter, so no deadlocks)
+    SELECT * INTO g FROM "CarpoolGroup" WHERE id = p_group_id FOR UPDATE;
+    SELECT * INTO r FROM "GroupRequest" WHERE id = p_request_id FOR UPDATE;
+
+    IF r.id IS NULL THEN
+        RETURN QUERY SELECT 'not_found'::TEXT, NULL::INTEGER, NULL::INTEGER, NULL::INTEGER, NULL::TEXT, NULL::INTEGER;
+        RETURN;
+    END IF;
+    IF r."groupId" != p_group_id THEN
+        RETURN QUERY SELECT 'wrong_group'::TEXT, NULL::INTEGER, NULL::INTEGER, NULL::INTEGER, NULL::TEXT, NULL::INTEGER;
+        RETURN;
+    END IF;
+    IF r.status != 'pending' THEN
+        RETURN QUERY SELECT 'already_processed'::TEXT, r."votesReceived", r."votesRequired", r."userId", NULL::TEXT, g."currentOccupancy";
+        RETURN;
+    END IF;
+
+    INSERT INTO "GroupVote" ("requestId", "voterId", "vote")
+    VALUES (p_request_id, p_voter_id, p_vote)
+    ON CONFLICT ("requestId", "voterId") DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'already_voted'::TEXT, r."votesReceived", r."votesRequired", r."userId", NULL::TEXT, g."currentOccupancy";
+        RETURN;
+    END IF;
+
+    IF p_vote = 'reject' THEN
+        -- Any rejection = request denied immediately
+        UPDATE "GroupRequest" SET status = 'rejected', "updatedAt" = CURRENT_TIMESTAMP WHERE id = p_request_id;
+        RETURN QUERY SELECT 'rejected'::TEXT, r."votesReceived", r."votesRequired", r."userId", NULL::TEXT, g."currentOccupancy";
+        RETURN;
+    END IF;
+
+    UPDATE "GroupRequest"
+    SET "votesReceived" = "votesReceived" + 1, "updatedAt" = CURRENT_TIMESTAMP
+    WHERE id = p_request_id
+    RETURNING "votesReceived" INTO received;
+
+    IF received < r."votesRequired" THEN
+        RETURN QUERY SELECT 'pending'::TEXT, received, r."votesRequired", r."userId", NULL::TEXT, g."currentOccupancy";
+        RETURN;
+    END IF;
+
+    -- Consensus reached, but the group may have filled up meanwhile
+    IF g.status != 'OPEN' OR g."currentOccupancy" >= g."maxSeats" THEN
+        UPDATE "GroupRequest" SET status = 'rejected', "updatedAt" = CURRENT_TIMESTAMP WHERE id = p_request_id;
+        RETURN QUERY SELECT 'full'::TEXT, received, r."votesRequired", r."userId", NULL::TEXT, g."currentOccupancy";
+        RETURN;
+    END IF;
+
+    -- Provisional pickup order (last in the route); the app re-plans it
+    INSERT INTO "GroupMember" ("groupId", "userId", "role", "pickupLat", "pickupLng", "pickupOrder", "detourMiles")
+    SELECT p_group_id, r."userId", 'passenger', ha.latitude, ha.longitude,
+           (SELECT COALESCE(MAX("pickupOrder"), 0) + 1 FROM "GroupMember" WHERE "groupId" = p_group_id),
+           r."detourMiles"
+    FROM (SELECT 1) one
+    LEFT JOIN "HomeAddress" ha ON ha."userId" = r."userId";
+
+    -- check_group_capacity() marks the group FULL when this fills it
+    UPDATE "CarpoolGroup"
+    SET "currentOccupancy" = "currentOccupancy" + 1
+    WHERE id = p_group_id
+    RETURNING "currentOccupancy" INTO occupancy;
+
+    UPDATE "GroupRequest" SET status = 'approved', "updatedAt" = CURRENT_TIMESTAMP WHERE id = p_request_id;
+
+    SELECT u."firstName" INTO first_name FROM "User" u WHERE u.id = r."userId";
+    RETURN QUERY SELECT 'approved'::TEXT, received, r."votesRequired", r."userId", first_name, occupancy;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,250 @@
+"""
+Rate limiters for outbound API calls (the geocoder).
+
+All backends use the same reservation scheme (GCRA): the shared state is a
+single "theoretical arrival time" (TAT). Each caller atomically reserves the
+next free slot and then sleeps until it, so callers are served in the order
+they arrived and nobody busy-polls. A caller whose slot is further away
+than max_wait gets RateLimitTimeout without reserving anything.
+
+Backends:
+    local     per process (asyncio lock)
+    file      shared by every worker on the host (flock + mmap'd state file)
+    postgres  shared by every host (one row in "RateLimitBucket")
+
+Pick one with GEOCODER_RATE_LIMITER. The default, "file", keeps every
+worker on a host inside one budget; use "postgres" across hosts.
+"""
+import abc
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import time
+from typing import Optional
+
+GEOCODER_RATE = float(os.getenv("GEOCODER_RATE", "1.0"))
+GEOCODER_BURST = int(os.getenv("GEOCODER_BURST", "1"))
+GEOCODER_RATE_LIMITER = os.getenv("GEOCODER_RATE_LIMITER", "file")
+GEOCODER_RATE_LIMIT_FILE = os.getenv("GEOCODER_RATE_LIMIT_FILE", "/tmp/carpool-geocoder.ratelimit")
+GEOCODER_MAX_WAIT_SECONDS = float(os.getenv("GEOCODER_MAX_WAIT_SECONDS", "30"))
+
+_TAT = struct.Struct("<d")
+
+
+class RateLimitTimeout(Exception):
+    """Raised when the next free slot is further away than max_wait"""
+
+
+class RateLimiter(abc.ABC):
+    """Base class: subclasses implement _reserve against their shared state"""
+
+    backend = "base"
+
+    def __init__(
+        self,
+        rate: float = GEOCODER_RATE,
+        burst: int = GEOCODER_BURST,
+        max_wait: float = GEOCODER_MAX_WAIT_SECONDS,
+    ):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_wait = max_wait
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.acquired = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.max_queue_depth = 0
+        self.last_queue_depth = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _gcra(self, tat: float, now: float, max_wait: float):
+        """
+        Apply one reservation to the stored TAT.
+
+        Returns:
+            (new_tat, wait) or (tat, None) when the wait would exceed max_wait
+        """
+        tat = max(tat, now)
+        wait = max(0.0, tat - (self.burst - 1) * self.interval - now)
+        if wait > max_wait:
+            return tat, None
+        return tat + self.interval, wait
+
+    @abc.abstractmethod
+    async def _reserve(self, max_wait: float) -> Optional[tuple]:
+        """Reserve a slot; returns (wait_seconds, queue_depth) or None on timeout"""
+
+    async def acquire(self, max_wait: Optional[float] = None):
+        if self.rate <= 0:
+            return
+        max_wait = self.max_wait if max_wait is None else max_wait
+        reservation = await self._reserve(max_wait)
+        if reservation is None:
+            self.timeouts += 1
+            raise RateLimitTimeout(f"No {self.backend} rate limit slot within {max_wait:.0f}s")
+        wait, depth = reservation
+        self.acquired += 1
+        self.last_queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        if wait > 0:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+
+    def _queue_depth(self, tat: float, now: float) -> int:
+        """Reservations ahead of the caller across every process sharing the state"""
+        if not self.interval:
+            return 0
+        return max(0, int(round((tat - now) / self.interval)))
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "rate": self.rate,
+            "burst": self.burst,
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "waiting": self.waiting,
+            "maxWaiting": self.max_waiting,
+            "queueDepth": self.last_queue_depth,
+            "maxQueueDepth": self.max_queue_depth,
+            "avgWaitMs": round(self._wait_total / self.acquired * 1000, 1) if self.acquired else 0.0,
+            "maxWaitMs": round(self._wait_max * 1000, 1),
+        }
+
+
+class LocalRateLimiter(RateLimiter):
+    """Per-process limiter; enough for a single uvicorn worker"""
+
+    backend = "local"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tat = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _reserve(self, max_wait: float):
+        async with self._lock:
+            now = time.time()
+            self._tat, wait = self._gcra(self._tat, now, max_wait)
+            if wait is None:
+                return None
+            return wait, self._queue_depth(self._tat - self.interval, now)
+
+
+class FileRateLimiter(RateLimiter):
+    """
+    Host-wide limiter: the TAT lives in a small mmap'd file guarded by flock,
+    so every worker process on the machine shares one budget.
+    """
+
+    backend = "file"
+
+    def __init__(self, *args, path: str = GEOCODER_RATE_LIMIT_FILE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self._fd: Optional[int] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    def _open(self):
+        if self._mmap is None:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            if os.fstat(fd).st_size < _TAT.size:
+                os.ftruncate(fd, _TAT.size)
+            self._fd = fd
+            self._mmap = mmap.mmap(fd, _TAT.size)
+
+    def _reserve_sync(self, max_wait: float):
+        self._open()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            (tat,) = _TAT.unpack_from(self._mmap, 0)
+            new_tat, wait = self._gcra(tat, now, max_wait)
+            if wait is None:
+                return None
+            _TAT.pack_into(self._mmap, 0, new_tat)
+            return wait, self._queue_depth(new_tat - self.interval, now)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    async def _reserve(self, max_wait: float):
+        return await asyncio.to_thread(self._reserve_sync, max_wait)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            os.close(self._fd)
+            self._mmap = None
+            self._fd = None
+
+
+class PostgresRateLimiter(RateLimiter):
+    """
+    Cluster-wide limiter: the TAT is one row in "RateLimitBucket" and each
+    reservation is a single conditional UPDATE, so the row lock serializes
+    callers from every host.
+    """
+
+    backend = "postgres"
+
+    def __init__(self, *args, name: str = "geocoder", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self._initialized = False
+
+    async def _reserve(self, max_wait: float):
+        from database import db
+
+        if not self._initialized:
+            await db.execute_raw(
+                '''
+                INSERT INTO "RateLimitBucket" (name, tat)
+                VALUES ($1, 0)
+                ON CONFLICT (name) DO NOTHING
+                ''',
+                self.name
+            )
+            self._initialized = True
+        # Same arithmetic as RateLimiter._gcra, evaluated inside the UPDATE
+        rows = await db.query_raw(
+            '''
+            WITH clock AS (SELECT EXTRACT(EPOCH FROM clock_timestamp())::double precision AS now)
+            UPDATE "RateLimitBucket" b
+            SET tat = GREATEST(b.tat, clock.now) + $2::double precision
+            FROM clock
+            WHERE b.name = $1
+              AND GREATEST(b.tat, clock.now) - ($3::int - 1) * $2::double precision - clock.now
+                  <= $4::double precision
+            RETURNING GREATEST(0, b.tat - $3::int * $2::double precision - clock.now) AS wait,
+                      b.tat - $2::double precision - clock.now AS backlog
+            ''',
+            self.name, self.interval, self.burst, max_wait
+        )
+        if not rows:
+            return None
+        backlog = rows[0]["backlog"]
+        return rows[0]["wait"], max(0, int(round(backlog / self.interval)))
+
+
+def create_rate_limiter(
+    backend: str = GEOCODER_RATE_LIMITER,
+    rate: float = GEOCODER_RATE,
+    burst: int = GEOCODER_BURST,
+) -> RateLimiter:
+    if backend == "file":
+        return FileRateLimiter(rate, burst)
+    if backend == "postgres":
+        return PostgresRateLimiter(rate, burst)
+    if backend == "local":
+        return LocalRateLimiter(rate, burst)
+    raise ValueError(f"Unknown rate limiter backend {backend!r}; use 'local', 'file' or 'postgres'")
@@ -0,0 +1,187 @@
+"""
+Pickup routing for carpool groups.
+
+A group drives origin (the driver's home) -> each passenger's pickup ->
+destination (the driver's office). A pickup's detour is how much longer the
+whole drive gets because of it, so passengers already in the group count -
+not the distance to a straight origin->destination line. Distances are
+great-circle; there is no road network.
+
+Everything is NumPy over (groups, candidates, pickup orders): the length of
+every visiting order for every group/candidate pair is one array
+expression, so ranking dozens of groups for a passenger, or dozens of
+passengers for a group, is a single batched computation. Groups hold at most
+6 people, i.e. 5 pickups, so trying every order (5! = 120) is exact and
+still cheap.
+"""
+from functools import lru_cache
+from itertools import permutations
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+from geo import EARTH_RADIUS_METERS
+
+# Routes with more pickups than this keep their order and use cheapest insertion
+MAX_EXACT_PICKUPS = 6
+
+
+def pairwise_meters(a, b) -> np.ndarray:
+    """Great-circle distances from points a (..., n, 2) to b (..., m, 2), given as (lat, lng); shape (..., n, m)"""
+    a = np.radians(np.asarray(a, dtype=np.float64))
+    b = np.radians(np.asarray(b, dtype=np.float64))
+    lat1, lng1 = a[..., :, None, 0], a[..., :, None, 1]
+    lat2, lng2 = b[..., None, :, 0], b[..., None, :, 1]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def segment_distances(point, starts, ends) -> np.ndarray:
+    """
+    Meters from point (lat, lng) to each segment starts[i] -> ends[i], given
+    as (n, 2) arrays. Uses an equirectangular projection centred on the
+    point, which is well within 1% of the geodesic distance at commute
+    scales.
+    """
+    lat0, lng0 = np.radians(np.asarray(point, dtype=np.float64))
+    starts = np.radians(np.asarray(starts, dtype=np.float64).reshape(-1, 2))
+    ends = np.radians(np.asarray(ends, dtype=np.float64).reshape(-1, 2))
+    scale = np.cos(lat0)
+    ax, ay = (starts[:, 1] - lng0) * scale, starts[:, 0] - lat0
+    bx, by = (ends[:, 1] - lng0) * scale, ends[:, 0] - lat0
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    # Closest point on each segment to the origin of the projection (the point)
+    t = np.clip(-(ax * dx + ay * dy) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+    return EARTH_RADIUS_METERS * np.hypot(ax + t * dx, ay + t * dy)
+
+
+@lru_cache(maxsize=None)
+def _sequences(k: int) -> np.ndarray:
+    """Every stop sequence [0, <pickups 1..k in some order>, k + 1]; shape (k!, k + 2)"""
+    orders = np.array(list(permutations(range(1, k + 1))), dtype=np.int64).reshape(-1 if k else 1, k)
+    ends = np.ones((len(orders), 1), dtype=np.int64)
+    return np.hstack([0 * ends, orders, (k + 1) * ends])
+
+
+def _route_lengths(stops: np.ndarray) -> np.ndarray:
+    """Length of each (G, s, 2) stop sequence driven in the given order; shape (G,)"""
+    legs = pairwise_meters(stops[:, :-1, None, :], stops[:, 1:, None, :])
+    return legs[..., 0, 0].sum(axis=1)
+
+
+def best_orders(stops) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Shortest visiting order of each group's pickups.
+
+    Args:
+        stops: (G, k + 2, 2) [origin, k pickups, destination] per group
+
+    Returns:
+        (orders, lengths): pickup indices 0..k-1 in visiting order (G, k)
+        and the route length in meters (G,)
+    """
+    stops = np.asarray(stops, dtype=np.float64)
+    groups, k = stops.shape[0], stops.shape[1] - 2
+    if k > MAX_EXACT_PICKUPS:
+        return np.tile(np.arange(k), (groups, 1)), _route_lengths(stops)
+    sequences = _sequences(k)
+    distances = pairwise_meters(stops, stops)
+    lengths = distances[:, sequences[:, :-1], sequences[:, 1:]].sum(axis=2)
+    best = lengths.argmin(axis=1)
+    return sequences[best, 1:-1] - 1, lengths[np.arange(groups), best]
+
+
+def join_costs(stops, candidates) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cost of adding each candidate pickup to each group, re-ordering pickups
+    optimally.
+
+    Args:
+        stops: (G, k + 2, 2) each group's current route in driving order
+        candidates: (n, 2) pickups to try on every group, or (G, n, 2)
+
+    Returns:
+        (added, orders): meters the best route through the candidate adds to
+        the current route (G, n), and its visiting order (G, n, k + 1) where
+        index k is the candidate
+    """
+    stops = np.asarray(stops, dtype=np.float64)
+    groups, s = stops.shape[:2]
+    k = s - 2
+    candidates = np.broadcast_to(np.asarray(candidates, dtype=np.float64), (groups,) + np.shape(candidates)[-2:])
+    current = _route_lengths(stops)
+    to_stops = pairwise_meters(candidates, stops)  # (G, n, s)
+    if k + 1 > MAX_EXACT_PICKUPS:
+        return _cheapest_insertion(stops, to_stops, current)
+
+    # Sequences over k + 1 pickups; pickup k + 1 stands for the candidate and
+    # k + 2 for the destination. `ext` maps those indices back to stops.
+    sequences = _sequences(k + 1)
+    ext = np.r_[np.arange(k + 1), 0, k + 1]
+    fixed = pairwise_meters(stops, stops)[:, ext][:, :, ext]
+    fixed[:, k + 1, :] = 0
+    fixed[:, :, k + 1] = 0
+    # Length of the legs that do not touch the candidate: (G, P)
+    fixed_lengths = fixed[:, sequences[:, :-1], sequences[:, 1:]].sum(axis=2)
+    # The candidate's neighbours in each sequence
+    at = (sequences == k + 1).argmax(axis=1)
+    rows = np.arange(len(sequences))
+    before, after = ext[sequences[rows, at - 1]], ext[sequences[rows, at + 1]]
+    lengths = fixed_lengths[:, None, :] + to_stops[:, :, before] + to_stops[:, :, after]  # (G, n, P)
+    best = lengths.argmin(axis=2)
+    added = np.take_along_axis(lengths, best[..., None], axis=2)[..., 0] - current[:, None]
+    return added, sequences[best, 1:-1] - 1
+
+
+def _cheapest_insertion(stops: np.ndarray, to_stops: np.ndarray, current: np.ndarray):
+    """join_costs for long routes: keep the order, insert into the cheapest leg"""
+    k = stops.shape[1] - 2
+    legs = pairwise_meters(stops[:, :-1, None, :], stops[:, 1:, None, :])[..., 0, 0]  # (G, s - 1)
+    extra = to_stops[:, :, :-1] + to_stops[:, :, 1:] - legs[:, None, :]
+    leg = extra.argmin(axis=2)
+    added = np.take_along_axis(extra, leg[..., None], axis=2)[..., 0]
+    slots = np.arange(k + 1)
+    at = leg[..., None]
+    orders = np.where(slots < at, slots, np.where(slots == at, k, slots - 1))
+    return added, orders
+
+
+def join_costs_many(routes: Sequence, candidate) -> np.ndarray:
+    """
+    Meters one candidate pickup adds to each route, for routes with
+    different numbers of pickups. Routes are bucketed by pickup count and
+    each bucket is one join_costs call.
+
+    Args:
+        routes: [origin, *pickups, destination] point lists, in driving order
+        candidate: (lat, lng)
+    """
+    added = np.empty(len(routes), dtype=np.float64)
+    buckets = {}
+    for i, route in enumerate(routes):
+        buckets.setdefault(len(route), []).append(i)
+    for indices in buckets.values():
+        stops = np.array([routes[i] for i in indices], dtype=np.float64)
+        added[indices] = join_costs(stops, [candidate])[0][:, 0]
+    return added
+
+
+def plan_pickups(origin, destination, pickups: Sequence) -> Tuple[List[int], List[float], float]:
+    """
+    Best pickup order for one group and what each pickup costs.
+
+    Returns:
+        (order, detours, length): indices into pickups in visiting order,
+        meters each pickup adds (best route with everyone minus best route
+        without that pickup), and the route length in meters
+    """
+    k = len(pickups)
+    stops = np.array([origin, *pickups, destination], dtype=np.float64).reshape(1, k + 2, 2)
+    orders, lengths = best_orders(stops)
+    if k == 0:
+        return [], [], float(lengths[0])
+    without = np.stack([np.delete(stops[0], i + 1, axis=0) for i in range(k)])
+    _, lengths_without = best_orders(without)
+    detours = np.maximum(lengths[0] - lengths_without, 0.0)
+    return orders[0].tolist(), detours.tolist(), float(lengths[0])
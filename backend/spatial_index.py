@@ -0,0 +1,297 @@
+"""
+In-process spatial index over geocoded home and work addresses.
+
+Lets the search endpoints answer radius and nearest-neighbour queries
+without PostGIS. Points are bucketed into a uniform lat/lng grid and kept in
+NumPy arrays sorted by cell, so one grid row of a query's bounding box is a
+single contiguous slice found with searchsorted. Distances are exact
+haversine distances computed on the candidates only.
+
+Updates (an address geocoded by the worker) go into a small overlay that is
+merged into the sorted arrays once it grows past SPATIAL_INDEX_MERGE_AT.
+Each process also reloads from the database every
+SPATIAL_INDEX_RELOAD_SECONDS to pick up writes made by other processes.
+
+Longitudes are not wrapped at the antimeridian; every office is in the US.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from geo import EARTH_RADIUS_METERS
+
+logger = logging.getLogger(__name__)
+
+SPATIAL_INDEX_ENABLED = os.getenv("SPATIAL_INDEX_ENABLED", "true").lower() == "true"
+# ~11 km cells: a 10 mile search touches about 3x3 of them
+SPATIAL_INDEX_CELL_DEGREES = float(os.getenv("SPATIAL_INDEX_CELL_DEGREES", "0.1"))
+SPATIAL_INDEX_MERGE_AT = int(os.getenv("SPATIAL_INDEX_MERGE_AT", "256"))
+SPATIAL_INDEX_RELOAD_SECONDS = float(os.getenv("SPATIAL_INDEX_RELOAD_SECONDS", "300"))
+# How far nearest() looks when the caller sets no cap
+NEAREST_MAX_RADIUS_METERS = 200000
+
+_METERS_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_METERS / 180
+_LNG_CELLS = int(math.ceil(360 / SPATIAL_INDEX_CELL_DEGREES)) + 1
+
+
+def _haversine(lat, lng, lats, lngs):
+    """Vectorized haversine distance in meters from one point to many"""
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    dphi = phi2 - phi1
+    dlmb = np.radians(lngs - lng)
+    a = np.sin(dphi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    def __init__(self, name: str, cell_degrees: float = SPATIAL_INDEX_CELL_DEGREES):
+        self.name = name
+        self.cell_degrees = cell_degrees
+        self._ids = np.empty(0, dtype=np.int64)
+        self._lats = np.empty(0, dtype=np.float64)
+        self._lngs = np.empty(0, dtype=np.float64)
+        self._cells = np.empty(0, dtype=np.int64)
+        self._positions: Dict[int, Tuple[float, float]] = {}
+        # user_id -> (lat, lng), or None for a removed point, not yet merged
+        self._overlay: Dict[int, Optional[Tuple[float, float]]] = {}
+        self.loaded = False
+        self.queries = 0
+        self.merges = 0
+        self._query_seconds = 0.0
+
+    def _cell(self, lat, lng):
+        row = np.floor((np.asarray(lat) + 90) / self.cell_degrees).astype(np.int64)
+        col = np.floor((np.asarray(lng) + 180) / self.cell_degrees).astype(np.int64)
+        return row * _LNG_CELLS + col
+
+    def load(self, points: Iterable[Tuple[int, float, float]]):
+        """Replace the contents with (user_id, lat, lng) points"""
+        self._positions = {int(uid): (float(lat), float(lng)) for uid, lat, lng in points}
+        self._overlay = {}
+        self._rebuild()
+        self.loaded = True
+
+    def _rebuild(self):
+        n = len(self._positions)
+        ids = np.fromiter(self._positions.keys(), dtype=np.int64, count=n)
+        coords = np.array(list(self._positions.values()), dtype=np.float64).reshape(n, 2)
+        cells = self._cell(coords[:, 0], coords[:, 1])
+        order = np.argsort(cells, kind="stable")
+        self._ids = ids[order]
+        self._lats = coords[order, 0].copy()
+        self._lngs = coords[order, 1].copy()
+        self._cells = cells[order]
+
+    def upsert(self, user_id: int, lat: float, lng: float):
+        self._overlay[user_id] = (lat, lng)
+        self._maybe_merge()
+
+    def remove(self, user_id: int):
+        self._overlay[user_id] = None
+        self._maybe_merge()
+
+    def _maybe_merge(self):
+        if len(self._overlay) < SPATIAL_INDEX_MERGE_AT:
+            return
+        for user_id, coords in self._overlay.items():
+            if coords is None:
+                self._positions.pop(user_id, None)
+            else:
+                self._positions[user_id] = coords
+        self._overlay = {}
+        self._rebuild()
+        self.merges += 1
+
+    def position(self, user_id: int) -> Optional[Tuple[float, float]]:
+        if user_id in self._overlay:
+            return self._overlay[user_id]
+        return self._positions.get(user_id)
+
+    def __len__(self) -> int:
+        return len(self._positions) + sum(
+            (coords is not None) - (uid in self._positions) for uid, coords in self._overlay.items()
+        )
+
+    def _candidates(self, lat: float, lng: float, radius_meters: float):
+        """Row indices of base points inside the query's bounding box cells"""
+        dlat = radius_meters / _METERS_PER_DEGREE_LAT
+        cos_lat = max(math.cos(math.radians(min(89.0, abs(lat) + dlat))), 1e-6)
+        dlng = min(180.0, dlat / cos_lat)
+        return self._box_rows(lat - dlat, lng - dlng, lat + dlat, lng + dlng)
+
+    def _box_rows(self, south: float, west: float, north: float, east: float):
+        """Row indices of base points in the cells covering a lat/lng box"""
+        row_lo, row_hi = (int(math.floor((lat + 90) / self.cell_degrees)) for lat in (south, north))
+        col_lo, col_hi = (int(math.floor((lng + 180) / self.cell_degrees)) for lng in (west, east))
+        starts = np.arange(row_lo, row_hi + 1, dtype=np.int64) * _LNG_CELLS
+        lo = np.searchsorted(self._cells, starts + col_lo, side="left")
+        hi = np.searchsorted(self._cells, starts + col_hi, side="right")
+        slices = [np.arange(a, b) for a, b in zip(lo, hi) if b > a]
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def within(
+        self,
+        lat: float,
+        lng: float,
+        radius_meters: float,
+        exclude: Optional[int] = None,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[float, int]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        (user_id, distance_meters) within the radius, ordered by distance then
+        id. after=(distance, id) skips everything up to and including that
+        key, for keyset pagination.
+        """
+        started = time.perf_counter()
+        rows = self._candidates(lat, lng, radius_meters)
+        ids = self._ids[rows]
+        dists = _haversine(lat, lng, self._lats[rows], self._lngs[rows])
+        keep = dists <= radius_meters
+        if self._overlay:
+            # Base entries that were moved or removed are answered by the overlay
+            keep &= ~np.isin(ids, np.fromiter(self._overlay.keys(), dtype=np.int64))
+        if exclude is not None:
+            keep &= ids != exclude
+        ids, dists = ids[keep], dists[keep]
+
+        overlay = [(uid, c) for uid, c in self._overlay.items() if c is not None and uid != exclude]
+        if overlay:
+            o_ids = np.array([uid for uid, _ in overlay], dtype=np.int64)
+            o_coords = np.array([c for _, c in overlay], dtype=np.float64)
+            o_dists = _haversine(lat, lng, o_coords[:, 0], o_coords[:, 1])
+            o_keep = o_dists <= radius_meters
+            ids = np.concatenate([ids, o_ids[o_keep]])
+            dists = np.concatenate([dists, o_dists[o_keep]])
+
+        if after is not None:
+            after_dist, after_id = after
+            keep = (dists > after_dist) | ((dists == after_dist) & (ids > after_id))
+            ids, dists = ids[keep], dists[keep]
+        if limit is not None and len(dists) > limit:
+            # Keep every point tied with the limit-th distance so the id
+            # tiebreak below decides which of them make the cut
+            kth = np.partition(dists, limit - 1)[limit - 1]
+            top = dists <= kth
+            ids, dists = ids[top], dists[top]
+        order = np.lexsort((ids, dists))
+        if limit is not None:
+            order = order[:limit]
+        self.queries += 1
+        self._query_seconds += time.perf_counter() - started
+        return [(int(i), float(d)) for i, d in zip(ids[order], dists[order])]
+
+    def points_in_box(self, south: float, west: float, north: float, east: float):
+        """(ids, lats, lngs) arrays of every point inside a lat/lng box, in no particular order"""
+        rows = self._box_rows(south, west, north, east)
+        ids, lats, lngs = self._ids[rows], self._lats[rows], self._lngs[rows]
+        if self._overlay:
+            keep = ~np.isin(ids, np.fromiter(self._overlay.keys(), dtype=np.int64))
+            overlay = [(uid, c) for uid, c in self._overlay.items() if c is not None]
+            ids = np.concatenate([ids[keep], np.array([uid for uid, _ in overlay], dtype=np.int64)])
+            lats = np.concatenate([lats[keep], np.array([c[0] for _, c in overlay], dtype=np.float64)])
+            lngs = np.concatenate([lngs[keep], np.array([c[1] for _, c in overlay], dtype=np.float64)])
+        inside = (lats >= south) & (lats <= north) & (lngs >= west) & (lngs <= east)
+        return ids[inside], lats[inside], lngs[inside]
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int,
+        exclude: Optional[int] = None,
+        max_radius_meters: Optional[float] = None,
+        after: Optional[Tuple[float, int]] = None
+    ) -> List[Tuple[int, float]]:
+        """The k nearest (user_id, distance_meters) within max_radius_meters, after the given key"""
+        # Widen the search ring until it holds k points; everything inside the
+        # ring is found, so the k closest of them are the true k nearest
+        if max_radius_meters is None:
+            max_radius_meters = NEAREST_MAX_RADIUS_METERS
+        radius = self.cell_degrees * _METERS_PER_DEGREE_LAT
+        while True:
+            radius = min(radius, max_radius_meters)
+            found = self.within(lat, lng, radius, exclude=exclude, limit=k, after=after)
+            if len(found) >= k or radius >= max_radius_meters:
+                return found
+            radius *= 2
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self.loaded,
+            "points": len(self),
+            "pendingUpdates": len(self._overlay),
+            "merges": self.merges,
+            "queries": self.queries,
+            "avgQueryUs": round(self._query_seconds / self.queries * 1e6, 1) if self.queries else 0.0,
+        }
+
+
+class SpatialIndexes:
+    """Home and work indexes, loaded from the database and kept fresh"""
+
+    def __init__(self):
+        self.home = SpatialIndex("home")
+        self.work = SpatialIndex("work")
+        self._task: Optional[asyncio.Task] = None
+        self.last_loaded: Optional[float] = None
+
+    def get(self, kind: str) -> SpatialIndex:
+        """kind is "home" or "work" ("company" is accepted for work)"""
+        return self.home if kind == "home" else self.work
+
+    async def load(self):
+        from database import db
+
+        started = time.perf_counter()
+        for index, table in ((self.home, "HomeAddress"), (self.work, "CompanyAddress")):
+            rows = await db.query_raw(
+                f'''
+                SELECT "userId", latitude, longitude
+                FROM "{table}"
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+                '''
+            )
+            index.load((r["userId"], r["latitude"], r["longitude"]) for r in rows)
+        self.last_loaded = time.time()
+        logger.info(
+            f"Loaded spatial indexes: {len(self.home)} homes, {len(self.work)} offices "
+            f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Spatial index load failed: {e}")
+            await asyncio.sleep(SPATIAL_INDEX_RELOAD_SECONDS)
+
+    def stats(self) -> dict:
+        return {
+            "home": self.home.stats(),
+            "work": self.work.stats(),
+            "lastLoadedAgeSeconds": round(time.time() - self.last_loaded) if self.last_loaded else None,
+        }
+
+
+spatial_indexes = SpatialIndexes()
@@ -1,11 +1,154 @@
 """
 Storage abstraction layer for handling file uploads to local disk or AWS S3
+
+Uploads are streamed: the request body is read in chunks and sent to S3/R2
+as a multipart upload (a single PUT when it fits in one part), so a file is
+never held in memory in full. boto3 is synchronous, so every S3 call runs
+in a worker thread, and STORAGE_UPLOAD_CONCURRENCY caps how many uploads
+are in flight at once.
+
+Point S3_ENDPOINT at any S3-compatible server (e.g. a local MinIO) to run
+against a stand-in instead of AWS/R2/B2.
+
+STORAGE_TYPE:
+    local  uploads/<timestamp>_<filename>
+    cas    content-addressed, deduplicated uploads/ab/cd/<sha256>.<ext>
+           (see content_store.py)
+    s3     S3/R2/B2, falling back to local on errors
 """
+import asyncio
+import io
 import os
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import unquote, urlparse
+import aiofiles
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
 from typing import Optional
+from content_store import CONTENT_PATH, ContentStore
+
+# S3 requires every part except the last to be at least 5 MiB
+STORAGE_PART_SIZE = max(5 * 1024 * 1024, int(os.getenv("STORAGE_PART_SIZE", str(8 * 1024 * 1024))))
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "4"))
+# Size of each read from the incoming request body
+STORAGE_READ_CHUNK = 1024 * 1024
+# Presigned GET URLs: lifetime, and how long before expiry a cached one is re-signed
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", "604800"))  # 7 days (the S3 maximum)
+PRESIGNED_URL_REFRESH_MARGIN = int(os.getenv("PRESIGNED_URL_REFRESH_MARGIN", "86400"))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000"))
+
+
+class UploadStats:
+    """Throughput and latency of completed uploads"""
+
+    def __init__(self, window: int = 500):
+        self.uploads = 0
+        self.failures = 0
+        self.multipart = 0
+        self.bytes = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self._busy_seconds = 0.0
+        self._latencies = deque(maxlen=window)
+
+    def record(self, size: int, seconds: float, multipart: bool):
+        self.uploads += 1
+        self.multipart += int(multipart)
+        self.bytes += size
+        self._busy_seconds += seconds
+        self._latencies.append(seconds)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1)
+
+        return {
+            "uploads": self.uploads,
+            "failures": self.failures,
+            "multipart": self.multipart,
+            "bytes": self.bytes,
+            "inFlight": self.in_flight,
+            "waiting": self.waiting,
+            "throughputMBps": round(self.bytes / self._busy_seconds / 1e6, 2) if self._busy_seconds else 0.0,
+            "latencyP50Ms": percentile(0.5),
+            "latencyP95Ms": percentile(0.95),
+            "latencyMaxMs": percentile(1.0),
+        }
+
+
+class PresignedUrlCache:
+    """
+    LRU of signed URLs keyed by object key.
+
+    A cached URL is reused until it is within refresh_margin of expiring, so a
+    URL handed to a client always stays valid for at least that long.
+    """
+
+    def __init__(
+        self,
+        max_size: int = PRESIGNED_URL_CACHE_SIZE,
+        ttl: int = PRESIGNED_URL_TTL,
+        refresh_margin: int = PRESIGNED_URL_REFRESH_MARGIN,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh_margin = min(refresh_margin, ttl // 2)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, key: str, sign) -> str:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] - self.refresh_margin > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if entry is None:
+            self.misses += 1
+        else:
+            self.refreshes += 1
+        url = sign(key, self.ttl)
+        with self._lock:
+            self._entries[key] = (url, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return url
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.refreshes
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hitRate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class _BytesUpload:
+    """Minimal async file wrapper so in-memory content can use the streaming path"""
+
+    def __init__(self, content: bytes):
+        self._buffer = io.BytesIO(content)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._buffer.read(size)
+
+    async def seek(self, offset: int):
+        self._buffer.seek(offset)
+
 
 class StorageService:
     def __init__(self):
@@ -16,12 +159,16 @@ class StorageService:
         
         if self.storage_type == "s3":
             # Support for Cloudflare R2 and other S3-compatible services
-            endpoint_url = os.getenv("R2_ENDPOINT") or os.getenv("B2_ENDPOINT")
+            # S3_ENDPOINT is for local stand-ins such as MinIO
+            endpoint_url = os.getenv("S3_ENDPOINT") or os.getenv("R2_ENDPOINT") or os.getenv("B2_ENDPOINT")
+            self.presign_urls = endpoint_url is not None
             
             # R2 requires signature v4
             config = Config(
                 signature_version='s3v4',
-                s3={'addressing_style': 'path'}
+                s3={'addressing_style': 'path'},
+                # One pooled connection per concurrent upload
+                max_pool_connections=max(10, STORAGE_UPLOAD_CONCURRENCY)
             )
             
             self.s3_client = boto3.client(
@@ -33,57 +180,218 @@ class StorageService:
                 config=config
             )
             self.bucket_name = os.getenv("AWS_S3_BUCKET")
+            self.url_cache = PresignedUrlCache()
         else:
             os.makedirs(self.upload_dir, exist_ok=True)
+        
+        self.content_store = ContentStore(self.upload_dir) if self.storage_type == "cas" else None
+        self.upload_stats = UploadStats()
+        self._upload_slots: Optional[asyncio.Semaphore] = None
     
-    async def save_file(self, file_content: bytes, filename: str) -> str:
+    async def save_upload(self, upload, filename: str) -> str:
         """
-        Save file to S3/R2/B2 with fallback to local storage
+        Stream an UploadFile to S3/R2/B2 with fallback to local storage
         """
         if self.storage_type == "s3":
             try:
-                return await self._save_to_s3(file_content, filename)
+                return await self._save_to_s3(upload, filename)
             except Exception as e:
                 print(f"[WARNING] S3 upload failed, falling back to local: {e}")
-                return self._save_to_local(file_content, filename)
+                await upload.seek(0)
+                return await self._save_to_local(upload, filename)
+        elif self.content_store is not None:
+            rel_path = await self.content_store.put(upload, filename)
+            return f"/uploads/{rel_path}"
         else:
-            return self._save_to_local(file_content, filename)
+            return await self._save_to_local(upload, filename)
     
-    def _save_to_local(self, file_content: bytes, filename: str) -> str:
-        """Save file to local disk"""
+    async def save_file(self, file_content: bytes, filename: str) -> str:
+        """
+        Save in-memory content (e.g. generated thumbnails) with the same fallback rules
+        """
+        return await self.save_upload(_BytesUpload(file_content), filename)
+    
+    async def delete_file(self, file_path: str):
+        """
+        Drop a stored file. Content-addressed files are reference counted and
+        only removed once nothing refers to them any more.
+        """
+        if file_path.startswith("/uploads/"):
+            rel_path = file_path[len("/uploads/"):]
+            if self.content_store is not None and CONTENT_PATH.match(rel_path):
+                await self.content_store.release(rel_path)
+            else:
+                local_path = os.path.join(self.upload_dir, rel_path)
+                if os.path.isfile(local_path):
+                    await asyncio.to_thread(os.unlink, local_path)
+        elif self.storage_type == "s3":
+            await asyncio.to_thread(self.s3_client.delete_object, Bucket=self.bucket_name, Key=self._key_from_url(file_path))
+    
+    async def load_file(self, file_path: str) -> Optional[bytes]:
+        """
+        Read back a stored file given the path/URL returned by save_upload.
+        Returns None if it no longer exists.
+        """
+        if file_path.startswith("/uploads/"):
+            local_path = os.path.join(self.upload_dir, file_path[len("/uploads/"):])
+            if not os.path.isfile(local_path):
+                return None
+            async with aiofiles.open(local_path, 'rb') as f:
+                return await f.read()
+        if self.storage_type != "s3":
+            return None
+        key = self._key_from_url(file_path)
+        try:
+            response = await asyncio.to_thread(self.s3_client.get_object, Bucket=self.bucket_name, Key=key)
+            return await asyncio.to_thread(response["Body"].read)
+        except ClientError as e:
+            print(f"Error reading {key} from S3: {e}")
+            return None
+    
+    @staticmethod
+    def _key_from_url(url: str) -> str:
+        if not url.startswith(("http://", "https://")):
+            return url  # already an object key
+        # Presigned (path-style) and public URLs both end in .../profiles/<filename>
+        path = unquote(urlparse(url).path)
+        return path[path.index("profiles/"):] if "profiles/" in path else path.lstrip("/")
+    
+    async def _save_to_local(self, upload, filename: str) -> str:
+        """Stream file to local disk"""
         os.makedirs(self.upload_dir, exist_ok=True)
         file_path = os.path.join(self.upload_dir, filename)
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
+        async with aiofiles.open(file_path, 'wb') as f:
+            while chunk := await upload.read(STORAGE_READ_CHUNK):
+                await f.write(chunk)
         return f"/uploads/{filename}"
     
-    async def _save_to_s3(self, file_content: bytes, filename: str) -> str:
-        """Upload file to S3/R2/B2 and return a presigned URL"""
+    async def _read_part(self, upload) -> bytes:
+        """Read up to one multipart part from the request body"""
+        buffer = bytearray()
+        while len(buffer) < STORAGE_PART_SIZE:
+            chunk = await upload.read(min(STORAGE_READ_CHUNK, STORAGE_PART_SIZE - len(buffer)))
+            if not chunk:
+                break
+            buffer += chunk
+        return bytes(buffer)
+    
+    async def _save_to_s3(self, upload, filename: str) -> str:
+        """Stream file to S3/R2/B2 and return its URL"""
+        if self._upload_slots is None:
+            self._upload_slots = asyncio.Semaphore(STORAGE_UPLOAD_CONCURRENCY)
+        
+        self.upload_stats.waiting += 1
+        try:
+            await self._upload_slots.acquire()
+        finally:
+            self.upload_stats.waiting -= 1
+        
+        self.upload_stats.in_flight += 1
+        started = time.perf_counter()
         try:
             key = f"profiles/{filename}"
-            self.s3_client.put_object(
-                Bucket=self.bucket_name,
-                Key=key,
-                Body=file_content,
-                ContentType=self._get_content_type(filename)
-            )
-            
-            # For R2 and B2, generate a presigned URL that's valid for 7 days
-            # This is secure and doesn't require public bucket access
-            if os.getenv("R2_ENDPOINT") or os.getenv("B2_ENDPOINT"):
-                presigned_url = self.s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': self.bucket_name, 'Key': key},
-                    ExpiresIn=604800  # 7 days in seconds
+            content_type = self._get_content_type(filename)
+            first = await self._read_part(upload)
+            if len(first) < STORAGE_PART_SIZE:
+                # Fits in one part: a plain PUT is one round trip instead of three
+                await asyncio.to_thread(
+                    self.s3_client.put_object,
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    Body=first,
+                    ContentType=content_type
                 )
-                return presigned_url
+                size, multipart = len(first), False
             else:
-                # AWS S3 public URL (if bucket is public)
-                region = os.getenv('AWS_REGION', 'us-east-1')
-                return f"https://{self.bucket_name}.s3.{region}.amazonaws.com/{key}"
+                size, multipart = await self._multipart_upload(upload, key, content_type, first), True
+            self.upload_stats.record(size, time.perf_counter() - started, multipart)
+            # Only the key is stored; URLs are signed when responses are built
+            return key
         except ClientError as e:
+            self.upload_stats.failures += 1
             print(f"Error uploading to S3: {e}")
             raise Exception(f"Failed to upload file to S3: {str(e)}")
+        except BaseException:
+            self.upload_stats.failures += 1
+            raise
+        finally:
+            self.upload_stats.in_flight -= 1
+            self._upload_slots.release()
+    
+    async def _multipart_upload(self, upload, key: str, content_type: str, first: bytes) -> int:
+        """
+        Upload the body part by part. The next part is read from the request
+        while the previous one is being sent, so at most two parts are buffered.
+        """
+        created = await asyncio.to_thread(
+            self.s3_client.create_multipart_upload,
+            Bucket=self.bucket_name,
+            Key=key,
+            ContentType=content_type
+        )
+        upload_id = created["UploadId"]
+        parts = []
+        size = 0
+        
+        def send(part_number: int, body: bytes) -> dict:
+            response = self.s3_client.upload_part(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        
+        try:
+            body = first
+            while body:
+                size += len(body)
+                sending = asyncio.ensure_future(asyncio.to_thread(send, len(parts) + 1, body))
+                body = await self._read_part(upload)
+                parts.append(await sending)
+            await asyncio.to_thread(
+                self.s3_client.complete_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            # Don't leave billable orphaned parts behind
+            await asyncio.to_thread(
+                self.s3_client.abort_multipart_upload,
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id
+            )
+            raise
+        return size
+    
+    def _presign(self, key: str, expires_in: int) -> str:
+        # Signing is a local HMAC computation - no network round trip
+        return self.s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket_name, 'Key': key},
+            ExpiresIn=expires_in
+        )
+    
+    def _object_url(self, key: str) -> str:
+        # For R2, B2 and custom endpoints, hand out presigned URLs
+        # This is secure and doesn't require public bucket access
+        if self.presign_urls:
+            return self.url_cache.get(key, self._presign)
+        # AWS S3 public URL (if bucket is public)
+        region = os.getenv('AWS_REGION', 'us-east-1')
+        return f"https://{self.bucket_name}.s3.{region}.amazonaws.com/{key}"
+    
+    def stats(self) -> dict:
+        stats = {"type": self.storage_type, **self.upload_stats.stats()}
+        if self.content_store is not None:
+            stats["contentStore"] = self.content_store.stats()
+        if self.storage_type == "s3":
+            stats["presignedUrlCache"] = self.url_cache.stats()
+        return stats
     
     def _get_content_type(self, filename: str) -> str:
         """Determine content type based on file extension"""
@@ -97,16 +405,24 @@ class StorageService:
         }
         return content_types.get(ext, 'application/octet-stream')
     
-    def get_file_url(self, file_path: str) -> str:
+    def get_file_url(self, file_path: Optional[str]) -> Optional[str]:
         """
-        Convert stored path to accessible URL
-        For S3: return the path as-is (it's already a URL)
-        For local: return the relative path for the static file server
+        Convert a stored path to an accessible URL.
+        For local files: the /uploads/... path for the static file server
+        For S3: a (cached) presigned or public URL for the object key.
+        Rows written before keys were stored hold a full URL; its key is
+        extracted so the link is re-signed instead of going stale.
         """
-        if self.storage_type == "s3":
+        if not file_path or file_path.startswith("/uploads/"):
             return file_path
-        else:
-            # Return just the filename for local static serving
-            return os.path.basename(file_path)
+        if self.storage_type != "s3":
+            return file_path
+        return self._object_url(self._key_from_url(file_path))
+    
+    def get_variant_urls(self, variants: Optional[dict]) -> Optional[dict]:
+        """Resolve every path in a profileVariants map"""
+        if not variants:
+            return variants
+        return {size: self.get_file_url(path) for size, path in variants.items()}
 
 storage_service = StorageService()
@@ -0,0 +1,167 @@
+"""
+Concurrent-vote stress test for cast_group_vote().
+
+Creates throwaway users and groups, fires votes at the same time and checks
+the invariants the function is meant to keep:
+
+- consensus race: every member of a group approves one request at once.
+  Exactly one vote completes the consensus, votesReceived equals the
+  number of voters and the requester joins exactly once.
+- seat race: several requests to a group with one free seat are all
+  approved at once. Exactly one gets the seat, the rest come back "full",
+  and currentOccupancy never passes maxSeats.
+
+Everything it creates is deleted afterwards. Run against a development
+database only:
+    python stress_group_votes.py
+    python stress_group_votes.py --rounds 20 --members 5 --requesters 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
+
+from database import db  # noqa: E402
+
+EMAIL_DOMAIN = "stress-votes.invalid"
+
+
+async def make_users(tag: str, count: int, role: str = "passenger") -> list:
+    users = []
+    for _ in range(count):
+        users.append(await db.user.create({
+            "firstName": "Stress",
+            "lastName": tag,
+            "email": f"{uuid.uuid4().hex}@{EMAIL_DOMAIN}",
+            "role": role,
+            "willingToTake": []
+        }))
+    return users
+
+
+async def make_group(driver, passengers: list, max_seats: int):
+    group = await db.carpoolgroup.create({
+        "name": "stress test",
+        "driverId": driver.id,
+        "maxSeats": max_seats,
+        "currentOccupancy": 1 + len(passengers),
+        "status": "OPEN" if 1 + len(passengers) < max_seats else "FULL"
+    })
+    await db.groupmember.create({"groupId": group.id, "userId": driver.id, "role": "driver", "pickupOrder": 0})
+    for order, passenger in enumerate(passengers, 1):
+        await db.groupmember.create({
+            "groupId": group.id, "userId": passenger.id, "role": "passenger", "pickupOrder": order
+        })
+    return group
+
+
+async def vote(group_id: int, request_id: int, voter_id: int, timings: list) -> str:
+    started = time.perf_counter()
+    rows = await db.query_raw(
+        'SELECT * FROM cast_group_vote($1, $2, $3, $4)',
+        group_id, request_id, voter_id, "approve"
+    )
+    timings.append((time.perf_counter() - started) * 1000)
+    return rows[0]["outcome"]
+
+
+async def consensus_race(tag: str, members: int, timings: list) -> list:
+    """All members approve one request concurrently; returns failed checks"""
+    driver, *passengers = await make_users(tag, members, "driver")
+    requester, = await make_users(tag, 1)
+    group = await make_group(driver, passengers, members + 1)
+    request = await db.grouprequest.create({
+        "groupId": group.id, "userId": requester.id, "votesRequired": members
+    })
+
+    outcomes = await asyncio.gather(*(
+        vote(group.id, request.id, voter.id, timings) for voter in [driver, *passengers]
+    ))
+
+    request = await db.grouprequest.find_unique(where={"id": request.id})
+    group = await db.carpoolgroup.find_unique(where={"id": group.id}, include={"members": True})
+    failures = []
+    if outcomes.count("approved") != 1 or outcomes.count("pending") != members - 1:
+        failures.append(f"consensus outcomes {sorted(outcomes)}")
+    if request.votesReceived != members or request.status != "approved":
+        failures.append(f"request has {request.votesReceived}/{members} votes, status {request.status}")
+    if group.currentOccupancy != members + 1 or len(group.members) != members + 1:
+        failures.append(f"group occupancy {group.currentOccupancy}, {len(group.members)} members")
+    return failures
+
+
+async def seat_race(tag: str, requesters: int, timings: list) -> list:
+    """Many requests race for the last seat; returns failed checks"""
+    driver, passenger = await make_users(tag, 2, "driver")
+    group = await make_group(driver, [passenger], 3)
+    candidates = await make_users(tag, requesters)
+    requests = [
+        await db.grouprequest.create({"groupId": group.id, "userId": c.id, "votesRequired": 2})
+        for c in candidates
+    ]
+    # The passenger has already approved everyone; the driver's votes race
+    for r in requests:
+        await vote(group.id, r.id, passenger.id, [])
+
+    outcomes = await asyncio.gather(*(vote(group.id, r.id, driver.id, timings) for r in requests))
+
+    group = await db.carpoolgroup.find_unique(where={"id": group.id}, include={"members": True})
+    failures = []
+    if outcomes.count("approved") != 1 or outcomes.count("full") != requesters - 1:
+        failures.append(f"seat race outcomes {sorted(outcomes)}")
+    if group.currentOccupancy != 3 or len(group.members) != 3 or group.status != "FULL":
+        failures.append(
+            f"group occupancy {group.currentOccupancy}/{group.maxSeats}, "
+            f"{len(group.members)} members, status {group.status}"
+        )
+    return failures
+
+
+async def cleanup():
+    users = await db.user.find_many(where={"email": {"endswith": f"@{EMAIL_DOMAIN}"}})
+    ids = [u.id for u in users]
+    if ids:
+        # Requests, members and votes go with their groups
+        await db.carpoolgroup.delete_many(where={"driverId": {"in": ids}})
+        await db.user.delete_many(where={"id": {"in": ids}})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Stress-test concurrent group votes")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--members", type=int, default=5, help="Voters per consensus race (group has members + 1 seats)")
+    parser.add_argument("--requesters", type=int, default=6, help="Requests racing for the last seat")
+    args = parser.parse_args()
+
+    await db.connect()
+    timings = []
+    failures = []
+    try:
+        for round_number in range(1, args.rounds + 1):
+            tag = f"round {round_number}"
+            failures += [f"{tag}: {f}" for f in await consensus_race(tag, args.members, timings)]
+            failures += [f"{tag}: {f}" for f in await seat_race(tag, args.requesters, timings)]
+    finally:
+        await cleanup()
+        await db.disconnect()
+
+    timings.sort()
+    print(
+        f"{len(timings)} concurrent votes: p50 {statistics.median(timings):.1f} ms, "
+        f"p95 {timings[int(len(timings) * 0.95)]:.1f} ms, max {timings[-1]:.1f} ms"
+    )
+    if failures:
+        for failure in failures:
+            print(f"FAIL {failure}")
+        raise SystemExit(1)
+    print(f"OK: {args.rounds} rounds, no lost votes, no overfilled groups")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
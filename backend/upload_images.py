@@ -1,5 +1,31 @@
+"""
+Bulk-copy backend/uploads to the S3/R2/B2 bucket and point users at it.
+
+- lists the bucket prefix once to learn which keys already exist (ETag/size)
+- skips files whose size and MD5 already match the remote object
+- uploads the rest from a thread pool, retrying failures with backoff
+- records progress in a manifest, so an interrupted run resumes without
+  re-hashing or re-uploading finished files
+- rewrites User.profilePath / profileVariants from /uploads/... to the
+  object key in batched UPDATEs (see StorageService.get_file_url)
+
+Usage:
+    python upload_images.py
+    python upload_images.py --workers 32 --no-db
+    python upload_images.py --dry-run
+"""
+import argparse
+import asyncio
+import hashlib
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -7,23 +33,239 @@ load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
 uploads_dir = os.path.join(os.path.dirname(__file__), "uploads")
 bucket_name = os.getenv("AWS_S3_BUCKET")
-endpoint_url = os.getenv("R2_ENDPOINT")
+endpoint_url = os.getenv("S3_ENDPOINT") or os.getenv("R2_ENDPOINT") or os.getenv("B2_ENDPOINT")
 aws_access_key_id = os.getenv("AWS_ACCESS_KEY_ID")
 aws_secret_access_key = os.getenv("AWS_SECRET_ACCESS_KEY")
 region_name = os.getenv("AWS_REGION", "auto")
 
-s3_client = boto3.client(
-    "s3",
-    endpoint_url=endpoint_url,
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=region_name
-)
-
-for filename in os.listdir(uploads_dir):
-    file_path = os.path.join(uploads_dir, filename)
-    if os.path.isfile(file_path):
-        key = f"profiles/{filename}"
-        print(f"Uploading {filename} to {bucket_name}/{key} ...")
-        s3_client.upload_file(file_path, bucket_name, key)
-print("All files uploaded.")
\ No newline at end of file
+DEFAULT_MANIFEST = os.path.join(os.path.dirname(__file__), "upload_images.manifest.json")
+KEY_PREFIX = "profiles/"
+MAX_ATTEMPTS = 4
+# Files at or below this size go up in one PUT, so their ETag is their MD5
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+
+
+def make_client(workers: int):
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=region_name,
+        config=Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "path"},
+            max_pool_connections=workers,
+            retries={"max_attempts": MAX_ATTEMPTS, "mode": "adaptive"},
+        ),
+    )
+
+
+def list_remote(s3_client, prefix: str) -> dict:
+    """{key: (etag, size)} for every object under the prefix"""
+    remote = {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            remote[obj["Key"]] = (obj["ETag"].strip('"'), obj["Size"])
+    return remote
+
+
+def list_local(root: str):
+    """(relative posix path, absolute path) for every upload, including sharded content-addressed files"""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in filenames:
+            if filename.startswith("."):
+                continue
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, root).replace(os.sep, "/"), path
+
+
+def file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    Per-file state (size, mtime, md5, uploaded) persisted as JSON. With
+    persist=False (dry runs) the state is only kept in memory.
+    """
+
+    def __init__(self, path: str, reset: bool = False, persist: bool = True):
+        self.path = path
+        self.persist = persist
+        self.files = {}
+        self._lock = threading.Lock()
+        self._dirty = 0
+        if not reset and os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f).get("files", {})
+
+    def md5(self, rel_path: str, abs_path: str, stat) -> str:
+        """Reuse the recorded MD5 while the file's size and mtime are unchanged"""
+        entry = self.files.get(rel_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            return entry["md5"]
+        md5 = file_md5(abs_path)
+        with self._lock:
+            self.files[rel_path] = {"size": stat.st_size, "mtime": stat.st_mtime, "md5": md5, "uploaded": False}
+        return md5
+
+    def mark_uploaded(self, rel_path: str):
+        with self._lock:
+            self.files[rel_path]["uploaded"] = True
+            self._dirty += 1
+            if self.persist and self._dirty >= 50:
+                self._save_locked()
+
+    def save(self):
+        with self._lock:
+            self._save_locked()
+
+    def _save_locked(self):
+        if not self.persist:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = 0
+
+
+def needs_upload(remote: dict, key: str, md5: str, size: int) -> bool:
+    existing = remote.get(key)
+    if existing is None:
+        return True
+    etag, remote_size = existing
+    if remote_size != size:
+        return True
+    # Multipart ETags ("<hash>-<parts>") are not an MD5 of the content; size must do
+    return "-" not in etag and etag != md5
+
+
+def upload_one(s3_client, transfer_config, manifest: Manifest, remote: dict, rel_path: str, abs_path: str, dry_run: bool):
+    """Returns (status, bytes) where status is "uploaded", "skipped" or "failed" """
+    key = KEY_PREFIX + rel_path
+    stat = os.stat(abs_path)
+    md5 = manifest.md5(rel_path, abs_path, stat)
+    if not needs_upload(remote, key, md5, stat.st_size):
+        manifest.mark_uploaded(rel_path)
+        return "skipped", 0
+    if dry_run:
+        return "uploaded", stat.st_size
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            s3_client.upload_file(abs_path, bucket_name, key, Config=transfer_config)
+            manifest.mark_uploaded(rel_path)
+            return "uploaded", stat.st_size
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS:
+                print(f"Failed to upload {rel_path}: {e}")
+                return "failed", 0
+            time.sleep(0.5 * 2 ** (attempt - 1))
+
+
+async def rewrite_profile_paths(present: set, batch_size: int) -> int:
+    """Point users at object keys for every /uploads file that is now in the bucket"""
+    from database import db
+
+    def to_key(path):
+        if path and path.startswith("/uploads/") and path[len("/uploads/"):] in present:
+            return KEY_PREFIX + path[len("/uploads/"):]
+        return path
+
+    await db.connect()
+    try:
+        rows = await db.query_raw(
+            '''
+            SELECT id, "profilePath", "profileVariants"
+            FROM "User"
+            WHERE "profilePath" LIKE '/uploads/%'
+               OR "profileVariants"::text LIKE '%/uploads/%'
+            '''
+        )
+        updates = []
+        for row in rows:
+            variants = row["profileVariants"]
+            if isinstance(variants, str):
+                variants = json.loads(variants)
+            new_path = to_key(row["profilePath"])
+            new_variants = {size: to_key(p) for size, p in variants.items()} if variants else variants
+            if new_path != row["profilePath"] or new_variants != variants:
+                updates.append((row["id"], new_path, json.dumps(new_variants) if new_variants else None))
+
+        for start in range(0, len(updates), batch_size):
+            batch = updates[start:start + batch_size]
+            values = []
+            params = []
+            for i, (user_id, path, variants) in enumerate(batch):
+                values.append(f"(${3 * i + 1}::int, ${3 * i + 2}::text, ${3 * i + 3}::jsonb)")
+                params.extend([user_id, path, variants])
+            await db.execute_raw(
+                f'''
+                UPDATE "User" AS u
+                SET "profilePath" = v.path, "profileVariants" = v.variants
+                FROM (VALUES {", ".join(values)}) AS v(id, path, variants)
+                WHERE u.id = v.id
+                ''',
+                *params
+            )
+        return len(updates)
+    finally:
+        await db.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload backend/uploads to the S3/R2/B2 bucket")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    parser.add_argument("--reset", action="store_true", help="Ignore the manifest and re-hash everything")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be uploaded")
+    parser.add_argument("--no-db", action="store_true", help="Do not rewrite User.profilePath")
+    parser.add_argument("--batch-size", type=int, default=500, help="Rows per profilePath UPDATE")
+    args = parser.parse_args()
+
+    s3_client = make_client(args.workers)
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, use_threads=False)
+    manifest = Manifest(args.manifest, reset=args.reset, persist=not args.dry_run)
+
+    remote = list_remote(s3_client, KEY_PREFIX)
+    local_files = list(list_local(uploads_dir))
+    print(f"{len(local_files)} local files, {len(remote)} objects already under {bucket_name}/{KEY_PREFIX}")
+
+    counts = {"uploaded": 0, "skipped": 0, "failed": 0}
+    uploaded_bytes = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [
+            pool.submit(upload_one, s3_client, transfer_config, manifest, remote, rel_path, abs_path, args.dry_run)
+            for rel_path, abs_path in local_files
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            status, size = future.result()
+            counts[status] += 1
+            uploaded_bytes += size
+            if done % 100 == 0 or done == len(futures):
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{done}/{len(futures)}: {counts['uploaded']} uploaded, {counts['skipped']} skipped, "
+                    f"{counts['failed']} failed ({done / elapsed:.1f} files/s, "
+                    f"{uploaded_bytes / elapsed / 1e6:.2f} MB/s)"
+                )
+    if not args.dry_run:
+        manifest.save()
+
+    if not args.no_db and not args.dry_run:
+        present = {rel for rel, entry in manifest.files.items() if entry.get("uploaded")}
+        rewritten = asyncio.run(rewrite_profile_paths(present, args.batch_size))
+        print(f"Pointed {rewritten} users at their object keys")
+    print("All files uploaded." if not counts["failed"] else f"{counts['failed']} files failed; re-run to retry.")
+
+
+if __name__ == "__main__":
+    main()
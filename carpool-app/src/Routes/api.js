@@ -125,7 +125,12 @@ export function getProfileImageUrl(profilePath) {
         return profilePath;
     }
     
-    // Otherwise, it's a local file - get filename and construct local URL
+    // Local files keep their path under /uploads (content-addressed files are sharded: /uploads/ab/cd/<hash>.webp)
+    if (profilePath.startsWith('/uploads/')) {
+        return `${API_BASE}${profilePath}`;
+    }
+    
+    // Otherwise, it's a bare local filename - construct local URL
     const filename = profilePath.split('/').pop();
     return `${API_BASE}/uploads/${filename}`;
 }